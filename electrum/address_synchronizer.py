@@ -23,6 +23,10 @@
 
 import threading
 import itertools
+import hashlib
+import hmac
+import json
+import os
 from collections import defaultdict
 
 from . import bitcoin
@@ -31,13 +35,16 @@ from .util import PrintError, profiler, bfh, VerifiedTxInfo, TxMinedStatus
 from .transaction import Transaction, TxOutput
 from .synchronizer import Synchronizer
 from .verifier import SPV
-from .blockchain import hash_header
 from .i18n import _
 
 TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# snapshot of the indexes derived from the wallet file
+SNAPSHOT_MAGIC = b'ELSNAP'
+SNAPSHOT_VERSION = 2
+
 class AddTransactionException(Exception):
     pass
 
@@ -55,12 +62,17 @@ class AddressSynchronizer(PrintError):
     def __init__(self, storage):
         self.storage = storage
         self.network = None
+        self.scheduler = None
         # verifier (SPV) and synchronizer are started in start_threads
         self.synchronizer = None
         self.verifier = None
         # locks: if you need to take multiple ones, acquire them in the order they are defined here!
         self.lock = threading.RLock()
         self.transaction_lock = threading.RLock()
+        # txids and addresses changed since the last pop_changes
+        self.changes_lock = threading.Lock()
+        self.changed_txids = set()
+        self.changed_addresses = set()
         # address -> list(txid, height)
         self.history = storage.get('addr_history',{})
         # Verified transactions.  txid -> VerifiedTxInfo.  Access with self.lock.
@@ -78,12 +90,110 @@ class AddressSynchronizer(PrintError):
         self.load_and_cleanup()
 
     def load_and_cleanup(self):
+        if self.load_snapshot():
+            self.load_unverified_transactions()
+            return
         self.load_transactions()
         self.load_local_history()
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
 
+    def snapshot_path(self):
+        dirname, basename = os.path.split(self.storage.path)
+        return os.path.join(dirname, '.' + basename + '.snapshot')
+
+    def snapshot_key(self):
+        '''Key of the MAC of the snapshot, derived from the content of
+        the wallet file, as last read or written.  It is not stored in
+        the snapshot, and changes whenever the wallet file does.'''
+        if not os.path.exists(self.storage.path):
+            return None
+        with open(self.storage.path, 'rb') as f:
+            return hashlib.sha256(b'electrum snapshot key' + f.read()).digest()
+
+    def use_shared_caches(self):
+        # the transaction and proof caches of the electrum directory
+        # are shared by all wallets and not encrypted; an encrypted
+        # wallet only reads from them
+        return not self.storage.is_encrypted()
+
+    def use_snapshot(self):
+        # snapshots are not encrypted, and would leak the history
+        # of an encrypted wallet.  They are only valid for the data
+        # in the wallet file, not for changes we have not written.
+        return (self.storage.path is not None
+                and not self.storage.is_encrypted()
+                and not self.storage.modified)
+
+    @profiler
+    def load_snapshot(self):
+        '''Loads the indexes saved by write_snapshot, if they were
+        derived from the current content of the wallet file.'''
+        path = self.snapshot_path()
+        if not self.use_snapshot() or not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            data = f.read()
+        n = len(SNAPSHOT_MAGIC)
+        if data[0:n] != SNAPSHOT_MAGIC or data[n:n+1] != bytes([SNAPSHOT_VERSION]):
+            return False
+        mac, payload = data[n+1:n+33], data[n+33:]
+        key = self.snapshot_key()
+        if key is None or not hmac.compare_digest(mac, hmac.new(key, payload, hashlib.sha256).digest()):
+            # outdated, corrupted or not ours
+            self.print_error('snapshot does not match the wallet file')
+            return False
+        try:
+            d = json.loads(payload.decode('utf8'))
+            txi = {txid: {addr: set(tuple(x) for x in lst) for addr, lst in v.items()}
+                   for txid, v in d['txi'].items()}
+            spent_outpoints = defaultdict(dict)
+            for prevout_hash, v in d['spent_outpoints'].items():
+                spent_outpoints[prevout_hash] = {int(n): txid for n, txid in v.items()}
+            history_local = {addr: set(txids) for addr, txids in d['history_local'].items()}
+            tx_list = self.storage.get('transactions', {})
+            transactions = {tx_hash: Transaction(tx_list[tx_hash])
+                            for tx_hash in d['transactions']}
+            txo, tx_fees = d['txo'], d['tx_fees']
+        except BaseException as e:
+            self.print_error('cannot read snapshot', repr(e))
+            return False
+        self.txi = txi
+        self.txo = txo
+        self.tx_fees = tx_fees
+        self.spent_outpoints = spent_outpoints
+        self._history_local = history_local
+        self.transactions = transactions
+        return True
+
+    @profiler
+    def write_snapshot(self):
+        '''Saves the indexes derived from the wallet file, so that the
+        next load_and_cleanup can skip rebuilding them.  Call after the
+        wallet file has been written.'''
+        path = self.snapshot_path()
+        if not self.use_snapshot():
+            return
+        key = self.snapshot_key()
+        if key is None:
+            return
+        with self.transaction_lock:
+            payload = json.dumps({
+                'txi': {txid: {addr: list(s) for addr, s in v.items()}
+                        for txid, v in self.txi.items()},
+                'txo': self.txo,
+                'tx_fees': self.tx_fees,
+                'spent_outpoints': self.spent_outpoints,
+                'history_local': {addr: list(s) for addr, s in self._history_local.items()},
+                'transactions': list(self.transactions.keys()),
+            }).encode('utf8')
+        mac = hmac.new(key, payload, hashlib.sha256).digest()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + mac + payload)
+        os.replace(temp_path, path)
+
     def is_mine(self, address):
         return address in self.history
 
@@ -134,19 +244,30 @@ class AddressSynchronizer(PrintError):
                 # add it in case it was previously unconfirmed
                 self.add_unverified_tx(tx_hash, tx_height)
 
-    def start_threads(self, network):
+    def start_threads(self, network, scheduler=None):
+        '''The jobs run on the network thread, or on the workers of
+        the daemon's scheduler if one is given.'''
         self.network = network
+        self.scheduler = scheduler
         if self.network is not None:
+            # the synchronizer subscribes to all of them
+            bitcoin.addresses_to_scripthashes(self.get_addresses())
             self.verifier = SPV(self.network, self)
             self.synchronizer = Synchronizer(self, network)
-            network.add_jobs([self.verifier, self.synchronizer])
+            if scheduler:
+                scheduler.add_jobs(self.storage.path, [self.verifier, self.synchronizer])
+            else:
+                network.add_jobs([self.verifier, self.synchronizer])
         else:
             self.verifier = None
             self.synchronizer = None
 
     def stop_threads(self):
         if self.network:
-            self.network.remove_jobs([self.synchronizer, self.verifier])
+            if self.scheduler:
+                self.scheduler.remove_jobs(self.storage.path, [self.synchronizer, self.verifier])
+            else:
+                self.network.remove_jobs([self.synchronizer, self.verifier])
             self.synchronizer.release()
             self.synchronizer = None
             self.verifier = None
@@ -156,11 +277,13 @@ class AddressSynchronizer(PrintError):
         self.save_transactions()
         self.save_verified_tx()
         self.storage.write()
+        self.write_snapshot()
 
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
             self.set_up_to_date(False)
+            self.mark_changed(addresses=[address])
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -343,6 +466,7 @@ class AddressSynchronizer(PrintError):
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+        self.mark_changed(addresses=[addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -523,6 +647,7 @@ class AddressSynchronizer(PrintError):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
+            self.mark_tx_changed(txid)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
@@ -534,6 +659,28 @@ class AddressSynchronizer(PrintError):
                     pass
                 else:
                     self._history_local[addr] = cur_hist
+            # after the change, so that a cached value computed in the
+            # meantime is dropped
+            self.mark_tx_changed(txid)
+
+    def mark_changed(self, txids=(), addresses=()):
+        with self.changes_lock:
+            self.changed_txids.update(txids)
+            self.changed_addresses.update(addresses)
+
+    def mark_tx_changed(self, txid):
+        with self.transaction_lock:
+            addresses = list(itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])))
+        self.mark_changed([txid], addresses)
+
+    def pop_changes(self):
+        '''Returns the sets of txids and addresses whose history, height
+        or value changed since the last call, so that the GUI only
+        updates what changed.'''
+        with self.changes_lock:
+            txids, self.changed_txids = self.changed_txids, set()
+            addresses, self.changed_addresses = self.changed_addresses, set()
+        return txids, addresses
 
     def add_unverified_tx(self, tx_hash, tx_height):
         if tx_hash in self.verified_tx:
@@ -549,12 +696,14 @@ class AddressSynchronizer(PrintError):
             # to remove pending proof requests:
             if self.verifier:
                 self.verifier.remove_spv_proof_for_tx(tx_hash)
+        self.mark_tx_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: VerifiedTxInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info
+        self.mark_tx_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, tx_mined_status)
 
@@ -570,8 +719,8 @@ class AddressSynchronizer(PrintError):
             for tx_hash, info in list(self.verified_tx.items()):
                 tx_height = info.height
                 if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
+                    # the header itself may have been pruned
+                    if blockchain.read_hash(tx_height) != info.header_hash:
                         self.verified_tx.pop(tx_hash, None)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
@@ -584,6 +733,8 @@ class AddressSynchronizer(PrintError):
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
                         txs.add(tx_hash)
+        for tx_hash in txs:
+            self.mark_tx_changed(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -24,6 +24,7 @@
 # SOFTWARE.
 
 import hashlib
+from functools import lru_cache
 from typing import List
 
 from .util import bfh, bh2u, BitcoinException, print_error, assert_bytes, to_bytes, inv_dict
@@ -266,9 +267,19 @@ def script_to_address(script, *, net=None):
     assert t == TYPE_ADDRESS
     return addr
 
+# wallets convert the same addresses over and over, when they
+# subscribe to them and when they serialize transactions
+ADDRESS_CACHE_SIZE = 100000
+
+
 def address_to_script(addr, *, net=None):
     if net is None:
         net = constants.net
+    return _address_to_script(addr, net)
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _address_to_script(addr, net):
     witver, witprog = segwit_addr.decode(net.SEGWIT_HRP, addr)
     if witprog is not None:
         if not (0 <= witver <= 16):
@@ -290,10 +301,29 @@ def address_to_script(addr, *, net=None):
         raise BitcoinException('unknown address type: {}'.format(addrtype))
     return script
 
-def address_to_scripthash(addr):
-    script = address_to_script(addr)
+def address_to_scripthash(addr, *, net=None):
+    if net is None:
+        net = constants.net
+    return _address_to_scripthash(addr, net)
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _address_to_scripthash(addr, net):
+    script = _address_to_script(addr, net)
     return script_to_scripthash(script)
 
+
+def addresses_to_scripts(addresses, *, net=None) -> List[str]:
+    if net is None:
+        net = constants.net
+    return [_address_to_script(addr, net) for addr in addresses]
+
+
+def addresses_to_scripthashes(addresses, *, net=None) -> List[str]:
+    if net is None:
+        net = constants.net
+    return [_address_to_scripthash(addr, net) for addr in addresses]
+
 def script_to_scripthash(script):
     h = sha256(bytes.fromhex(script))[0:32]
     return bh2u(bytes(reversed(h)))
@@ -310,34 +340,77 @@ __b43chars = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
 
+class _BaseCodec:
+    '''Conversion between bytes and the digits of a base.  The number
+    is split into chunks of CHUNK digits, so that most of the arithmetic
+    is done on small integers; a chunk is encoded two digits at a time
+    with a lookup table.'''
+
+    CHUNK = 10
+
+    def __init__(self, chars):
+        self.chars = chars
+        self.base = base = len(chars)
+        self.chunk_base = base ** self.CHUNK
+        self.pairs = [bytes([a, b]) for a in chars for b in chars]
+        # maps a character to its digit, and any other byte to 0xff
+        table = bytearray(b'\xff' * 256)
+        for i, c in enumerate(chars):
+            table[c] = i
+        self.digits = bytes(table)
+
+    def encode(self, v: bytes) -> str:
+        n = int.from_bytes(v, 'big')
+        chunks = []
+        while n >= self.chunk_base:
+            n, r = divmod(n, self.chunk_base)
+            chunks.append(r)
+        chunks.append(n)
+        base2 = self.base * self.base
+        pairs = self.pairs
+        result = bytearray()
+        for r in reversed(chunks):
+            chunk = []
+            for i in range(self.CHUNK // 2):
+                r, d = divmod(r, base2)
+                chunk.append(pairs[d])
+            result += b''.join(reversed(chunk))
+        zero = self.chars[0]
+        result = result.lstrip(bytes([zero])) or bytes([zero])
+        # Bitcoin does a little leading-zero-compression:
+        # leading 0-bytes in the input become leading-1s
+        npad = len(v) - len(v.lstrip(b'\x00'))
+        return (bytes([zero]) * npad + result).decode('ascii')
+
+    def decode(self, v: bytes) -> bytes:
+        digits = v.translate(self.digits)
+        bad = digits.rfind(b'\xff')
+        if bad != -1:
+            raise ValueError('Forbidden character {} for base {}'.format(v[bad], self.base))
+        base = self.base
+        n = 0
+        # the first chunk is the short one
+        i, size = 0, len(digits) % self.CHUNK or self.CHUNK
+        while i < len(digits):
+            r = 0
+            for d in digits[i:i + size]:
+                r = r * base + d
+            n = n * self.chunk_base + r
+            i, size = i + size, self.CHUNK
+        npad = len(v) - len(v.lstrip(self.chars[:1]))
+        result = n.to_bytes(max(1, (n.bit_length() + 7) // 8), 'big')
+        return b'\x00' * npad + result
+
+
+_codecs = {58: _BaseCodec(__b58chars), 43: _BaseCodec(__b43chars)}
+
+
 def base_encode(v: bytes, base: int) -> str:
     """ encode v, which is a string of bytes, to base58."""
     assert_bytes(v)
     if base not in (58, 43):
         raise ValueError('not supported base: {}'.format(base))
-    chars = __b58chars
-    if base == 43:
-        chars = __b43chars
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * c
-    result = bytearray()
-    while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result.append(chars[mod])
-        long_value = div
-    result.append(chars[long_value])
-    # Bitcoin does a little leading-zero-compression:
-    # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == 0x00:
-            nPad += 1
-        else:
-            break
-    result.extend([chars[0]] * nPad)
-    result.reverse()
-    return result.decode('ascii')
+    return _codecs[base].encode(v)
 
 
 def base_decode(v, length, base):
@@ -346,32 +419,10 @@ def base_decode(v, length, base):
     v = to_bytes(v, 'ascii')
     if base not in (58, 43):
         raise ValueError('not supported base: {}'.format(base))
-    chars = __b58chars
-    if base == 43:
-        chars = __b43chars
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        digit = chars.find(bytes([c]))
-        if digit == -1:
-            raise ValueError('Forbidden character {} for base {}'.format(c, base))
-        long_value += digit * (base**i)
-    result = bytearray()
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result.append(mod)
-        long_value = div
-    result.append(long_value)
-    nPad = 0
-    for c in v:
-        if c == chars[0]:
-            nPad += 1
-        else:
-            break
-    result.extend(b'\x00' * nPad)
+    result = _codecs[base].decode(v)
     if length is not None and len(result) != length:
         return None
-    result.reverse()
-    return bytes(result)
+    return result
 
 
 class InvalidChecksum(Exception):
@@ -632,6 +683,19 @@ class InvalidMasterKeyVersionBytes(BitcoinException): pass
 def deserialize_xkey(xkey, prv, *, net=None):
     if net is None:
         net = constants.net
+    if not prv:
+        return _deserialize_xpub(xkey, net)
+    return _deserialize_xkey(xkey, prv, net)
+
+
+@lru_cache(maxsize=1000)
+def _deserialize_xpub(xkey, net):
+    # the same few xpubs are parsed for every address and every
+    # x_pubkey of a wallet.  private keys are never kept here.
+    return _deserialize_xkey(xkey, False, net)
+
+
+def _deserialize_xkey(xkey, prv, net):
     xkey = DecodeBase58Check(xkey)
     if len(xkey) != 78:
         raise BitcoinException('Invalid length for extended key: {}'
@@ -29,6 +29,8 @@ from . import constants
 from .util import bfh, bh2u
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+HEADER_SIZE = 80
+HASH_SIZE = 32
 
 
 class MissingHeader(Exception):
@@ -92,11 +94,26 @@ def read_blockchains(config):
 def check_header(header):
     if type(header) is not dict:
         return False
-    for b in blockchains.values():
-        if b.check_header(header):
-            return b
+    height = header.get('block_height')
+    header_hash = hash_header(header)
+    b = find_hash(header_hash)
+    if b and b.get_height(header_hash) == height:
+        return b
+    # headers of the checkpoint region may not have been downloaded;
+    # get_hash knows the checkpoints
+    if height is not None and height < len(constants.net.CHECKPOINTS) * 2016:
+        for b in blockchains.values():
+            if b.check_header(header):
+                return b
     return False
 
+def find_hash(header_hash):
+    '''Returns the branch that has a header with this hash, or None.'''
+    for b in list(blockchains.values()):
+        if b.get_height(header_hash) is not None:
+            return b
+    return None
+
 def can_connect(header):
     for b in blockchains.values():
         if b.can_connect(header):
@@ -117,8 +134,12 @@ class Blockchain(util.PrintError):
         self.parent_id = parent_id
         assert parent_id != forkpoint
         self.lock = threading.RLock()
+        self._targets = {}  # chunk index -> target
+        self._heights = {}  # block hash (bytes) -> height, for the headers of this branch
         with self.lock:
             self.update_size()
+            self.sync_hashes()
+            self.load_heights()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -187,12 +208,98 @@ class Blockchain(util.PrintError):
             header = deserialize_header(raw_header, index*2016 + i)
             self.verify_header(header, prev_hash, target)
             prev_hash = hash_header(header)
+            # headers we have pruned must come back unchanged
+            known_hash = self.read_hash(index*2016 + i)
+            if known_hash is not None and known_hash != prev_hash:
+                raise Exception("hash mismatch with index at height %d" % (index*2016 + i))
 
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.forkpoint))
         return os.path.join(d, filename)
 
+    def hashes_path(self):
+        # index of block hashes: one 32 byte hash per header of the
+        # headers file, in the same order
+        d = util.get_headers_dir(self.config)
+        filename = 'blockchain_hashes' if self.parent_id is None else os.path.join('forks', 'hashes_%d_%d'%(self.parent_id, self.forkpoint))
+        return os.path.join(d, filename)
+
+    @classmethod
+    def hash_headers(cls, data):
+        hashes = []
+        for i in range(0, len(data), HEADER_SIZE):
+            raw_header = data[i:i+HEADER_SIZE]
+            # headers not downloaded yet are zeroed
+            if raw_header == bytes(HEADER_SIZE):
+                hashes.append(bytes(HASH_SIZE))
+            else:
+                hashes.append(Hash(raw_header))
+        return b''.join(hashes)
+
+    def write_hashes(self, hashes, offset, truncate=True):
+        filename = self.hashes_path()
+        with self.lock:
+            with open(filename, 'rb+' if os.path.exists(filename) else 'wb+') as f:
+                # forget the hashes being overwritten
+                f.seek(offset)
+                old_hashes = f.read() if truncate else f.read(len(hashes))
+                self.update_heights(old_hashes, offset, remove=True)
+                if truncate:
+                    f.seek(offset)
+                    f.truncate()
+                f.seek(offset)
+                f.write(hashes)
+            self.update_heights(hashes, offset)
+
+    def update_heights(self, hashes, offset, remove=False):
+        height = self.forkpoint + offset // HASH_SIZE
+        for i in range(0, len(hashes), HASH_SIZE):
+            h = hashes[i:i+HASH_SIZE]
+            if h == bytes(HASH_SIZE):
+                pass
+            elif not remove:
+                self._heights[h] = height
+            elif self._heights.get(h) == height:
+                del self._heights[h]
+            height += 1
+
+    @with_lock
+    def load_heights(self):
+        self._heights = {}
+        with open(self.hashes_path(), 'rb') as f:
+            offset = 0
+            while True:
+                hashes = f.read(2016 * HASH_SIZE)
+                if not hashes:
+                    break
+                self.update_heights(hashes, offset)
+                offset += len(hashes)
+
+    def get_height(self, header_hash):
+        '''Height of the header with this hash, if it is stored in this
+        branch (and not in a parent).'''
+        return self._heights.get(bfh(header_hash)[::-1])
+
+    @with_lock
+    def sync_hashes(self):
+        '''Brings the hash index in line with the headers file, e.g. after
+        an upgrade or a crash between writing the two.'''
+        size = self.size() if os.path.exists(self.path()) else 0
+        filename = self.hashes_path()
+        num_hashes = os.path.getsize(filename) // HASH_SIZE if os.path.exists(filename) else 0
+        if num_hashes > size or not os.path.exists(filename):
+            self.write_hashes(b'', min(num_hashes, size) * HASH_SIZE)
+            num_hashes = min(num_hashes, size)
+        if num_hashes == size:
+            return
+        self.print_error('indexing %d headers' % (size - num_hashes))
+        with open(self.path(), 'rb') as f:
+            for start in range(num_hashes, size, 2016):
+                f.seek(start * HEADER_SIZE)
+                data = f.read(min(2016, size - start) * HEADER_SIZE)
+                self.write_hashes(self.hash_headers(data), start * HASH_SIZE, truncate=False)
+
     @with_lock
     def save_chunk(self, index, chunk):
         chunk_within_checkpoint_region = index < len(self.checkpoints)
@@ -204,15 +311,55 @@ class Blockchain(util.PrintError):
 
         delta_height = (index * 2016 - self.forkpoint)
         delta_bytes = delta_height * 80
+        # a chunk that does not extend the branch refills pruned headers
+        refill = index * 2016 + len(chunk) // 80 - 1 <= self.height()
         # if this chunk contains our forkpoint, only save the part after forkpoint
         # (the part before is the responsibility of the parent)
         if delta_bytes < 0:
+            if refill:
+                self.parent().save_chunk(index, chunk[:-delta_bytes])
             chunk = chunk[-delta_bytes:]
             delta_bytes = 0
-        truncate = not chunk_within_checkpoint_region
+        truncate = not chunk_within_checkpoint_region and not refill
         self.write(chunk, delta_bytes, truncate)
         self.swap_with_parent()
 
+    @with_lock
+    def prune(self, height):
+        '''Drops the headers below height from the headers file, except
+        the first and last header of each retarget period.  Their hashes
+        stay in the index, so get_hash and forks are not affected, and a
+        pruned chunk can be downloaded again and checked against the
+        index when a header is needed.  The file is rewritten as a
+        sparse file, so that the zeroed headers do not use disk space.'''
+        assert self.parent_id is None
+        height = min(height, self.height() + 1)
+        filename = self.path()
+        tmp_filename = filename + '.tmp'
+        block_size = 4096
+        zero_block = bytes(block_size)
+        with open(filename, 'rb') as f, open(tmp_filename, 'wb') as g:
+            for index in range(self.size() // 2016 + 1):
+                chunk = bytearray(f.read(2016 * HEADER_SIZE))
+                if not chunk:
+                    break
+                for i in range(1, min(2015, len(chunk) // HEADER_SIZE)):
+                    if index * 2016 + i >= height:
+                        break
+                    chunk[i*HEADER_SIZE:(i+1)*HEADER_SIZE] = bytes(HEADER_SIZE)
+                # chunks are not aligned with file system blocks
+                for i in range(0, len(chunk), block_size):
+                    block = bytes(chunk[i:i+block_size])
+                    if block == zero_block:
+                        g.seek(len(block), os.SEEK_CUR)
+                    else:
+                        g.write(block)
+            g.truncate(self.size() * HEADER_SIZE)
+            g.flush()
+            os.fsync(g.fileno())
+        os.replace(tmp_filename, filename)
+        self.print_error('pruned headers below', height)
+
     @with_lock
     def swap_with_parent(self):
         if self.parent_id is None:
@@ -231,21 +378,30 @@ class Blockchain(util.PrintError):
         with open(parent.path(), 'rb') as f:
             f.seek((forkpoint - parent.forkpoint)*80)
             parent_data = f.read(parent_branch_size*80)
-        self.write(parent_data, 0)
-        parent.write(my_data, (forkpoint - parent.forkpoint)*80)
+        with open(self.hashes_path(), 'rb') as f:
+            my_hashes = f.read()
+        with open(parent.hashes_path(), 'rb') as f:
+            f.seek((forkpoint - parent.forkpoint)*HASH_SIZE)
+            parent_hashes = f.read(parent_branch_size*HASH_SIZE)
+        self.write(parent_data, 0, hashes=parent_hashes)
+        parent.write(my_data, (forkpoint - parent.forkpoint)*80, hashes=my_hashes)
         # store file path
         for b in blockchains.values():
             b.old_path = b.path()
+            b.old_hashes_path = b.hashes_path()
+            b._targets = {}
         # swap parameters
         self.parent_id = parent.parent_id; parent.parent_id = parent_id
         self.forkpoint = parent.forkpoint; parent.forkpoint = forkpoint
         self._size = parent._size; parent._size = parent_branch_size
+        self._heights, parent._heights = parent._heights, self._heights
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
                 os.rename(b.old_path, b.path())
+                os.rename(b.old_hashes_path, b.hashes_path())
         # update pointers
         blockchains[self.forkpoint] = self
         blockchains[parent.forkpoint] = parent
@@ -258,7 +414,7 @@ class Blockchain(util.PrintError):
         else:
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
-    def write(self, data, offset, truncate=True):
+    def write(self, data, offset, truncate=True, hashes=None):
         filename = self.path()
         with self.lock:
             self.assert_headers_file_available(filename)
@@ -270,7 +426,16 @@ class Blockchain(util.PrintError):
                 f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
+            if hashes is None:
+                hashes = self.hash_headers(data)
+            self.write_hashes(hashes, offset // HEADER_SIZE * HASH_SIZE,
+                              truncate and offset != self._size*80)
             self.update_size()
+            # targets of the chunks from offset on may have changed
+            first_index = (self.forkpoint + offset // HEADER_SIZE) // 2016
+            for index in list(self._targets):
+                if index >= first_index:
+                    del self._targets[index]
 
     @with_lock
     def save_header(self, header):
@@ -312,8 +477,29 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
-        else:
-            return hash_header(self.read_header(height))
+        return self.read_hash(height) or hash_header(None)
+
+    def read_hash(self, height):
+        '''Hash of the header at height from the index, or None if we
+        do not have it.'''
+        assert self.parent_id != self.forkpoint
+        if height < 0:
+            return
+        if height < self.forkpoint:
+            return self.parent().read_hash(height)
+        if height > self.height():
+            return
+        delta = height - self.forkpoint
+        with open(self.hashes_path(), 'rb') as f:
+            f.seek(delta * HASH_SIZE)
+            h = f.read(HASH_SIZE)
+        if len(h) < HASH_SIZE:
+            # index is behind; should not happen
+            header = self.read_header(height)
+            return hash_header(header) if header else None
+        if h == bytes(HASH_SIZE):
+            return
+        return hash_encode(h)
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
@@ -324,6 +510,12 @@ class Blockchain(util.PrintError):
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
+        target = self._targets.get(index)
+        if target is None:
+            target = self._targets[index] = self.compute_target(index)
+        return target
+
+    def compute_target(self, index):
         # new target
         first = self.read_header(index * 2016)
         last = self.read_header(index * 2016 + 2015)
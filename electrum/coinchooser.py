@@ -24,6 +24,7 @@
 # SOFTWARE.
 from collections import defaultdict, namedtuple
 from math import floor, log10
+import time
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS, is_address
 from .transaction import Transaction, TxOutput
@@ -225,12 +226,31 @@ class CoinChooserBase(PrintError):
 
             return total_weight
 
+        def get_excess(buckets):
+            '''Given a list of buckets, return the value left over after
+            paying the outputs and the fee, before adding any change'''
+            total_input = sum(bucket.value for bucket in buckets)
+            total_weight = get_tx_weight(buckets)
+            return total_input - spent_amount - fee_estimator_w(total_weight)
+
         def sufficient_funds(buckets):
             '''Given a list of buckets, return True if it has enough
             value to pay for the transaction'''
-            total_input = sum(bucket.value for bucket in buckets)
-            total_weight = get_tx_weight(buckets)
-            return total_input >= spent_amount + fee_estimator_w(total_weight)
+            return get_excess(buckets) >= 0
+
+        # Excess below this is dropped to fees by change_outputs() rather
+        # than paid to a change output.  Choosers that look for changeless
+        # solutions use it together with get_excess.
+        if change_addrs:
+            change_guess = change_addrs[0]
+        else:
+            change_guess = coins[0]['address'] if coins else None
+        if change_guess is not None:
+            change_weight = 4 * Transaction.estimated_output_size(change_guess)
+            self.cost_of_change = fee_estimator_w(change_weight) + dust_threshold
+        else:
+            self.cost_of_change = dust_threshold
+        self.get_excess = get_excess
 
         # Collect the coins into buckets, choose a subset of the buckets
         buckets = self.bucketize_coins(coins)
@@ -375,8 +395,133 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    """Looks for a set of coins that pays the outputs and the fee
+    closely enough that no change output is needed.
+    Coins are grouped by address, as with the Privacy chooser, and the
+    groups are searched depth-first, largest effective value first.
+    The search is deterministic and bounded by a number of steps; the
+    wall-clock limit is only a safeguard for very large wallets.
+    If no changeless solution is found, or if it would pay more in fees
+    than creating change, it falls back to the Privacy chooser.
+    """
+
+    # maximum number of search steps per confirmation class
+    max_tries = 100000
+    # seconds; the search stops early if this is exceeded
+    time_limit = 2.0
+
+    def effective_values(self, buckets):
+        '''Value of each bucket minus the fee it adds to the transaction'''
+        get_excess = self.get_excess
+        base = get_excess([])
+        return [get_excess([bkt]) - base for bkt in buckets]
+
+    def bnb_search(self, buckets, deadline):
+        '''Depth-first search for a subset of buckets whose excess is
+        below cost_of_change.  Returns the best subset found, or None.
+
+        At each depth the bucket is first included, then omitted.
+        A branch is abandoned as soon as it overshoots the target window,
+        cannot reach the target with the remaining buckets, or already
+        spends more than the best solution found so far.
+        '''
+        values = self.effective_values(buckets)
+        # sort on bucket descriptions too, so that the order in which
+        # coins were passed in does not change the result
+        pool = [(v, bkt.desc, bkt) for v, bkt in zip(values, buckets) if v > 0]
+        pool.sort(key=lambda x: x[:2], reverse=True)
+        if not pool:
+            return None
+        values = [v for v, desc, bkt in pool]
+        buckets = [bkt for v, desc, bkt in pool]
+        target = -self.get_excess([])
+        cost_of_change = self.cost_of_change
+        available = sum(values)
+        if available < target:
+            return None
+
+        selection = []  # inclusion flag per depth
+        current = 0
+        current_input = 0
+        # The best solution is the one that pays the lowest fee, i.e.
+        # the one with the lowest input value.
+        best, best_input = None, None
+        for tries in range(self.max_tries):
+            backtrack = False
+            if (current + available < target or current > target + cost_of_change
+                    or (best is not None and current_input >= best_input)):
+                backtrack = True
+            elif current >= target:
+                backtrack = True
+                chosen = [buckets[i] for i, inc in enumerate(selection) if inc]
+                # effective values are approximate (segwit marker, fee
+                # rounding), so check the candidate against the real excess
+                if 0 <= self.get_excess(chosen) < cost_of_change:
+                    best, best_input = chosen, current_input
+            if tries % 1000 == 0 and time.monotonic() > deadline:
+                self.print_error('branch and bound: time limit reached')
+                break
+            if backtrack:
+                # walk back to the last included bucket, and omit it
+                while selection and not selection[-1]:
+                    selection.pop()
+                    available += values[len(selection)]
+                if not selection:
+                    break
+                selection[-1] = False
+                current -= values[len(selection) - 1]
+                current_input -= buckets[len(selection) - 1].value
+            else:
+                depth = len(selection)
+                available -= values[depth]
+                if selection and not selection[-1] and values[depth] == values[depth - 1]:
+                    # omitting the previous bucket of the same value
+                    # already covers the branches where this one is used
+                    selection.append(False)
+                else:
+                    selection.append(True)
+                    current += values[depth]
+                    current_input += buckets[depth].value
+        return best
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        deadline = time.monotonic() + self.time_limit
+        # Prefer confirmed coins, as in bucket_candidates_prefer_confirmed
+        conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
+        unconf_buckets = [bkt for bkt in buckets if bkt.min_height == 0]
+        bucket_sets = [conf_buckets, conf_buckets + unconf_buckets, buckets]
+        searched = 0
+        winner = None
+        for bkts in bucket_sets:
+            if len(bkts) == searched:
+                continue
+            searched = len(bkts)
+            winner = self.bnb_search(bkts, deadline)
+            if winner is not None:
+                break
+        fallback = super().choose_buckets(buckets, sufficient_funds, penalty_func)
+        if winner is None:
+            return fallback
+        # Only go changeless if that does not cost more than the fallback
+        # solution and its change, counting the change at cost_of_change:
+        # the fee for the output plus the dust threshold, as an estimate
+        # of what spending it later will cost.
+        # fee = input value - spent amount - change, and the spent amount
+        # is the same for both
+        changeless_fee = sum(bkt.value for bkt in winner)
+        fallback_fee = (sum(bkt.value for bkt in fallback)
+                        - self.get_excess(fallback) + self.cost_of_change)
+        self.print_error("Changeless solution, excess:", self.get_excess(winner))
+        if changeless_fee > fallback_fee:
+            self.print_error("Changeless solution costs more, not using it")
+            return fallback
+        return winner
+
+
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
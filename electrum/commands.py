@@ -23,6 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import sys
 import datetime
 import copy
@@ -41,6 +42,7 @@ from .i18n import _
 from .transaction import Transaction, multisig_script, TxOutput
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .plugin import run_hook
+from .tx_cache import TxCache
 
 known_commands = {}
 
@@ -145,6 +147,20 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.has_password()}
 
+    @command('wp')
+    def unlock(self, password=None):
+        """Keep the wallet keys decrypted in memory, for the session timeout
+        of the config. Signing still requires the password, but does not
+        decrypt the keys again."""
+        self.wallet.unlock_keystores(password, self.config.get_session_timeout())
+        return True
+
+    @command('w')
+    def lock(self):
+        """Wipe the decrypted wallet keys from memory."""
+        self.wallet.lock_keystores()
+        return True
+
     @command('')
     def getconfig(self, key):
         """Return a configuration variable. """
@@ -445,9 +461,75 @@ class Commands:
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime)
         return tx.as_dict()
 
+    @command('wp')
+    def consolidate(self, feerate=None, target_utxos=None, max_weight=None, unsigned=False, rbf=None, password=None):
+        """Consolidate small coins. Returns transactions that merge the
+        smallest coins of the wallet into a few outputs. Unless a fee rate
+        is given, nothing is done while the low-priority fee rate is above
+        the 'consolidation_max_fee_per_kb' config variable. The transactions
+        are not broadcasted."""
+        from .consolidation import ConsolidationPlanner
+        planner = ConsolidationPlanner(self.wallet, self.config)
+        if target_utxos is not None:
+            planner.target_utxos = target_utxos
+        if max_weight is not None:
+            planner.max_weight = max_weight
+        fee_per_kb = int(Decimal(feerate) * 1000) if feerate is not None else None
+        txs = planner.make_transactions(fee_per_kb)
+        if rbf is None:
+            rbf = self.config.get('use_rbf', True)
+        for tx in txs:
+            if rbf:
+                tx.set_rbf(True)
+            if not unsigned:
+                self.wallet.sign_transaction(tx, password)
+        return [tx.as_dict() for tx in txs]
+
+    @command('wp')
+    def queuepayment(self, destination, amount, nocheck=False, password=None):
+        """Queue a payment. It will be paid by the daemon in a batch
+        transaction, together with other queued payments. Returns the id
+        of the queued payment. The password is kept in memory for the
+        session timeout of the config, to sign the batch; after that,
+        use sendpayouts."""
+        self.nocheck = nocheck
+        address = self._resolver(destination)
+        amount = satoshis(amount)
+        if amount == '!':
+            raise Exception('Cannot queue a payment of the maximum amount')
+        queue = self.wallet.payout_queue
+        if self.wallet.has_password():
+            self.wallet.check_password(password)
+            queue.set_password(password, self.config.get_session_timeout())
+        return queue.add(address, amount)
+
+    @command('w')
+    def payoutqueue(self):
+        """Show queued payments, and the status of batch transactions."""
+        return self.wallet.payout_queue.get_status(self.config)
+
     @command('w')
-    def history(self, year=None, show_addresses=False, show_fiat=False):
-        """Wallet history. Returns the transaction history of your wallet."""
+    def removepayment(self, payout_id):
+        """Remove a payment from the queue."""
+        return self.wallet.payout_queue.remove(payout_id)
+
+    @command('wpn')
+    def sendpayouts(self, password=None):
+        """Pay all queued payments now, in one transaction, and broadcast it."""
+        queue = self.wallet.payout_queue
+        tx = queue.make_tx(self.config, password)
+        if tx is None:
+            return False
+        ok, msg = self.network.broadcast_transaction(tx)
+        queue.on_broadcast(tx.txid(), ok, msg)
+        return msg
+
+    @command('w')
+    def history(self, year=None, show_addresses=False, show_fiat=False, output=None):
+        """Wallet history. Returns the transaction history of your wallet.
+        With --output, the history is written to that file instead, as
+        CSV if its name ends with .csv, and as JSON otherwise. The file
+        must not exist."""
         kwargs = {'show_addresses': show_addresses}
         if year:
             import time
@@ -459,6 +541,21 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
+        if output:
+            # this runs in the daemon, also for JSON-RPC callers: only
+            # create new files, at a path that does not depend on the
+            # working directory of the daemon
+            if not os.path.isabs(output):
+                raise Exception('Output path must be absolute: ' + output)
+            output = os.path.realpath(output)
+            summary = {}
+            try:
+                f = open(output, 'x', encoding='utf-8')
+            except FileExistsError:
+                raise Exception('File exists: ' + output)
+            with f:
+                n = self.wallet.export_history(f, output.endswith('.csv'), summary=summary, **kwargs)
+            return json_encode({'output': output, 'transactions': n, 'summary': summary})
         return json_encode(self.wallet.get_full_history(**kwargs))
 
     @command('w')
@@ -517,7 +614,10 @@ class Commands:
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
-            raw = self.network.get_transaction(txid)
+            if self.network:
+                raw = self.network.get_transaction(txid)
+            else:
+                raw = TxCache(self.config).get(txid)
             if raw:
                 tx = Transaction(raw)
             else:
@@ -697,6 +797,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'payout_id': 'Id of a queued payment',
 }
 
 command_options = {
@@ -732,8 +833,12 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'output':      (None, "Write to this new file"),
     'fee_method':  (None, "Fee estimation method to use"),
-    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position")
+    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
+    'feerate':     (None, "Fee rate (in sat/byte)"),
+    'target_utxos': (None, "Number of coins to leave in the wallet"),
+    'max_weight':  (None, "Maximum weight of each transaction"),
 }
 
 
@@ -745,6 +850,7 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'output': os.path.abspath,
     'tx': tx_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
@@ -755,6 +861,9 @@ arg_types = {
     'locktime': int,
     'fee_method': str,
     'fee_level': json_loads,
+    'feerate': lambda x: str(Decimal(x)),
+    'target_utxos': int,
+    'max_weight': int,
 }
 
 config_variables = {
@@ -765,6 +874,16 @@ config_variables = {
         'ssl_chain': 'Chain of SSL certificates, needed for signed requests. Put your certificate at the top and the root CA at the end',
         'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
     },
+    'consolidate': {
+        'consolidation_max_fee_per_kb': 'Do not consolidate while the low-priority fee rate (sat/kbyte) is above this.',
+        'consolidation_target_utxos': 'Number of coins to leave in the wallet.',
+        'consolidation_max_weight': 'Maximum weight of each consolidation transaction.',
+    },
+    'queuepayment': {
+        'payout_interval': 'Seconds a queued payment may wait before a batch is sent.',
+        'payout_max_outputs': 'Send a batch as soon as this many payments are queued.',
+        'payout_max_value': 'Send a batch as soon as this much value (in satoshis) is queued.',
+    },
     'listrequests':{
         'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
     }
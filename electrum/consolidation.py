@@ -0,0 +1,173 @@
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# UTXO consolidation.
+#
+# Wallets that receive many small payments end up with a large UTXO set,
+# which makes coin selection slow and future payments expensive.  The
+# planner below merges the smallest coins into a few outputs, in batches
+# that stay under a weight limit, and only while fees are low.
+
+from .bitcoin import TYPE_ADDRESS
+from .coinchooser import CoinChooserPrivacy
+from .simple_config import FEE_ETA_TARGETS, FEE_DEPTH_TARGETS
+from .transaction import Transaction, TxOutput
+from .util import PrintError, NoDynamicFeeEstimates
+
+
+# transactions above this weight are not relayed
+MAX_STANDARD_TX_WEIGHT = 400000
+
+
+class ConsolidationPlanner(PrintError):
+
+    # defaults, overridden by the config keys of the same name
+    # prefixed with 'consolidation_'
+    max_weight = 100000      # weight units per sweep transaction
+    target_utxos = 50        # stop once the wallet has this many coins
+    max_fee_per_kb = 5000    # only sweep while the low fee rate is below this
+
+    def __init__(self, wallet, config):
+        self.wallet = wallet
+        self.config = config
+        self.max_weight = min(MAX_STANDARD_TX_WEIGHT,
+                              config.get('consolidation_max_weight', self.max_weight))
+        self.target_utxos = config.get('consolidation_target_utxos', self.target_utxos)
+        self.max_fee_per_kb = config.get('consolidation_max_fee_per_kb', self.max_fee_per_kb)
+
+    def diagnostic_name(self):
+        return self.wallet.diagnostic_name()
+
+    def low_fee_per_kb(self):
+        '''Fee rate for a transaction that can wait, in sat/kbyte: the
+        slowest eta target or the deepest mempool target, whichever
+        is lower.'''
+        fees = [self.config.eta_target_to_fee(FEE_ETA_TARGETS[0])]
+        if self.config.has_fee_mempool():
+            fees.append(self.config.depth_target_to_fee(FEE_DEPTH_TARGETS[0]))
+        fees = [fee for fee in fees if fee is not None]
+        if not fees:
+            raise NoDynamicFeeEstimates()
+        return min(fees)
+
+    def is_low_fee_time(self, fee_per_kb):
+        return fee_per_kb <= self.max_fee_per_kb
+
+    def get_coins(self):
+        # only confirmed coins: sweeping unconfirmed ones would chain
+        # low-fee transactions onto transactions we do not control
+        coins = self.wallet.get_utxos(excluded=self.wallet.frozen_addresses,
+                                      mature=True, confirmed_only=True)
+        # needed to estimate input sizes
+        for coin in coins:
+            self.wallet.add_input_info(coin)
+        return coins
+
+    def plan(self, coins, fee_per_kb, dest_address):
+        '''Returns a list of batches, each a list of coins to be swept
+        into one output.
+
+        Coins are grouped by address, so that an address is either
+        spent entirely or not at all, and the smallest groups are swept
+        first.  Groups that cost more in fees than they are worth are
+        left alone.
+        '''
+        to_remove = len(coins) - self.target_utxos
+        if to_remove <= 0:
+            return []
+        fee_estimator = lambda weight: self.config.estimate_fee_for_feerate(
+            fee_per_kb, Transaction.virtual_size_from_weight(weight))
+        buckets = CoinChooserPrivacy().bucketize_coins(coins)
+        buckets = [b for b in buckets if b.value > fee_estimator(b.weight)]
+        buckets.sort(key=lambda b: (b.value / len(b.coins), b.desc))
+        output = TxOutput(TYPE_ADDRESS, dest_address, 0)
+        base_weight = Transaction.from_io([], [output]).estimated_weight()
+
+        def batch_weight(batch):
+            weight = base_weight + sum(b.weight for b in batch)
+            if any(b.witness for b in batch):
+                # marker and flag, and an empty witness per legacy input
+                weight += 2 + sum(len(b.coins) for b in batch if not b.witness)
+            return weight
+
+        # each batch turns n coins into one; a batch of a single coin
+        # is not emitted, and removes nothing
+        removed = lambda batch: max(0, sum(len(b.coins) for b in batch) - 1)
+        batches = []
+        batch = []
+        for bucket in buckets:
+            if to_remove - removed(batch) <= 0:
+                break
+            if batch and batch_weight(batch + [bucket]) > self.max_weight:
+                if removed(batch):
+                    batches.append(batch)
+                    to_remove -= removed(batch)
+                batch = []
+            if batch_weight([bucket]) > self.max_weight:
+                self.print_error('skipping address with too many coins', bucket.desc)
+                continue
+            batch.append(bucket)
+        if removed(batch):
+            batches.append(batch)
+        return [[coin for b in batch for coin in b.coins] for batch in batches]
+
+    def get_destination_addresses(self, count):
+        '''Returns up to count distinct unused addresses, change addresses
+        first, so that the outputs of the sweeps are not linked by their
+        address.  Deterministic wallets get new change addresses when
+        they run out; others may get fewer than count, or none.'''
+        addrs = self.wallet.calc_unused_change_addresses()
+        addrs += [addr for addr in self.wallet.get_unused_addresses() if addr not in addrs]
+        while len(addrs) < count and self.wallet.is_deterministic():
+            addrs.append(self.wallet.create_new_address(for_change=True))
+        return addrs[:count]
+
+    def make_transactions(self, fee_per_kb=None):
+        '''Plans the sweeps and returns them as unsigned transactions.
+        Returns an empty list if the fee rate is too high to consolidate.'''
+        if fee_per_kb is None:
+            fee_per_kb = self.low_fee_per_kb()
+            if not self.is_low_fee_time(fee_per_kb):
+                self.print_error('fee rate too high for consolidation', fee_per_kb)
+                return []
+        coins = self.get_coins()
+        if not coins:
+            return []
+        # the plan only needs the size of the output: an address of the
+        # wallet will do, so that no address is created for nothing
+        batches = self.plan(coins, fee_per_kb, coins[0]['address'])
+        addrs = self.get_destination_addresses(len(batches))
+        if len(addrs) < len(batches):
+            # do not reuse an address; the rest waits for the next run
+            self.print_error('only %d unused addresses for %d batches'
+                             % (len(addrs), len(batches)))
+            batches = batches[:len(addrs)]
+        fee_estimator = lambda size: self.config.estimate_fee_for_feerate(fee_per_kb, size)
+        txs = []
+        for batch, addr in zip(batches, addrs):
+            outputs = [TxOutput(TYPE_ADDRESS, addr, '!')]
+            tx = self.wallet.make_unsigned_transaction(batch, outputs, self.config,
+                                                       fixed_fee=fee_estimator)
+            txs.append(tx)
+        self.print_error('consolidating %d coins in %d transactions'
+                         % (sum(len(b) for b in batches), len(txs)))
+        return txs
@@ -25,8 +25,10 @@
 import ast
 import os
 import time
+import threading
 import traceback
 import sys
+from collections import defaultdict
 
 # from jsonrpc import JSONRPCResponseManager
 import jsonrpclib
@@ -42,6 +44,7 @@ from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
 from .plugin import run_hook
+from .scheduler import WalletScheduler
 
 
 def get_lockfile(config):
@@ -117,6 +120,10 @@ def get_rpc_credentials(config):
     return rpc_user, rpc_password
 
 
+class WalletBusy(Exception):
+    pass
+
+
 class Daemon(DaemonThread):
 
     def __init__(self, config, fd, is_gui):
@@ -128,10 +135,18 @@ class Daemon(DaemonThread):
             self.network = Network(config)
             self.network.start()
         self.fx = FxThread(config, self.network)
+        self.scheduler = None
         if self.network:
             self.network.add_jobs([self.fx])
+            # wallets loaded by the daemon run their jobs on workers
+            self.scheduler = WalletScheduler(config)
+            self.scheduler.start()
+            self.network.add_jobs([self.scheduler])
         self.gui = None
-        self.wallets = {}
+        self.lock = threading.RLock()
+        self.wallets = {}                             # note: needs self.lock
+        self.wallet_locks = defaultdict(threading.Lock)  # note: needs self.lock
+        self.rpc_timeout = config.get('rpctimeout', 60)
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
 
@@ -142,7 +157,10 @@ class Daemon(DaemonThread):
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            rpc_threads=config.get('rpcthreads', 10),
+                                            request_timeout=self.rpc_timeout,
+                                            keepalive_timeout=config.get('rpckeepalive', 5))
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -159,9 +177,36 @@ class Daemon(DaemonThread):
             server.register_function(self.run_daemon, 'daemon')
             self.cmd_runner = Commands(self.config, None, self.network)
             for cmdname in known_commands:
-                server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+                server.register_function(self.make_rpc_command(cmdname), cmdname)
             server.register_function(self.run_cmdline, 'run_cmdline')
 
+    def make_rpc_command(self, cmdname):
+        # requests are handled concurrently, so each call gets its own
+        # Commands instance, for the wallet loaded last
+        def func(*args, **kwargs):
+            wallet = self.cmd_runner.wallet
+            cmd_runner = Commands(self.config, wallet, self.network)
+            return self.run_wallet_command(wallet, getattr(cmd_runner, cmdname), *args, **kwargs)
+        return func
+
+    def get_wallet_lock(self, path):
+        with self.lock:
+            return self.wallet_locks[path]
+
+    def run_wallet_command(self, wallet, func, *args, **kwargs):
+        '''Commands on the same wallet run one at a time; commands on
+        different wallets, or without a wallet, run in parallel.'''
+        if wallet is None:
+            return func(*args, **kwargs)
+        lock = self.get_wallet_lock(wallet.storage.path)
+        if not lock.acquire(timeout=self.rpc_timeout):
+            raise WalletBusy('Wallet "%s" is busy (timed out after %d seconds)'
+                            % (os.path.basename(wallet.storage.path), self.rpc_timeout))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            lock.release()
+
     def ping(self):
         return True
 
@@ -173,18 +218,14 @@ class Daemon(DaemonThread):
             response = "Daemon already running"
         elif sub == 'load_wallet':
             path = config.get_wallet_path()
-            wallet = self.load_wallet(path, config.get('password'))
+            wallet = self.load_wallet(path, config.get('password'), use_scheduler=True)
             if wallet is not None:
                 self.cmd_runner.wallet = wallet
                 run_hook('load_wallet', wallet, None)
             response = wallet is not None
         elif sub == 'close_wallet':
             path = config.get_wallet_path()
-            if path in self.wallets:
-                self.stop_wallet(path)
-                response = True
-            else:
-                response = False
+            response = self.stop_wallet(path)
         elif sub == 'status':
             if self.network:
                 p = self.network.get_parameters()
@@ -201,9 +242,10 @@ class Daemon(DaemonThread):
                     'auto_connect': p[4],
                     'version': ELECTRUM_VERSION,
                     'wallets': {k: w.is_up_to_date()
-                                for k, w in self.wallets.items()},
+                                for k, w in list(self.wallets.items())},
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
+                    'wallet_jobs': self.scheduler.get_stats(),
                 }
             else:
                 response = "Daemon offline"
@@ -226,11 +268,26 @@ class Daemon(DaemonThread):
             response = "Error: Electrum is running in daemon mode. Please stop the daemon first."
         return response
 
-    def load_wallet(self, path, password):
-        # wizard will be launched if we return
-        if path in self.wallets:
-            wallet = self.wallets[path]
+    def load_wallet(self, path, password, *, use_scheduler=False):
+        '''Wallets loaded with use_scheduler run their jobs on the workers
+        of the scheduler; the others, such as the wallets of the GUIs,
+        on the network thread.'''
+        # self.lock is only held to access self.wallets, so that loading
+        # a wallet does not block the other requests; loads of the same
+        # wallet are serialised by its lock
+        with self.get_wallet_lock(path):
+            with self.lock:
+                wallet = self.wallets.get(path)
+            if wallet is not None:
+                return wallet
+            wallet = self._load_wallet(path, password, use_scheduler)
+            if wallet is not None:
+                with self.lock:
+                    self.wallets[path] = wallet
             return wallet
+
+    def _load_wallet(self, path, password, use_scheduler):
+        # wizard will be launched if we return
         storage = WalletStorage(path, manual_upgrades=True)
         if not storage.file_exists():
             return
@@ -238,25 +295,42 @@ class Daemon(DaemonThread):
             if not password:
                 return
             storage.decrypt(password)
+        if self.config.get('segmented_wallet_files', False):
+            storage.set_segmented(True)
         if storage.requires_split():
             return
         if storage.get_action():
             return
         wallet = Wallet(storage)
-        wallet.start_threads(self.network)
-        self.wallets[path] = wallet
+        scheduler = self.scheduler if use_scheduler else None
+        wallet.start_threads(self.network, scheduler)
+        if scheduler:
+            scheduler.add_jobs(path, [wallet.payout_queue])
         return wallet
 
     def add_wallet(self, wallet):
         path = wallet.storage.path
-        self.wallets[path] = wallet
+        with self.lock:
+            self.wallets[path] = wallet
 
     def get_wallet(self, path):
-        return self.wallets.get(path)
+        with self.lock:
+            return self.wallets.get(path)
 
     def stop_wallet(self, path):
-        wallet = self.wallets.pop(path)
-        wallet.stop_threads()
+        with self.lock:
+            wallet = self.wallets.pop(path, None)
+        if wallet is None:
+            return False
+        # let a running command finish first
+        with self.get_wallet_lock(path):
+            if wallet.scheduler:
+                wallet.scheduler.remove_jobs(path, [wallet.payout_queue])
+            wallet.stop_threads()
+        with self.lock:
+            if path not in self.wallets:
+                self.wallet_locks.pop(path, None)
+        return True
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -269,7 +343,7 @@ class Daemon(DaemonThread):
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
             path = config.get_wallet_path()
-            wallet = self.wallets.get(path)
+            wallet = self.get_wallet(path)
             if wallet is None:
                 return {'error': 'Wallet "%s" is not loaded. Use "electrum daemon load_wallet"'%os.path.basename(path) }
         else:
@@ -284,14 +358,24 @@ class Daemon(DaemonThread):
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
         cmd_runner = Commands(config, wallet, self.network)
         func = getattr(cmd_runner, cmd.name)
-        result = func(*args, **kwargs)
+        try:
+            result = self.run_wallet_command(wallet, func, *args, **kwargs)
+        except WalletBusy as e:
+            return {'error': str(e)}
         return result
 
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
-        for k, wallet in self.wallets.items():
+        if self.server:
+            self.server.server_close()
+        with self.lock:
+            wallets = list(self.wallets.values())
+        for wallet in wallets:
             wallet.stop_threads()
+        if self.scheduler:
+            self.network.remove_jobs([self.scheduler])
+            self.scheduler.stop()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
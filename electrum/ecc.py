@@ -26,7 +26,7 @@
 import base64
 import hmac
 import hashlib
-from typing import Union
+from typing import List, Sequence, Tuple, Union
 
 
 import ecdsa
@@ -37,6 +37,7 @@ from ecdsa.util import string_to_number, number_to_string
 
 from .util import bfh, bh2u, assert_bytes, print_error, to_bytes, InvalidPassword, profiler
 from .crypto import (Hash, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
+from . import ecc_fast
 from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
 
 
@@ -196,6 +197,11 @@ class ECPubkey(object):
             raise Exception('Wrong encoding')
         if recid < 0 or recid > 3:
             raise ValueError('recid is {}, but should be 0 <= recid <= 3'.format(recid))
+        if ecc_fast.has_recovery():
+            pubkey = ecc_fast.recover_pubkey(sig_string, recid, msg_hash)
+            if pubkey is None:
+                raise InvalidECPointException()
+            return ECPubkey(pubkey)
         ecdsa_verifying_key = _MyVerifyingKey.from_signature(sig_string, recid, msg_hash, curve=SECP256k1)
         ecdsa_point = ecdsa_verifying_key.pubkey.point
         return ECPubkey.from_point(ecdsa_point)
@@ -266,6 +272,11 @@ class ECPubkey(object):
         assert_bytes(sig_string)
         if len(sig_string) != 64:
             raise Exception('Wrong encoding')
+        if ecc_fast.is_using_fast_ecc() and len(msg_hash) == 32:
+            pubkey = self.get_public_key_bytes(compressed=False)
+            if not ecc_fast.verify_batch([(sig_string, msg_hash, pubkey)])[0]:
+                raise ecdsa.BadSignatureError('Signature verification failed')
+            return
         ecdsa_point = self._pubkey.point
         verifying_key = _MyVerifyingKey.from_public_point(ecdsa_point, curve=SECP256k1)
         verifying_key.verify_digest(sig_string, msg_hash, sigdecode=ecdsa.util.sigdecode_string)
@@ -325,6 +336,32 @@ def verify_message_with_address(address: str, sig65: bytes, message: bytes):
         return False
 
 
+def verify_batch(items: Sequence[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+    """Checks each (sig_string, msg_hash, pubkey_bytes)."""
+    if ecc_fast.is_using_fast_ecc():
+        return ecc_fast.verify_batch(items)
+    result = []
+    for sig_string, msg_hash, pubkey in items:
+        try:
+            ECPubkey(pubkey).verify_message_hash(sig_string, msg_hash)
+            result.append(True)
+        except Exception:
+            result.append(False)
+    return result
+
+
+def sign_transaction_batch(items: Sequence[Tuple[bytes, bytes]]) -> List[bytes]:
+    """Signs each (privkey_bytes, hashed_preimage), returns DER signatures."""
+    if ecc_fast.is_using_fast_ecc():
+        for privkey_bytes, hashed_preimage in items:
+            assert_bytes(privkey_bytes)
+            if len(privkey_bytes) != 32 or not is_secret_within_curve_range(privkey_bytes):
+                raise InvalidECPointException('Invalid secret scalar (not within curve order)')
+        sigs = ecc_fast.sign_batch([(h, k) for k, h in items])
+        return [der_sig_from_sig_string(sig) for sig in sigs]
+    return [ECPrivkey(k).sign_transaction(h) for k, h in items]
+
+
 def is_secret_within_curve_range(secret: Union[int, bytes]) -> bool:
     if isinstance(secret, bytes):
         secret = string_to_number(secret)
@@ -367,11 +404,18 @@ class ECPrivkey(ECPubkey):
         privkey_32bytes = number_to_string(scalar, CURVE_ORDER)
         return privkey_32bytes
 
+    def get_secret_bytes(self) -> bytes:
+        return number_to_string(self.secret_scalar, CURVE_ORDER)
+
     def sign(self, data: bytes, sigencode=None, sigdecode=None) -> bytes:
         if sigencode is None:
             sigencode = sig_string_from_r_and_s
         if sigdecode is None:
             sigdecode = get_r_and_s_from_sig_string
+        if ecc_fast.is_using_fast_ecc() and len(data) == 32:
+            sig_string = ecc_fast.sign_batch([(data, self.get_secret_bytes())])[0]
+            r, s = get_r_and_s_from_sig_string(sig_string)
+            return sigencode(r, s, CURVE_ORDER)
         private_key = _MySigningKey.from_secret_exponent(self.secret_scalar, curve=SECP256k1)
         sig = private_key.sign_digest_deterministic(data, hashfunc=hashlib.sha256, sigencode=sigencode)
         public_key = private_key.get_verifying_key()
@@ -398,6 +442,9 @@ class ECPrivkey(ECPubkey):
 
         message = to_bytes(message, 'utf8')
         msg_hash = Hash(msg_magic(message))
+        if ecc_fast.has_recovery():
+            sig_string, recid = ecc_fast.sign_recoverable(msg_hash, self.get_secret_bytes())
+            return construct_sig65(sig_string, recid, is_compressed)
         sig_string = self.sign(msg_hash,
                                sigencode=sig_string_from_r_and_s,
                                sigdecode=get_r_and_s_from_sig_string)
@@ -3,8 +3,10 @@
 
 import os
 import sys
+import threading
 import traceback
 import ctypes
+from typing import List, Optional, Sequence, Tuple
 from ctypes.util import find_library
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer, CFUNCTYPE, POINTER
@@ -81,6 +83,24 @@ def load_library():
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        # the recovery module is optional
+        try:
+            secp256k1.secp256k1_ecdsa_sign_recoverable.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p, c_void_p, c_void_p]
+            secp256k1.secp256k1_ecdsa_sign_recoverable.restype = c_int
+
+            secp256k1.secp256k1_ecdsa_recoverable_signature_serialize_compact.argtypes = [c_void_p, c_char_p, POINTER(c_int), c_char_p]
+            secp256k1.secp256k1_ecdsa_recoverable_signature_serialize_compact.restype = c_int
+
+            secp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
+            secp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = c_int
+
+            secp256k1.secp256k1_ecdsa_recover.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
+            secp256k1.secp256k1_ecdsa_recover.restype = c_int
+
+            secp256k1.has_recovery = True
+        except AttributeError:
+            secp256k1.has_recovery = False
+
         secp256k1.ctx = secp256k1.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
         r = secp256k1.secp256k1_context_randomize(secp256k1.ctx, os.urandom(32))
         if r:
@@ -214,6 +234,110 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def has_recovery():
+    return is_using_fast_ecc() and _libsecp256k1.has_recovery
+
+
+class _Buffers:
+    '''ctypes buffers that are reused across calls, instead of being
+    allocated for every signature.  Access with lock.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sig = create_string_buffer(64)
+        self.recoverable_sig = create_string_buffer(65)
+        self.compact = create_string_buffer(64)
+        self.pubkey = create_string_buffer(64)
+        self.serialized = create_string_buffer(65)
+        self.size = c_size_t(65)
+        self.recid = c_int()
+
+
+_buffers = _Buffers()
+
+
+def _serialize_pubkey() -> bytes:
+    # uncompressed, as that is what python-ecdsa parses fastest
+    b = _buffers
+    b.size.value = 65
+    _libsecp256k1.secp256k1_ec_pubkey_serialize(
+        _libsecp256k1.ctx, b.serialized, byref(b.size), b.pubkey, SECP256K1_EC_UNCOMPRESSED)
+    return b.serialized.raw[:b.size.value]
+
+
+def _verify(sig_string: bytes, msg_hash: bytes, pubkey: bytes) -> bool:
+    b = _buffers
+    if len(sig_string) != 64 or len(msg_hash) != 32:
+        return False
+    if not _libsecp256k1.secp256k1_ecdsa_signature_parse_compact(_libsecp256k1.ctx, b.sig, sig_string):
+        return False
+    _libsecp256k1.secp256k1_ecdsa_signature_normalize(_libsecp256k1.ctx, b.sig, b.sig)
+    if not _libsecp256k1.secp256k1_ec_pubkey_parse(_libsecp256k1.ctx, b.pubkey, pubkey, len(pubkey)):
+        return False
+    return 1 == _libsecp256k1.secp256k1_ecdsa_verify(_libsecp256k1.ctx, b.sig, msg_hash, b.pubkey)
+
+
+def _check_own_signature(sig_string: bytes, msg_hash: bytes, secret: bytes) -> None:
+    b = _buffers
+    if not _libsecp256k1.secp256k1_ec_pubkey_create(_libsecp256k1.ctx, b.pubkey, secret):
+        raise Exception('invalid secret')
+    if not _verify(sig_string, msg_hash, _serialize_pubkey()):
+        raise Exception('Sanity check verifying our own signature failed.')
+
+
+def sign_batch(items: Sequence[Tuple[bytes, bytes]]) -> List[bytes]:
+    '''Signs each 32 byte hash of (msg_hash, secret) with its secret.
+    Returns compact signatures, with low S.  Every signature is
+    checked against the public key of its secret.'''
+    b = _buffers
+    result = []
+    with b.lock:
+        for msg_hash, secret in items:
+            if not _libsecp256k1.secp256k1_ecdsa_sign(
+                    _libsecp256k1.ctx, b.sig, msg_hash, secret, None, None):
+                raise Exception('signing failed')
+            _libsecp256k1.secp256k1_ecdsa_signature_serialize_compact(_libsecp256k1.ctx, b.compact, b.sig)
+            sig_string = b.compact.raw
+            _check_own_signature(sig_string, msg_hash, secret)
+            result.append(sig_string)
+    return result
+
+
+def verify_batch(items: Sequence[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+    '''Checks each (sig_string, msg_hash, pubkey), where sig_string is
+    a compact signature and pubkey a serialized public key.'''
+    with _buffers.lock:
+        return [_verify(sig_string, msg_hash, pubkey) for sig_string, msg_hash, pubkey in items]
+
+
+def sign_recoverable(msg_hash: bytes, secret: bytes) -> Tuple[bytes, int]:
+    '''Returns the compact signature and its recovery id.'''
+    b = _buffers
+    with b.lock:
+        if not _libsecp256k1.secp256k1_ecdsa_sign_recoverable(
+                _libsecp256k1.ctx, b.recoverable_sig, msg_hash, secret, None, None):
+            raise Exception('signing failed')
+        _libsecp256k1.secp256k1_ecdsa_recoverable_signature_serialize_compact(
+            _libsecp256k1.ctx, b.compact, byref(b.recid), b.recoverable_sig)
+        sig_string, recid = b.compact.raw, b.recid.value
+        _check_own_signature(sig_string, msg_hash, secret)
+    return sig_string, recid
+
+
+def recover_pubkey(sig_string: bytes, recid: int, msg_hash: bytes) -> Optional[bytes]:
+    '''Returns the uncompressed public key that made the signature,
+    or None.'''
+    b = _buffers
+    with b.lock:
+        if not _libsecp256k1.secp256k1_ecdsa_recoverable_signature_parse_compact(
+                _libsecp256k1.ctx, b.recoverable_sig, sig_string, recid):
+            return None
+        if not _libsecp256k1.secp256k1_ecdsa_recover(
+                _libsecp256k1.ctx, b.pubkey, b.recoverable_sig, msg_hash):
+            return None
+        return _serialize_pubkey()
+
+
 try:
     _libsecp256k1 = load_library()
 except:
@@ -32,11 +32,12 @@ from electrum.bitcoin import is_address
 from .util import *
 
 
-class AddressList(MyTreeWidget):
+class AddressList(MyTreeView):
     filter_columns = [0, 1, 2, 3]  # Type, Address, Label, Balance
 
     def __init__(self, parent=None):
-        MyTreeWidget.__init__(self, parent, self.create_menu, [], 2)
+        MyTreeView.__init__(self, parent, self.create_menu, [], 2)
+        self.monospace_font = QFont(MONOSPACE_FONT)
         self.refresh_headers()
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setSortingEnabled(True)
@@ -84,88 +85,109 @@ class AddressList(MyTreeWidget):
 
     def on_update(self):
         self.wallet = self.parent.wallet
-        item = self.currentItem()
-        current_address = item.data(0, Qt.UserRole) if item else None
         if self.show_change == 1:
             addr_list = self.wallet.get_receiving_addresses()
         elif self.show_change == 2:
             addr_list = self.wallet.get_change_addresses()
         else:
             addr_list = self.wallet.get_addresses()
-        self.clear()
+        if self.show_used:
+            addr_list = [address for address in addr_list if self.is_shown(address)]
+        # rows are only computed when they are shown
+        self.set_keys(addr_list)
+
+    def is_shown(self, address):
+        c, u, x = self.wallet.get_addr_balance(address)
+        balance = c + u + x
+        is_used_and_empty = self.wallet.is_used(address) and balance == 0
+        if self.show_used == 1 and (balance or is_used_and_empty):
+            return False
+        if self.show_used == 2 and balance == 0:
+            return False
+        if self.show_used == 3 and not is_used_and_empty:
+            return False
+        return True
+
+    def get_row(self, address):
         fx = self.parent.fx
-        for address in addr_list:
-            num = self.wallet.get_address_history_len(address)
-            label = self.wallet.labels.get(address, '')
-            c, u, x = self.wallet.get_addr_balance(address)
-            balance = c + u + x
-            is_used_and_empty = self.wallet.is_used(address) and balance == 0
-            if self.show_used == 1 and (balance or is_used_and_empty):
-                continue
-            if self.show_used == 2 and balance == 0:
-                continue
-            if self.show_used == 3 and not is_used_and_empty:
-                continue
-            balance_text = self.parent.format_amount(balance, whitespaces=True)
-            # create item
-            if fx and fx.get_fiat_address_config():
-                rate = fx.exchange_rate()
-                fiat_balance = fx.value_str(balance, rate)
-                address_item = SortableTreeWidgetItem(['', address, label, balance_text, fiat_balance, "%d"%num])
-            else:
-                address_item = SortableTreeWidgetItem(['', address, label, balance_text, "%d"%num])
-            # align text and set fonts
-            for i in range(address_item.columnCount()):
-                address_item.setTextAlignment(i, Qt.AlignVCenter)
-                if i not in (0, 2):
-                    address_item.setFont(i, QFont(MONOSPACE_FONT))
-            if fx and fx.get_fiat_address_config():
-                address_item.setTextAlignment(4, Qt.AlignRight | Qt.AlignVCenter)
-            # setup column 0
-            if self.wallet.is_change(address):
-                address_item.setText(0, _('change'))
-                address_item.setBackground(0, ColorScheme.YELLOW.as_color(True))
-            else:
-                address_item.setText(0, _('receiving'))
-                address_item.setBackground(0, ColorScheme.GREEN.as_color(True))
-            address_item.setData(0, Qt.UserRole, address)  # column 0; independent from address column
-            # setup column 1
-            if self.wallet.is_frozen(address):
-                address_item.setBackground(1, ColorScheme.BLUE.as_color(True))
-            if self.wallet.is_beyond_limit(address):
-                address_item.setBackground(1, ColorScheme.RED.as_color(True))
-            # add item
-            self.addChild(address_item)
-            if address == current_address:
-                self.setCurrentItem(address_item)
+        num = self.wallet.get_address_history_len(address)
+        label = self.wallet.labels.get(address, '')
+        c, u, x = self.wallet.get_addr_balance(address)
+        balance = c + u + x
+        balance_text = self.parent.format_amount(balance, whitespaces=True)
+        if fx and fx.get_fiat_address_config():
+            rate = fx.exchange_rate()
+            fiat_balance = fx.value_str(balance, rate)
+            entry = ['', address, label, balance_text, fiat_balance, "%d"%num]
+        else:
+            entry = ['', address, label, balance_text, "%d"%num]
+        # align text and set fonts
+        row = [{Qt.DisplayRole: text, Qt.TextAlignmentRole: int(Qt.AlignVCenter)} for text in entry]
+        for i, cell in enumerate(row):
+            if i not in (0, 2):
+                cell[Qt.FontRole] = self.monospace_font
+        row[3][LazyListModel.SortRole] = balance
+        row[-1][LazyListModel.SortRole] = num
+        if fx and fx.get_fiat_address_config():
+            row[4][Qt.TextAlignmentRole] = int(Qt.AlignRight | Qt.AlignVCenter)
+            row[4][LazyListModel.SortRole] = balance
+        # setup column 0
+        if self.wallet.is_change(address):
+            row[0][Qt.DisplayRole] = _('change')
+            row[0][Qt.BackgroundRole] = ColorScheme.YELLOW.as_color(True)
+        else:
+            row[0][Qt.DisplayRole] = _('receiving')
+            row[0][Qt.BackgroundRole] = ColorScheme.GREEN.as_color(True)
+        # setup column 1
+        if self.wallet.is_frozen(address):
+            row[1][Qt.BackgroundRole] = ColorScheme.BLUE.as_color(True)
+        if self.wallet.is_beyond_limit(address):
+            row[1][Qt.BackgroundRole] = ColorScheme.RED.as_color(True)
+        return row
+
+    def sort_key(self, address, column):
+        # the type, address and label columns are sorted without computing the rows
+        if column == 0:
+            return self.wallet.is_change(address)
+        elif column == 1:
+            return address
+        elif column == 2:
+            return self.wallet.labels.get(address, '')
+        return MyTreeView.sort_key(self, address, column)
+
+    def update_addresses(self, addresses):
+        '''Updates the rows of addresses whose history changed.'''
+        if self.show_used:
+            # the filter may now hide or show them
+            self.update()
+        else:
+            self.refresh_keys(addresses)
 
     def create_menu(self, position):
         from electrum.wallet import Multisig_Wallet
         is_multisig = isinstance(self.wallet, Multisig_Wallet)
         can_delete = self.wallet.can_delete_address()
-        selected = self.selectedItems()
-        multi_select = len(selected) > 1
-        addrs = [item.text(1) for item in selected]
+        addrs = self.selected_keys()
+        multi_select = len(addrs) > 1
         if not addrs:
             return
         if not multi_select:
-            item = self.itemAt(position)
-            col = self.currentColumn()
-            if not item:
+            index = self.indexAt(position)
+            col = self.currentIndex().column()
+            if not index.isValid():
                 return
             addr = addrs[0]
             if not is_address(addr):
-                item.setExpanded(not item.isExpanded())
                 return
 
         menu = QMenu()
         if not multi_select:
-            column_title = self.headerItem().text(col)
-            copy_text = item.text(col)
+            column_title = self.header_text(col)
+            copy_text = self.text(addr, col)
             menu.addAction(_("Copy {}").format(column_title), lambda: self.parent.app.clipboard().setText(copy_text))
             menu.addAction(_('Details'), lambda: self.parent.show_address(addr))
             if col in self.editable_columns:
-                menu.addAction(_("Edit {}").format(column_title), lambda: self.editItem(item, col))
+                menu.addAction(_("Edit {}").format(column_title), lambda: self.edit_cell(addr, col))
             menu.addAction(_("Request payment"), lambda: self.parent.receive_at(addr))
             if self.wallet.can_export():
                 menu.addAction(_("Private key"), lambda: self.parent.show_private_key(addr))
@@ -189,7 +211,3 @@ class AddressList(MyTreeWidget):
 
         run_hook('receive_menu', menu, addrs, self.wallet)
         menu.exec_(self.viewport().mapToGlobal(position))
-
-    def on_permit_edit(self, item, column):
-        # labels for headings, e.g. "receiving" or "used" should not be editable
-        return item.childCount() == 0
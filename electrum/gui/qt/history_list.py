@@ -26,10 +26,10 @@
 import webbrowser
 import datetime
 
-from electrum.address_synchronizer import TX_HEIGHT_LOCAL
+from electrum.address_synchronizer import TX_HEIGHT_LOCAL, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_UNCONFIRMED
 from .util import *
 from electrum.i18n import _
-from electrum.util import block_explorer_URL, profiler, print_error, TxMinedStatus
+from electrum.util import block_explorer_URL, profiler, print_error, TxMinedStatus, timestamp_to_datetime
 
 try:
     from electrum.plot import plot_history, NothingToPlotException
@@ -52,14 +52,16 @@ TX_ICONS = [
 ]
 
 
-class HistoryList(MyTreeWidget, AcceptFileDragDrop):
+class HistoryList(MyTreeView, AcceptFileDragDrop):
     filter_columns = [2, 3, 4]  # Date, Description, Amount
 
     def __init__(self, parent=None):
-        MyTreeWidget.__init__(self, parent, self.create_menu, [], 3)
+        MyTreeView.__init__(self, parent, self.create_menu, [], 3)
         AcceptFileDragDrop.__init__(self, ".txn")
+        self.blue_brush = QBrush(QColor("#1E1EFF"))
+        self.red_brush = QBrush(QColor("#BC1E1E"))
+        self.monospace_font = QFont(MONOSPACE_FONT)
         self.refresh_headers()
-        self.setColumnHidden(1, True)
         self.setSortingEnabled(True)
         self.sortByColumn(0, Qt.AscendingOrder)
         self.start_timestamp = None
@@ -67,6 +69,10 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         self.years = []
         self.create_toolbar_buttons()
         self.wallet = None
+        self.transactions = []
+        self.summary = {}
+        self.tx_items = {}
+        self.history_query = None
 
     def format_date(self, d):
         return str(datetime.date(d.year, d.month, d.day)) if d else _('None')
@@ -83,6 +89,7 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         else:
             self.editable_columns -= {6}
         self.update_headers(headers)
+        self.setColumnHidden(1, True)
 
     def get_domain(self):
         '''Replaced in address_dialog.py'''
@@ -212,11 +219,23 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         except NothingToPlotException as e:
             self.parent.show_message(str(e))
 
-    @profiler
     def on_update(self):
-        self.wallet = self.parent.wallet
+        self.wallet = wallet = self.parent.wallet
+        fx = self.parent.fx
+        domain = self.get_domain()
+        start_timestamp, end_timestamp = self.start_timestamp, self.end_timestamp
+        # the history of large wallets takes a while to compute
+        if self.history_query:
+            self.history_query.cancel()
+        self.history_query = self.parent.queries.submit(
+            lambda progress: wallet.get_full_history(domain=domain, from_timestamp=start_timestamp,
+                                                     to_timestamp=end_timestamp, fx=fx, progress=progress),
+            on_success=self.on_history)
+
+    @profiler
+    def on_history(self, r):
+        self.history_query = None
         fx = self.parent.fx
-        r = self.wallet.get_full_history(domain=self.get_domain(), from_timestamp=self.start_timestamp, to_timestamp=self.end_timestamp, fx=fx)
         self.transactions = r['transactions']
         self.summary = r['summary']
         if not self.years and self.transactions:
@@ -225,117 +244,146 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
             end_date = self.transactions[-1].get('date') or date.today()
             self.years = [str(i) for i in range(start_date.year, end_date.year + 1)]
             self.period_combo.insertItems(1, self.years)
-        item = self.currentItem()
-        current_tx = item.data(0, Qt.UserRole) if item else None
-        self.clear()
         if fx: fx.history_used_spot = False
-        blue_brush = QBrush(QColor("#1E1EFF"))
-        red_brush = QBrush(QColor("#BC1E1E"))
-        monospace_font = QFont(MONOSPACE_FONT)
-        for tx_item in self.transactions:
-            tx_hash = tx_item['txid']
-            height = tx_item['height']
+        self.tx_items = {tx_item['txid']: tx_item for tx_item in self.transactions}
+        # rows are only computed when they are shown
+        self.set_keys(reversed([tx_item['txid'] for tx_item in self.transactions]))
+
+    def get_row(self, tx_hash):
+        tx_item = self.tx_items[tx_hash]
+        fx = self.parent.fx
+        conf = tx_item['confirmations']
+        value = tx_item['value'].value
+        balance = tx_item['balance'].value
+        tx_mined_status = TxMinedStatus(tx_item['height'], conf, tx_item['timestamp'], None)
+        status, status_str = self.wallet.get_tx_status(tx_hash, tx_mined_status)
+        has_invoice = self.wallet.invoices.paid.get(tx_hash)
+        v_str = self.parent.format_amount(value, is_diff=True, whitespaces=True)
+        balance_str = self.parent.format_amount(balance, whitespaces=True)
+        entry = ['', tx_hash, status_str, tx_item['label'], v_str, balance_str]
+        fiat_value = None
+        if value is not None and fx and fx.show_history():
+            fiat_value = tx_item['fiat_value'].value
+            value_str = fx.format_fiat(fiat_value)
+            entry.append(value_str)
+            # fixme: should use is_mine
+            if value < 0:
+                entry.append(fx.format_fiat(tx_item['acquisition_price'].value))
+                entry.append(fx.format_fiat(tx_item['capital_gain'].value))
+        row = [{Qt.DisplayRole: text} for text in entry]
+        row[0][Qt.DecorationRole] = self.icon_cache.get(":icons/" + TX_ICONS[status])
+        row[0][Qt.ToolTipRole] = str(conf) + " confirmation" + ("s" if conf != 1 else "")
+        if has_invoice:
+            row[3][Qt.DecorationRole] = self.icon_cache.get(":icons/seal")
+        for i, cell in enumerate(row):
+            if i>3:
+                cell[Qt.TextAlignmentRole] = int(Qt.AlignRight | Qt.AlignVCenter)
+            if i!=2:
+                cell[Qt.FontRole] = self.monospace_font
+        if value and value < 0:
+            row[3][Qt.ForegroundRole] = self.red_brush
+            row[4][Qt.ForegroundRole] = self.red_brush
+        if fiat_value and not tx_item['fiat_default']:
+            row[6][Qt.ForegroundRole] = self.blue_brush
+        return row
+
+    def sort_key(self, tx_hash, column):
+        # sorting must not compute the rows
+        tx_item = self.tx_items[tx_hash]
+        if column == 0:
+            # same order as the status of wallet.get_tx_status
             conf = tx_item['confirmations']
+            if conf > 0:
+                return 3 + min(conf, 6), conf
+            status = {TX_HEIGHT_UNCONFIRMED: 0, TX_HEIGHT_UNCONF_PARENT: 1, TX_HEIGHT_LOCAL: 3}
+            return status.get(tx_item['height'], 2), conf
+        elif column == 2:
             timestamp = tx_item['timestamp']
-            value = tx_item['value'].value
-            balance = tx_item['balance'].value
-            label = tx_item['label']
-            tx_mined_status = TxMinedStatus(height, conf, timestamp, None)
-            status, status_str = self.wallet.get_tx_status(tx_hash, tx_mined_status)
-            has_invoice = self.wallet.invoices.paid.get(tx_hash)
-            icon = self.icon_cache.get(":icons/" + TX_ICONS[status])
-            v_str = self.parent.format_amount(value, is_diff=True, whitespaces=True)
-            balance_str = self.parent.format_amount(balance, whitespaces=True)
-            entry = ['', tx_hash, status_str, label, v_str, balance_str]
-            fiat_value = None
-            if value is not None and fx and fx.show_history():
-                fiat_value = tx_item['fiat_value'].value
-                value_str = fx.format_fiat(fiat_value)
-                entry.append(value_str)
-                # fixme: should use is_mine
-                if value < 0:
-                    entry.append(fx.format_fiat(tx_item['acquisition_price'].value))
-                    entry.append(fx.format_fiat(tx_item['capital_gain'].value))
-            item = SortableTreeWidgetItem(entry)
-            item.setIcon(0, icon)
-            item.setToolTip(0, str(conf) + " confirmation" + ("s" if conf != 1 else ""))
-            item.setData(0, SortableTreeWidgetItem.DataRole, (status, conf))
-            if has_invoice:
-                item.setIcon(3, self.icon_cache.get(":icons/seal"))
-            for i in range(len(entry)):
-                if i>3:
-                    item.setTextAlignment(i, Qt.AlignRight | Qt.AlignVCenter)
-                if i!=2:
-                    item.setFont(i, monospace_font)
-            if value and value < 0:
-                item.setForeground(3, red_brush)
-                item.setForeground(4, red_brush)
-            if fiat_value and not tx_item['fiat_default']:
-                item.setForeground(6, blue_brush)
-            if tx_hash:
-                item.setData(0, Qt.UserRole, tx_hash)
-            self.insertTopLevelItem(0, item)
-            if current_tx == tx_hash:
-                self.setCurrentItem(item)
-
-    def on_edited(self, item, column, prior):
+            return timestamp is None, timestamp or 0
+        elif column == 3:
+            return tx_item['label']
+        elif column == 4:
+            return tx_item['value'].value
+        elif column == 5:
+            return tx_item['balance'].value or 0
+        return MyTreeView.sort_key(self, tx_hash, column)
+
+    def on_edited(self, tx_hash, column, text, prior):
         '''Called only when the text actually changes'''
-        key = item.data(0, Qt.UserRole)
-        text = item.text(column)
         # fixme
         if column == 3:
-            self.parent.wallet.set_label(key, text)
+            self.parent.wallet.set_label(tx_hash, text)
             self.update_labels()
             self.parent.update_completions()
         elif column == 6:
-            self.parent.wallet.set_fiat_value(key, self.parent.fx.ccy, text)
+            self.parent.wallet.set_fiat_value(tx_hash, self.parent.fx.ccy, text)
             self.on_update()
 
-    def on_doubleclick(self, item, column):
-        if self.permit_edit(item, column):
-            super(HistoryList, self).on_doubleclick(item, column)
+    def on_doubleclick(self, tx_hash, column):
+        if self.permit_edit(tx_hash, column):
+            super(HistoryList, self).on_doubleclick(tx_hash, column)
         else:
-            tx_hash = item.data(0, Qt.UserRole)
             tx = self.wallet.transactions.get(tx_hash)
             self.parent.show_transaction(tx)
 
     def update_labels(self):
-        root = self.invisibleRootItem()
-        child_count = root.childCount()
-        for i in range(child_count):
-            item = root.child(i)
-            txid = item.data(0, Qt.UserRole)
-            label = self.wallet.get_label(txid)
-            item.setText(3, label)
+        for tx_hash, tx_item in self.tx_items.items():
+            tx_item['label'] = self.wallet.get_label(tx_hash)
+        self.list_model.invalidate()
+
+    def set_tx_mined_status(self, tx_item, tx_mined_status):
+        tx_item['height'] = tx_mined_status.height
+        tx_item['confirmations'] = tx_mined_status.conf
+        tx_item['timestamp'] = tx_mined_status.timestamp
+        tx_item['date'] = timestamp_to_datetime(tx_mined_status.timestamp)
 
     def update_item(self, tx_hash, tx_mined_status):
         if self.wallet is None:
             return
-        conf = tx_mined_status.conf
-        status, status_str = self.wallet.get_tx_status(tx_hash, tx_mined_status)
-        icon = self.icon_cache.get(":icons/" +  TX_ICONS[status])
-        items = self.findItems(tx_hash, Qt.UserRole|Qt.MatchContains|Qt.MatchRecursive, column=1)
-        if items:
-            item = items[0]
-            item.setIcon(0, icon)
-            item.setData(0, SortableTreeWidgetItem.DataRole, (status, conf))
-            item.setText(2, status_str)
+        tx_item = self.tx_items.get(tx_hash)
+        if tx_item is None:
+            return
+        self.set_tx_mined_status(tx_item, tx_mined_status)
+        self.list_model.refresh(tx_hash)
 
-    def create_menu(self, position):
-        self.selectedIndexes()
-        item = self.currentItem()
-        if not item:
+    def refresh_txids(self, txids, new_block=False):
+        '''Applies the changes of the wallet.  Rows of transactions that
+        only got confirmations are updated in place; the history is only
+        computed again if transactions were added, removed or moved.'''
+        if self.wallet is None:
             return
-        column = self.currentColumn()
-        tx_hash = item.data(0, Qt.UserRole)
+        for tx_hash in txids:
+            tx_item = self.tx_items.get(tx_hash)
+            if tx_item is None:
+                self.update()
+                return
+            tx_mined_status = self.wallet.get_tx_height(tx_hash)
+            if (tx_mined_status.height != tx_item['height']
+                    or self.wallet.get_tx_value(tx_hash) != tx_item['value'].value):
+                # the order of the history, and the balances, changed
+                self.update()
+                return
+        for tx_hash in txids:
+            self.update_item(tx_hash, self.wallet.get_tx_height(tx_hash))
+        if new_block:
+            local_height = self.wallet.get_local_height()
+            for tx_item in self.transactions:
+                if tx_item['confirmations'] > 0:
+                    tx_item['confirmations'] = max(local_height - tx_item['height'] + 1, 0)
+            self.list_model.invalidate()
+
+    def create_menu(self, position):
+        index = self.currentIndex()
+        tx_hash = self.key_at(index)
         if not tx_hash:
             return
+        column = index.column()
         if column is 0:
             column_title = "ID"
             column_data = tx_hash
         else:
-            column_title = self.headerItem().text(column)
-            column_data = item.text(column)
+            column_title = self.header_text(column)
+            column_data = self.text(tx_hash, column)
         tx_URL = block_explorer_URL(self.config, 'tx', tx_hash)
         height = self.wallet.get_tx_height(tx_hash).height
         tx = self.wallet.transactions.get(tx_hash)
@@ -347,8 +395,8 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
             menu.addAction(_("Remove"), lambda: self.remove_local_tx(tx_hash))
         menu.addAction(_("Copy {}").format(column_title), lambda: self.parent.app.clipboard().setText(column_data))
         for c in self.editable_columns:
-            menu.addAction(_("Edit {}").format(self.headerItem().text(c)),
-                           lambda bound_c=c: self.editItem(item, bound_c))
+            menu.addAction(_("Edit {}").format(self.header_text(c)),
+                           lambda bound_c=c: self.edit_cell(tx_hash, bound_c))
         menu.addAction(_("Details"), lambda: self.parent.show_transaction(tx))
         if is_unconfirmed and tx:
             # note: the current implementation of RBF *needs* the old tx fee
@@ -408,29 +456,33 @@ class HistoryList(MyTreeWidget, AcceptFileDragDrop):
         filename = filename_e.text()
         if not filename:
             return
-        try:
-            self.do_export_history(self.wallet, filename, csv_button.isChecked())
-        except (IOError, os.error) as reason:
+        is_csv = csv_button.isChecked()
+        # the file is written in the background, as the history is computed
+        progress = QProgressDialog(_('Exporting history...'), _('Cancel'), 0, len(self.transactions), self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+        def on_success(result):
+            progress.reset()
+            self.parent.show_message(_("Your wallet history has been successfully exported."))
+        def on_error(exc_info):
+            progress.reset()
             export_error_label = _("Electrum was unable to produce a transaction export.")
-            self.parent.show_critical(export_error_label + "\n" + str(reason), title=_("Unable to export history"))
-            return
-        self.parent.show_message(_("Your wallet history has been successfully exported."))
-
-    def do_export_history(self, wallet, fileName, is_csv):
-        history = self.transactions
-        lines = []
-        for item in history:
-            if is_csv:
-                lines.append([item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['date']])
-            else:
-                lines.append(item)
-        with open(fileName, "w+", encoding='utf-8') as f:
-            if is_csv:
-                import csv
-                transaction = csv.writer(f, lineterminator='\n')
-                transaction.writerow(["transaction_hash","label", "confirmations", "value", "timestamp"])
-                for line in lines:
-                    transaction.writerow(line)
-            else:
-                from electrum.util import json_encode
-                f.write(json_encode(history))
+            self.parent.show_critical(export_error_label + "\n" + str(exc_info[1]), title=_("Unable to export history"))
+        def on_progress(n, total):
+            progress.setMaximum(total)
+            progress.setValue(n)
+        query = self.parent.queries.submit(
+            lambda p: self.do_export_history(self.wallet, filename, is_csv, p),
+            on_success=on_success, on_error=on_error, on_progress=on_progress)
+        progress.canceled.connect(query.cancel)
+
+    def do_export_history(self, wallet, fileName, is_csv, progress=None):
+        try:
+            with open(fileName, "w+", encoding='utf-8') as f:
+                wallet.export_history(f, is_csv, domain=self.get_domain(),
+                                      from_timestamp=self.start_timestamp,
+                                      to_timestamp=self.end_timestamp,
+                                      fx=self.parent.fx, progress=progress)
+        except QueryCancelled:
+            os.unlink(fileName)
+            raise
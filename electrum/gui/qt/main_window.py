@@ -30,6 +30,7 @@ import webbrowser
 import csv
 from decimal import Decimal
 import base64
+from collections import defaultdict
 from functools import partial
 
 from PyQt5.QtGui import *
@@ -50,7 +51,7 @@ from electrum.util import (format_time, format_satoshis, format_fee_satoshis,
                            export_meta, import_meta, bh2u, bfh, InvalidPassword,
                            base_units, base_units_list, base_unit_name_to_decimal_point,
                            decimal_point_to_base_unit_name, quantize_feerate,
-                           UnknownBaseUnit, DECIMAL_POINT_DEFAULT)
+                           UnknownBaseUnit, DECIMAL_POINT_DEFAULT, Debouncer)
 from electrum.transaction import Transaction, TxOutput
 from electrum.address_synchronizer import AddTransactionException
 from electrum.wallet import Multisig_Wallet, CannotBumpFee
@@ -98,6 +99,14 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
     computing_privkeys_signal = pyqtSignal()
     show_privkeys_signal = pyqtSignal()
 
+    # network updates are applied once they stopped for REFRESH_QUIET
+    # seconds, or REFRESH_MAX_DELAY seconds after the first one, so that
+    # catching up with many blocks does not refresh the tabs each time
+    REFRESH_QUIET = 0.5
+    REFRESH_MAX_DELAY = 3
+    # above this many changed txids and addresses, tabs are rebuilt
+    MAX_REFRESH_CHANGES = 1000
+
     def __init__(self, gui_object, wallet):
         QMainWindow.__init__(self)
 
@@ -123,9 +132,14 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         self.tx_notifications = []
         self.tl_windows = []
         self.tx_external_keypairs = {}
+        self.queries = QueryService(self.on_error)
 
         self.create_status_bar()
         self.need_update = threading.Event()
+        self.refresh_requests = Debouncer(self.REFRESH_QUIET, self.REFRESH_MAX_DELAY)
+        # tab name -> [number of refreshes, total time, max time]
+        self.refresh_stats = defaultdict(lambda: [0, 0., 0.])
+        self.local_height = None
 
         self.decimal_point = config.get('decimal_point', DECIMAL_POINT_DEFAULT)
         try:
@@ -295,7 +309,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
 
     def on_network(self, event, *args):
         if event == 'updated':
-            self.need_update.set()
+            self.refresh_requests.request()
             self.gui_object.network_updated_signal_obj.network_updated_signal \
                 .emit(event, args)
         elif event == 'new_transaction':
@@ -644,6 +658,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if self.need_update.is_set():
             self.need_update.clear()
             self.update_wallet()
+        elif self.refresh_requests.ready():
+            self.refresh_wallet()
         # resolve aliases
         # FIXME this is a blocking network call that has a timeout of 5 sec
         self.payto_e.resolve()
@@ -761,13 +777,49 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if self.wallet.up_to_date or not self.network or not self.network.is_connected():
             self.update_tabs()
 
+    def refresh_wallet(self):
+        '''Applies the changes of the wallet to the tabs that show them.'''
+        self.update_status()
+        if not (self.wallet.up_to_date or not self.network or not self.network.is_connected()):
+            # changes are applied once the wallet is synchronized
+            return
+        txids, addresses = self.wallet.pop_changes()
+        if len(txids) + len(addresses) > self.MAX_REFRESH_CHANGES:
+            self.update_tabs()
+            return
+        local_height = self.wallet.get_local_height()
+        new_block = local_height != self.local_height
+        self.local_height = local_height
+        if txids or new_block:
+            self.timed_update('history', self.history_list.refresh_txids, txids, new_block)
+        if addresses:
+            self.timed_update('addresses', self.address_list.update_addresses, addresses)
+            self.timed_update('coins', self.utxo_list.update)
+            self.timed_update('requests', self.request_list.update)
+        if txids:
+            self.timed_update('invoices', self.invoice_list.update)
+
+    def timed_update(self, name, f, *args):
+        t0 = time.time()
+        f(*args)
+        dt = time.time() - t0
+        stats = self.refresh_stats[name]
+        stats[0] += 1
+        stats[1] += dt
+        stats[2] = max(stats[2], dt)
+        if dt > 0.1:
+            self.print_error("refreshing %s took %.3f s" % (name, dt))
+
     def update_tabs(self):
-        self.history_list.update()
-        self.request_list.update()
-        self.address_list.update()
-        self.utxo_list.update()
-        self.contact_list.update()
-        self.invoice_list.update()
+        # everything is refreshed
+        self.wallet.pop_changes()
+        self.local_height = self.wallet.get_local_height()
+        self.timed_update('history', self.history_list.update)
+        self.timed_update('requests', self.request_list.update)
+        self.timed_update('addresses', self.address_list.update)
+        self.timed_update('coins', self.utxo_list.update)
+        self.timed_update('contacts', self.contact_list.update)
+        self.timed_update('invoices', self.invoice_list.update)
         self.update_completions()
 
     def create_history_tab(self):
@@ -960,7 +1012,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
 
     def export_payment_request(self, addr):
         r = self.wallet.receive_requests.get(addr)
-        pr = paymentrequest.serialize_request(r).SerializeToString()
+        pr = self.wallet.receive_requests.get_serialized(addr)
         name = r['id'] + '.bip70'
         fileName = self.getSaveFileName(_("Select where to save your payment request"), name, "*.bip70")
         if fileName:
@@ -2093,10 +2145,13 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
     @protected
     def _delete_wallet(self, password):
         wallet_path = self.wallet.storage.path
+        snapshot_path = self.wallet.snapshot_path()
         basename = os.path.basename(wallet_path)
         self.gui_object.daemon.stop_wallet(wallet_path)
         self.close()
         os.unlink(wallet_path)
+        if os.path.exists(snapshot_path):
+            os.unlink(snapshot_path)
         self.show_error(_("Wallet removed: {}").format(basename))
 
     @protected
@@ -3032,6 +3087,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
 
     def clean_up(self):
         self.wallet.thread.stop()
+        self.queries.stop()
         if self.network:
             self.network.unregister_callback(self.on_network)
         self.config.set_key("is_maximized", self.isMaximized())
@@ -67,7 +67,7 @@ class NodesListWidget(QTreeWidget):
     def __init__(self, parent):
         QTreeWidget.__init__(self)
         self.parent = parent
-        self.setHeaderLabels([_('Connected node'), _('Height')])
+        self.setHeaderLabels([_('Connected node'), _('Height'), _('Latency')])
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.create_menu)
 
@@ -113,9 +113,12 @@ class NodesListWidget(QTreeWidget):
                 x = self
             for i in items:
                 star = ' *' if i == network.interface else ''
-                item = QTreeWidgetItem([i.host + star, '%d'%i.tip])
+                stats = i.get_stats()
+                rtt = '%d ms' % stats['rtt_ms'] if stats['rtt_ms'] is not None else ''
+                item = QTreeWidgetItem([i.host + star, '%d'%i.tip, rtt])
                 item.setData(0, Qt.UserRole, 0)
                 item.setData(1, Qt.UserRole, i.server)
+                item.setToolTip(2, self.latency_tooltip(stats))
                 x.addChild(item)
             if n_chains>1:
                 self.addTopLevelItem(x)
@@ -125,6 +128,13 @@ class NodesListWidget(QTreeWidget):
         h.setStretchLastSection(False)
         h.setSectionResizeMode(0, QHeaderView.Stretch)
         h.setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        h.setSectionResizeMode(2, QHeaderView.ResizeToContents)
+
+    def latency_tooltip(self, stats):
+        lines = [_('Requests in flight') + ': %d / %d' % (stats['unanswered'], stats['max_requests'])]
+        for method, h in sorted(stats['latency'].items()):
+            lines.append('%s: %d, p50 %s ms, p90 %s ms' % (method, h['count'], h['p50_ms'], h['p90_ms']))
+        return '\n'.join(lines)
 
 
 class ServerListWidget(QTreeWidget):
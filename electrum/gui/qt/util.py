@@ -4,6 +4,7 @@ import sys
 import platform
 import queue
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 from PyQt5.QtGui import *
@@ -11,7 +12,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
 from electrum.i18n import _
-from electrum.util import FileImportFailed, FileExportFailed
+from electrum.util import FileImportFailed, FileExportFailed, PrintError
 from electrum.paymentrequest import PR_UNPAID, PR_PAID, PR_EXPIRED
 
 
@@ -398,7 +399,45 @@ class ElectrumItemDelegate(QStyledItemDelegate):
     def createEditor(self, parent, option, index):
         return self.parent().createEditor(parent, option, index)
 
-class MyTreeWidget(QTreeWidget):
+class ListToolbar:
+    '''Filter buttons shown above a list, implemented by subclasses
+    with get_toolbar_buttons and on_hide_toolbar.'''
+
+    toolbar_shown = False
+
+    def create_toolbar(self, config=None):
+        hbox = QHBoxLayout()
+        buttons = self.get_toolbar_buttons()
+        for b in buttons:
+            b.setVisible(False)
+            hbox.addWidget(b)
+        hide_button = QPushButton('x')
+        hide_button.setVisible(False)
+        hide_button.pressed.connect(lambda: self.show_toolbar(False, config))
+        self.toolbar_buttons = buttons + (hide_button,)
+        hbox.addStretch()
+        hbox.addWidget(hide_button)
+        return hbox
+
+    def save_toolbar_state(self, state, config):
+        pass  # implemented in subclasses
+
+    def show_toolbar(self, state, config=None):
+        if state == self.toolbar_shown:
+            return
+        self.toolbar_shown = state
+        if config:
+            self.save_toolbar_state(state, config)
+        for b in self.toolbar_buttons:
+            b.setVisible(state)
+        if not state:
+            self.on_hide_toolbar()
+
+    def toggle_toolbar(self, config=None):
+        self.show_toolbar(not self.toolbar_shown, config)
+
+
+class MyTreeWidget(QTreeWidget, ListToolbar):
 
     def __init__(self, parent, create_menu, headers, stretch_column=None,
                  editable_columns=None):
@@ -546,36 +585,288 @@ class MyTreeWidget(QTreeWidget):
             item.setHidden(all([item.text(column).lower().find(p) == -1
                                 for column in columns]))
 
-    def create_toolbar(self, config=None):
-        hbox = QHBoxLayout()
-        buttons = self.get_toolbar_buttons()
-        for b in buttons:
-            b.setVisible(False)
-            hbox.addWidget(b)
-        hide_button = QPushButton('x')
-        hide_button.setVisible(False)
-        hide_button.pressed.connect(lambda: self.show_toolbar(False, config))
-        self.toolbar_buttons = buttons + (hide_button,)
-        hbox.addStretch()
-        hbox.addWidget(hide_button)
-        return hbox
+class LazyListModel(QAbstractItemModel):
+    '''A flat model for lists that can be long.  Rows are identified by
+    a key, and their cells are computed by view.get_row(key) when Qt
+    first asks for them, so only the rows that are shown cost anything.
+    Cached rows are dropped with refresh() when their data changes.'''
+
+    SortRole = Qt.UserRole + 1
+
+    def __init__(self, view):
+        QAbstractItemModel.__init__(self, view)
+        self.view = view
+        self.headers = []
+        self.keys = []
+        self.positions = {}
+        self.rows = {}
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section < len(self.headers):
+            return self.headers[section]
+        return None
+
+    def get_row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = self.view.get_row(key)
+        return row
+
+    def get_cell(self, key, column, role=Qt.DisplayRole):
+        row = self.get_row(key)
+        if column >= len(row):
+            return None
+        if role == Qt.EditRole:
+            role = Qt.DisplayRole
+        return row[column].get(role)
 
-    def save_toolbar_state(self, state, config):
-        pass  # implemented in subclasses
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        return self.get_cell(self.keys[index.row()], index.column(), role)
 
-    def show_toolbar(self, state, config=None):
-        if state == self.toolbar_shown:
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.isValid() and self.view.permit_edit(self.keys[index.row()], index.column()):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        key = self.keys[index.row()]
+        prior = self.get_cell(key, index.column())
+        if value != prior:
+            self.view.on_edited(key, index.column(), value, prior)
+        return True
+
+    def set_headers(self, headers):
+        self.beginResetModel()
+        self.headers = list(headers)
+        self.rows.clear()
+        self.endResetModel()
+
+    def set_keys(self, keys):
+        '''Sets the rows of the list.  If the keys did not change, the
+        cached rows are only dropped, and the view keeps its state.'''
+        keys = list(keys)
+        if len(keys) == len(self.keys) and self.positions.keys() == set(keys):
+            self.invalidate()
+            if self.sort_column is not None:
+                self.sort(self.sort_column, self.sort_order)
             return
-        self.toolbar_shown = state
-        if config:
-            self.save_toolbar_state(state, config)
-        for b in self.toolbar_buttons:
-            b.setVisible(state)
-        if not state:
-            self.on_hide_toolbar()
+        self.beginResetModel()
+        self.keys = keys
+        self.rows.clear()
+        if self.sort_column is not None:
+            self.sort_keys()
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.endResetModel()
+
+    def invalidate(self):
+        self.rows.clear()
+        if self.keys:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.keys) - 1, len(self.headers) - 1))
+
+    def refresh(self, key):
+        '''Recomputes the row of key when it is shown again.'''
+        self.rows.pop(key, None)
+        row = self.positions.get(key)
+        if row is None:
+            return False
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+        return True
 
-    def toggle_toolbar(self, config=None):
-        self.show_toolbar(not self.toolbar_shown, config)
+    def sort_keys(self):
+        column = self.sort_column
+        self.keys.sort(key=lambda key: self.view.sort_key(key, column),
+                       reverse=self.sort_order == Qt.DescendingOrder)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < 0:
+            return
+        self.sort_column = column
+        self.sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList()
+        old_keys = [self.keys[index.row()] for index in old]
+        self.sort_keys()
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.changePersistentIndexList(old, [self.index(self.positions[key], index.column())
+                                             for key, index in zip(old_keys, old)])
+        self.layoutChanged.emit()
+
+
+class MyTreeView(QTreeView, ListToolbar):
+    '''Same interface as MyTreeWidget, but backed by a LazyListModel.
+    Subclasses call set_keys from on_update, and implement get_row(key),
+    which returns for each column a dict of Qt role to value.'''
+
+    filter_columns = []
+
+    def __init__(self, parent, create_menu, headers, stretch_column=None,
+                 editable_columns=None):
+        QTreeView.__init__(self, parent)
+        self.parent = parent
+        self.config = self.parent.config
+        self.stretch_column = stretch_column
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(create_menu)
+        self.setUniformRowHeights(True)
+        self.setRootIsDecorated(False)  # remove left margin
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.icon_cache = IconCache()
+        if editable_columns is None:
+            editable_columns = {stretch_column}
+        else:
+            editable_columns = set(editable_columns)
+        self.editable_columns = editable_columns
+        self.pending_update = False
+        self.current_filter = ""
+        self.list_model = LazyListModel(self)
+        self.list_model.layoutChanged.connect(self.refilter)
+        self.setModel(self.list_model)
+        self.doubleClicked.connect(lambda index: self.on_doubleclick(self.key_at(index), index.column()))
+        self.update_headers(headers)
+
+    def update_headers(self, headers):
+        self.list_model.set_headers(headers)
+        header = self.header()
+        header.setStretchLastSection(False)
+        # only measure the visible rows, or all rows would be computed
+        header.setResizeContentsPrecision(0)
+        for col in range(len(headers)):
+            sm = QHeaderView.Stretch if col == self.stretch_column else QHeaderView.ResizeToContents
+            header.setSectionResizeMode(col, sm)
+
+    def header_text(self, column):
+        return self.list_model.headers[column]
+
+    def key_at(self, index):
+        if not index.isValid():
+            return None
+        return self.list_model.keys[index.row()]
+
+    def text(self, key, column):
+        return self.list_model.get_cell(key, column) or ''
+
+    def current_key(self):
+        return self.key_at(self.currentIndex())
+
+    def set_current_key(self, key):
+        row = self.list_model.positions.get(key)
+        if row is not None:
+            self.setCurrentIndex(self.list_model.index(row, 0))
+
+    def selected_keys(self):
+        return [self.list_model.keys[index.row()] for index in self.selectionModel().selectedRows()]
+
+    def get_row(self, key):
+        raise NotImplementedError()
+
+    def sort_key(self, key, column):
+        value = self.list_model.get_cell(key, column, LazyListModel.SortRole)
+        if value is not None:
+            return value
+        text = self.text(key, column)
+        try:
+            return (0, float(text), '')
+        except ValueError:
+            return (1, 0, text)
+
+    def edit_cell(self, key, column):
+        row = self.list_model.positions.get(key)
+        if row is not None and self.permit_edit(key, column):
+            self.edit(self.list_model.index(row, column))
+
+    def keyPressEvent(self, event):
+        if event.key() in [ Qt.Key_F2, Qt.Key_Return ] and self.state() != QAbstractItemView.EditingState:
+            self.on_activated(self.currentIndex())
+        else:
+            QTreeView.keyPressEvent(self, event)
+
+    def permit_edit(self, key, column):
+        return (column in self.editable_columns
+                and self.on_permit_edit(key, column))
+
+    def on_permit_edit(self, key, column):
+        return True
+
+    def on_doubleclick(self, key, column):
+        self.edit_cell(key, column)
+
+    def on_activated(self, index):
+        # on 'enter' we show the menu
+        pt = self.visualRect(index).bottomLeft()
+        pt.setX(50)
+        self.customContextMenuRequested.emit(pt)
+
+    def closeEditor(self, editor, hint):
+        QTreeView.closeEditor(self, editor, hint)
+        if self.pending_update:
+            self.pending_update = False
+            self.update()
+
+    def on_edited(self, key, column, text, prior):
+        '''Called only when the text actually changes'''
+        self.parent.wallet.set_label(key, text)
+        self.list_model.refresh(key)
+        self.parent.history_list.update_labels()
+        self.parent.update_completions()
+
+    def update(self):
+        # Defer updates if editing
+        if self.state() == QAbstractItemView.EditingState:
+            self.pending_update = True
+            return
+        self.on_update()
+
+    def on_update(self):
+        pass
+
+    def set_keys(self, keys):
+        '''Sets the rows of the list, keeping the current row, the
+        scroll position and the filter.'''
+        current_key = self.current_key()
+        scroll_pos = self.verticalScrollBar().value()
+        self.list_model.set_keys(keys)
+        self.set_current_key(current_key)
+        self.verticalScrollBar().setValue(scroll_pos)
+        self.refilter()
+
+    def refresh_keys(self, keys):
+        '''Updates the rows of keys, without touching the others.'''
+        for key in keys:
+            self.list_model.refresh(key)
+
+    def refilter(self):
+        if self.current_filter:
+            self.filter(self.current_filter)
+
+    def filter(self, p):
+        columns = self.__class__.filter_columns
+        p = p.lower()
+        self.current_filter = p
+        for row, key in enumerate(self.list_model.keys):
+            hidden = bool(p) and all(self.text(key, column).lower().find(p) == -1
+                                     for column in columns)
+            self.setRowHidden(row, QModelIndex(), hidden)
 
 
 class ButtonsWidget(QWidget):
@@ -674,6 +965,94 @@ class TaskThread(QThread):
         self.tasks.put(None)
 
 
+class QueryCancelled(Exception):
+    pass
+
+
+class Query(QObject):
+    '''A computation run by a QueryService.  Its signals are delivered
+    in the GUI thread.'''
+
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    progressed = pyqtSignal(int, int)
+    done = pyqtSignal()
+    # emitted by the worker thread, and relayed in the GUI thread
+    # unless the query was cancelled in the meantime
+    result_ready = pyqtSignal(object)
+    error_raised = pyqtSignal(object)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.cancelled = False
+        self.result_ready.connect(self.on_result)
+        self.error_raised.connect(self.on_error)
+
+    def cancel(self):
+        self.cancelled = True
+
+    @pyqtSlot(object)
+    def on_result(self, result):
+        if not self.cancelled:
+            self.finished.emit(result)
+
+    @pyqtSlot(object)
+    def on_error(self, exc_info):
+        if not self.cancelled:
+            self.failed.emit(exc_info)
+
+    def progress(self, n, total):
+        '''Called by the computation, in its thread.'''
+        if self.cancelled:
+            raise QueryCancelled()
+        self.progressed.emit(n, total)
+
+
+class QueryService(PrintError):
+    '''Runs heavy wallet queries in a pool of threads, so that they do
+    not block the GUI.  A query is a function called with a progress
+    callback, that raises QueryCancelled once the query is cancelled.'''
+
+    def __init__(self, on_error=None, max_workers=2):
+        self.on_error = on_error
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # queries are kept alive until their signals are delivered
+        self.queries = set()
+
+    def submit(self, func, on_success=None, on_error=None, on_progress=None):
+        on_error = on_error or self.on_error
+        query = Query()
+        if on_success:
+            query.finished.connect(on_success)
+        if on_error:
+            query.failed.connect(on_error)
+        if on_progress:
+            query.progressed.connect(on_progress)
+        query.done.connect(lambda: self.queries.discard(query))
+        self.queries.add(query)
+        self.executor.submit(self.run, query, func)
+        return query
+
+    def run(self, query, func):
+        try:
+            if query.cancelled:
+                return
+            result = func(query.progress)
+        except QueryCancelled:
+            pass
+        except BaseException:
+            query.error_raised.emit(sys.exc_info())
+        else:
+            query.result_ready.emit(result)
+        finally:
+            query.done.emit()
+
+    def stop(self):
+        for query in self.queries:
+            query.cancel()
+        self.executor.shutdown(wait=False)
+
+
 class ColorSchemeItem:
     def __init__(self, fg_color, bg_color):
         self.colors = (fg_color, bg_color)
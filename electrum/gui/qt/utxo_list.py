@@ -33,15 +33,23 @@ class UTXOList(MyTreeWidget):
         MyTreeWidget.__init__(self, parent, self.create_menu, [ _('Address'), _('Label'), _('Amount'), _('Height'), _('Output point')], 1)
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setSortingEnabled(True)
+        self.utxos = []
+        self.utxo_query = None
 
     def get_name(self, x):
         return x.get('prevout_hash') + ":%d"%x.get('prevout_n')
 
     def on_update(self):
-        self.wallet = self.parent.wallet
-        item = self.currentItem()
+        self.wallet = wallet = self.parent.wallet
+        if self.utxo_query:
+            self.utxo_query.cancel()
+        self.utxo_query = self.parent.queries.submit(lambda progress: wallet.get_utxos(),
+                                                     on_success=self.on_utxos)
+
+    def on_utxos(self, utxos):
+        self.utxo_query = None
         self.clear()
-        self.utxos = self.wallet.get_utxos()
+        self.utxos = utxos
         for x in self.utxos:
             address = x.get('address')
             height = x.get('height')
@@ -56,6 +64,8 @@ class UTXOList(MyTreeWidget):
             if self.wallet.is_frozen(address):
                 utxo_item.setBackground(0, ColorScheme.BLUE.as_color(True))
             self.addChild(utxo_item)
+        if self.current_filter:
+            self.filter(self.current_filter)
 
     def create_menu(self, position):
         selected = [x.data(0, Qt.UserRole) for x in self.selectedItems()]
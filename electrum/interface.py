@@ -22,6 +22,7 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import bisect
 import os
 import re
 import socket
@@ -30,6 +31,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import defaultdict
 
 import requests
 
@@ -247,15 +249,84 @@ class TcpConnection(threading.Thread, util.PrintError):
         self.queue.put((self.server, socket))
 
 
+class LatencyHistogram(object):
+    '''Round-trip times of the requests of one method, counted in
+    buckets whose upper bounds are given in milliseconds.'''
+
+    BOUNDS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        '''Upper bound of the bucket of the p-th percentile.'''
+        n = self.count()
+        if not n:
+            return None
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= n * p / 100:
+                break
+        return self.BOUNDS[i] if i < len(self.BOUNDS) else round(self.max)
+
+    def as_dict(self):
+        n = self.count()
+        return {
+            'count': n,
+            'avg_ms': round(self.total / n) if n else None,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'max_ms': round(self.max),
+            'buckets': list(zip(self.BOUNDS + [None], self.counts)),
+        }
+
+
 class Interface(util.PrintError):
     """The Interface class handles a socket connected to a single remote
     Electrum server.  Its exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), get_stats()
     - Member variable server.
+
+    The number of unanswered requests is limited by a window that grows
+    by one request per window of timely answers, and is halved when the
+    server answers with errors or much slower than usual (AIMD).
     """
 
+    # bounds of the request window
+    MIN_REQUESTS = 10
+    MAX_REQUESTS = 1000
+    INITIAL_REQUESTS = 100
+    # request timeouts, in seconds, before and after we have measured
+    # round-trip times.  A low round-trip time never makes the timeout
+    # shorter than the default.
+    DEFAULT_TIMEOUT = 10
+    MIN_TIMEOUT = 10
+    MAX_TIMEOUT = 30
+    # extra time for requests that take a busy server long to answer:
+    # the history of a busy address, or a chunk of 2016 headers
+    SLOW_METHODS = {
+        'blockchain.scripthash.get_history': 20,
+        'blockchain.block.headers': 20,
+    }
+    # answers slower than this many smoothed round-trip times, and
+    # slower than SLOW_ANSWER seconds, shrink the window
+    SLOW_FACTOR = 4
+    SLOW_ANSWER = 1.
+
     def __init__(self, server, socket):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
@@ -267,8 +338,15 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        self.send_times = {}
         self.last_send = time.time()
         self.closed_remotely = False
+        self.max_requests = self.INITIAL_REQUESTS
+        self.last_decrease = 0
+        self.srtt = None
+        self.rttvar = None
+        self.errors = 0
+        self.latency = defaultdict(LatencyHistogram)
 
     def diagnostic_name(self):
         return self.host
@@ -293,9 +371,9 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = int(self.max_requests) - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
@@ -313,16 +391,69 @@ class Interface(util.PrintError):
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
         return True
 
+    def request_timeout(self, method=None):
+        if self.srtt is None:
+            timeout = self.DEFAULT_TIMEOUT
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+            timeout = min(self.MAX_TIMEOUT, max(self.MIN_TIMEOUT, timeout))
+        return timeout + self.SLOW_METHODS.get(method, 0)
+
+    def on_response(self, request, response):
+        '''Measures the round-trip time of request, and adapts the
+        request window.'''
+        method, params, wire_id = request
+        sent = self.send_times.pop(wire_id, None)
+        if sent is None:
+            return
+        now = time.time()
+        rtt = now - sent
+        self.latency[method].add(rtt)
+        slow = (self.srtt is not None and rtt > self.SLOW_FACTOR * self.srtt
+                and rtt > self.SLOW_ANSWER)
+        # smoothed round-trip time and variation, as for TCP (RFC 6298)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        error = response.get('error') is not None
+        if error:
+            self.errors += 1
+        if error or slow:
+            # at most once per round trip, as the answers to the
+            # requests already sent will be slow too
+            if now - self.last_decrease > self.srtt:
+                self.max_requests = max(self.MIN_REQUESTS, self.max_requests / 2)
+                self.last_decrease = now
+        elif len(self.unanswered_requests) + 1 >= self.max_requests / 2:
+            # only grow the window if we are using it
+            self.max_requests = min(self.MAX_REQUESTS, self.max_requests + 1 / self.max_requests)
+
+    def get_stats(self):
+        return {
+            'max_requests': int(self.max_requests),
+            'unanswered': len(self.unanswered_requests),
+            'rtt_ms': round(self.srtt * 1000) if self.srtt is not None else None,
+            'timeout': round(self.request_timeout(), 1),
+            'errors': self.errors,
+            'latency': {method: h.as_dict() for method, h in list(self.latency.items())},
+        }
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
 
     def has_timed_out(self):
         '''Returns True if the interface has timed out.'''
-        if (self.unanswered_requests and time.time() - self.request_time > 10
-            and self.pipe.idle_time() > 10):
+        timeout = max([self.request_timeout(r[0])
+                       for r in self.unanswered_requests.values() if r],
+                      default=self.request_timeout())
+        if (self.unanswered_requests and time.time() - self.request_time > timeout
+            and self.pipe.idle_time() > timeout):
             self.print_error("timeout", len(self.unanswered_requests))
             return True
 
@@ -357,6 +488,7 @@ class Interface(util.PrintError):
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
+                    self.on_response(request, response)
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
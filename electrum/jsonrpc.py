@@ -23,8 +23,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
+from jsonrpclib.SimpleJSONRPCServer import PooledJSONRPCServer, SimpleJSONRPCRequestHandler
+from jsonrpclib.threadpool import ThreadPool
 from base64 import b64decode
+import socket
+import threading
 import time
 
 from . import util
@@ -46,14 +49,44 @@ class RPCAuthUnsupportedType(Exception):
 
 
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
-class VerifyingJSONRPCServer(SimpleJSONRPCServer):
-
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+class VerifyingJSONRPCServer(PooledJSONRPCServer):
+    """Requests are handled by a pool of rpc_threads threads, so that a
+    slow command does not hold up other clients.  Connections are kept
+    alive between requests, and closed after keepalive_timeout seconds
+    without a request, as an idle connection holds a thread of the
+    pool.  A request that stalls for request_timeout seconds is
+    dropped.  Batch requests are handled by jsonrpclib.
+    """
+
+    def __init__(self, *args, rpc_user, rpc_password, rpc_threads=10,
+                 request_timeout=60, keepalive_timeout=5, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        self.connections_lock = threading.Lock()
+        self.connections = set()
+        self.thread_pool = ThreadPool(rpc_threads, 1, logname='VerifyingJSONRPCServer')
+        self.thread_pool.start()
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
+            # keep-alive
+            protocol_version = 'HTTP/1.1'
+            # socket timeout while a request is read or answered
+            timeout = request_timeout
+
+            def handle_one_request(myself):
+                # wait for the next request with the shorter timeout
+                try:
+                    myself.connection.settimeout(keepalive_timeout)
+                    if not myself.rfile.peek(1):
+                        myself.close_connection = True
+                        return
+                except socket.timeout:
+                    myself.close_connection = True
+                    return
+                myself.connection.settimeout(request_timeout)
+                SimpleJSONRPCRequestHandler.handle_one_request(myself)
+
             def parse_request(myself):
                 # first, call the original implementation which returns
                 # True if all OK so far
@@ -73,8 +106,37 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
                         myself.send_error(500, str(e))
                 return False
 
-        SimpleJSONRPCServer.__init__(
-            self, requestHandler=VerifyingRequestHandler, *args, **kargs)
+        try:
+            PooledJSONRPCServer.__init__(
+                self, requestHandler=VerifyingRequestHandler,
+                thread_pool=self.thread_pool, *args, **kargs)
+        except BaseException:
+            self.thread_pool.stop()
+            raise
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        PooledJSONRPCServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        PooledJSONRPCServer.shutdown_request(self, request)
+
+    def server_close(self):
+        # PooledJSONRPCServer.server_close() waits for serve_forever(),
+        # which we do not use
+        self.socket.close()
+        # wake up threads waiting on idle keep-alive connections
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread_pool.stop()
 
     def authenticate(self, headers):
         if self.rpc_password == '':
@@ -24,18 +24,87 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import hmac
+import os
+import threading
+import time
+from functools import lru_cache
 from unicodedata import normalize
 
 from . import bitcoin, ecc, constants
 from .bitcoin import *
 from .ecc import string_to_number, number_to_string
-from .crypto import pw_decode, pw_encode
+from .crypto import pw_decode, pw_encode, hmac_oneshot
 from .util import (PrintError, InvalidPassword, hfu, WalletFileException,
                    BitcoinException)
 from .mnemonic import Mnemonic, load_wordlist
 from .plugin import run_hook
 
 
+@lru_cache(maxsize=1000)
+def _xpub_to_bytes(xpub):
+    return bitcoin.DecodeBase58Check(xpub)
+
+
+@lru_cache(maxsize=1000)
+def _xpub_from_bytes(xpub_bytes):
+    return bitcoin.EncodeBase58Check(xpub_bytes)
+
+
+class KeySession:
+    '''Secrets of an unlocked software keystore, kept so that signing
+    does not decrypt and parse them again.  Each secret is held in a
+    bytearray that wipe() overwrites, and the session only answers to
+    the password it was opened with.'''
+
+    def __init__(self, password, timeout=None):
+        self.salt = os.urandom(16)
+        self.password_hash = self.hash_password(password)
+        self.lock = threading.Lock()
+        self.secrets = {}
+        self.expires = None
+        self.timer = None
+        if timeout is not None:
+            self.expires = time.time() + timeout
+            self.timer = threading.Timer(timeout, self.wipe)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def hash_password(self, password):
+        data = b'' if password is None else b'\x01' + password.encode('utf8')
+        return hmac_oneshot(self.salt, data, hashlib.sha256)
+
+    def is_valid(self, password):
+        if self.secrets is None:
+            return False
+        if self.expires is not None and time.time() >= self.expires:
+            self.wipe()
+            return False
+        return hmac.compare_digest(self.password_hash, self.hash_password(password))
+
+    def get(self, key):
+        with self.lock:
+            if self.secrets is None or key not in self.secrets:
+                return None
+            return bytes(self.secrets[key])
+
+    def put(self, key, secret):
+        with self.lock:
+            if self.secrets is not None:
+                self.secrets[key] = bytearray(secret)
+
+    def wipe(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            if self.secrets is None:
+                return
+            for secret in self.secrets.values():
+                secret[:] = bytes(len(secret))
+            self.secrets = None
+
+
 class KeyStore(PrintError):
 
     def has_seed(self):
@@ -85,10 +154,35 @@ class Software_KeyStore(KeyStore):
 
     def __init__(self):
         KeyStore.__init__(self)
+        self.session = None
 
     def may_have_password(self):
         return not self.is_watching_only()
 
+    def unlock(self, password, timeout=None):
+        '''Keeps the decrypted keys in memory until lock is called, or
+        for timeout seconds.  Signing still requires the password.'''
+        self.check_password(password)
+        session = KeySession(password, timeout)
+        self.lock()
+        self.session = session
+        return session
+
+    def lock(self, session=None):
+        '''Wipes the keys of session, or of the current session.'''
+        session = session or self.session
+        if session is None:
+            return
+        session.wipe()
+        if session is self.session:
+            self.session = None
+
+    def get_session(self, password):
+        session = self.session
+        if session is not None and session.is_valid(password):
+            return session
+        return None
+
     def sign_message(self, sequence, message, password):
         privkey, compressed = self.get_private_key(sequence, password)
         key = ecc.ECPrivkey(privkey)
@@ -103,15 +197,22 @@ class Software_KeyStore(KeyStore):
     def sign_transaction(self, tx, password):
         if self.is_watching_only():
             return
-        # Raise if password is not correct.
-        self.check_password(password)
-        # Add private keys
-        keypairs = self.get_tx_derivations(tx)
-        for k, v in keypairs.items():
-            keypairs[k] = self.get_private_key(v, password)
-        # Sign
-        if keypairs:
-            tx.sign(keypairs)
+        # the inputs share the decrypted keys
+        session = None
+        if self.get_session(password) is None:
+            # Raise if password is not correct.
+            session = self.unlock(password)
+        try:
+            # Add private keys
+            keypairs = self.get_tx_derivations(tx)
+            for k, v in keypairs.items():
+                keypairs[k] = self.get_private_key(v, password)
+            # Sign
+            if keypairs:
+                tx.sign(keypairs)
+        finally:
+            if session:
+                self.lock(session)
 
 
 class Imported_KeyStore(Software_KeyStore):
@@ -157,11 +258,17 @@ class Imported_KeyStore(Software_KeyStore):
         self.keypairs.pop(key)
 
     def get_private_key(self, pubkey, password):
+        session = self.get_session(password)
+        secret = session.get(pubkey) if session else None
+        if secret is not None:
+            return secret[1:], bool(secret[0])
         sec = pw_decode(self.keypairs[pubkey], password)
         txin_type, privkey, compressed = deserialize_privkey(sec)
         # this checks the password
         if pubkey != ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed):
             raise InvalidPassword()
+        if session:
+            session.put(pubkey, bytes([compressed]) + privkey)
         return privkey, compressed
 
     def get_pubkey_derivation(self, x_pubkey):
@@ -175,6 +282,7 @@ class Imported_KeyStore(Software_KeyStore):
 
     def update_password(self, old_password, new_password):
         self.check_password(old_password)
+        self.lock()
         if new_password == '':
             new_password = None
         for k, v in self.keypairs.items():
@@ -249,14 +357,14 @@ class Xpub:
 
     def get_xpubkey(self, c, i):
         s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (c, i)))
-        return 'ff' + bh2u(bitcoin.DecodeBase58Check(self.xpub)) + s
+        return 'ff' + bh2u(_xpub_to_bytes(self.xpub)) + s
 
     @classmethod
     def parse_xpubkey(self, pubkey):
         assert pubkey[0:2] == 'ff'
         pk = bfh(pubkey)
         pk = pk[1:]
-        xkey = bitcoin.EncodeBase58Check(pk[0:78])
+        xkey = _xpub_from_bytes(pk[0:78])
         dd = pk[78:]
         s = []
         while dd:
@@ -294,7 +402,14 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         return d
 
     def get_master_private_key(self, password):
-        return pw_decode(self.xprv, password)
+        session = self.get_session(password)
+        xprv = session.get('xprv') if session else None
+        if xprv is not None:
+            return xprv.decode('ascii')
+        xprv = pw_decode(self.xprv, password)
+        if session:
+            session.put('xprv', xprv.encode('ascii'))
+        return xprv
 
     def check_password(self, password):
         xprv = pw_decode(self.xprv, password)
@@ -303,6 +418,7 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
 
     def update_password(self, old_password, new_password):
         self.check_password(old_password)
+        self.lock()
         if new_password == '':
             new_password = None
         if self.has_seed():
@@ -328,11 +444,28 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         self.add_xprv(xprv)
 
     def get_private_key(self, sequence, password):
+        session = self.get_session(password)
+        if session:
+            node = self.get_session_node(session, tuple(sequence), password)
+            return node[:32], True
         xprv = self.get_master_private_key(password)
         _, _, _, _, c, k = deserialize_xprv(xprv)
         pk = bip32_private_key(sequence, k, c)
         return pk, True
 
+    def get_session_node(self, session, path, password):
+        '''The private key and chain code at path, from the session.'''
+        node = session.get(path)
+        if node is None:
+            if path:
+                parent = self.get_session_node(session, path[:-1], password)
+                k, c = CKD_priv(parent[:32], parent[32:], path[-1])
+            else:
+                _, _, _, _, c, k = deserialize_xprv(self.get_master_private_key(password))
+            node = k + c
+            session.put(path, node)
+        return node
+
 
 
 class Old_KeyStore(Deterministic_KeyStore):
@@ -412,10 +545,17 @@ class Old_KeyStore(Deterministic_KeyStore):
         return pk
 
     def get_private_key(self, sequence, password):
-        seed = self.get_hex_seed(password)
-        self.check_seed(seed)
+        session = self.get_session(password)
+        secexp = session.get('secexp') if session else None
+        if secexp is not None:
+            secexp = string_to_number(secexp)
+        else:
+            seed = self.get_hex_seed(password)
+            self.check_seed(seed)
+            secexp = self.stretch_key(seed)
+            if session:
+                session.put('secexp', number_to_string(secexp, ecc.CURVE_ORDER))
         for_change, n = sequence
-        secexp = self.stretch_key(seed)
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return pk, False
 
@@ -462,6 +602,7 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     def update_password(self, old_password, new_password):
         self.check_password(old_password)
+        self.lock()
         if new_password == '':
             new_password = None
         if self.has_seed():
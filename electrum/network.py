@@ -22,6 +22,7 @@
 # SOFTWARE.
 import time
 import queue
+import hashlib
 import os
 import errno
 import random
@@ -44,6 +45,8 @@ from . import bitcoin
 from .bitcoin import COIN
 from . import constants
 from .interface import Connection, Interface
+from .transaction import Transaction
+from .tx_cache import TxCache, ProofCache
 from . import blockchain
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from .i18n import _
@@ -176,6 +179,22 @@ class Network(util.DaemonThread):
     """
     verbosity_filter = 'n'
 
+    # number of headers requested by the first round trip of a fork
+    # search, and upper bound; stays below the size of a chunk, so that
+    # the responses cannot be mistaken for chunks
+    FORK_SEARCH_WINDOW = 16
+    FORK_SEARCH_MAX_WINDOW = 1000
+    # chunks that may be in flight at once for each interface, when
+    # the verifier prefetches headers
+    CHUNK_PREFETCH = 8
+    # client requests that any server on our chain can answer; with
+    # 'load_balance' set, they are spread over all the interfaces
+    BALANCED_METHODS = {
+        'blockchain.transaction.get',
+        'blockchain.transaction.get_merkle',
+        'blockchain.scripthash.get_history',
+    }
+
     def __init__(self, config=None):
         if config is None:
             config = {}  # Do not use mutables as default values!
@@ -208,6 +227,7 @@ class Network(util.DaemonThread):
         self.blockchains_lock = threading.Lock()
 
         self.pending_sends = []
+        self.pending_chunks = []  # note: needs self.pending_sends_lock
         self.message_id = 0
         self.debug = False
         self.irc_servers = {}  # returned by interface (list from irc)
@@ -230,6 +250,8 @@ class Network(util.DaemonThread):
         self.h2addr = {}
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # message_id -> server, for those not sent to self.interface
+        self.routed_requests = {}
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -240,7 +262,9 @@ class Network(util.DaemonThread):
         self.interfaces = {}               # note: needs self.interface_lock
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
+        self.requested_chunks = {}         # index -> server
+        self.tx_cache = TxCache(self.config)
+        self.proof_cache = ProofCache(self.config)
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
@@ -345,6 +369,7 @@ class Network(util.DaemonThread):
         # Resend unanswered requests
         requests = self.unanswered_requests.values()
         self.unanswered_requests = {}
+        self.routed_requests = {}
         for request in requests:
             message_id = self.queue_request(request[0], request[1])
             self.unanswered_requests[message_id] = request
@@ -379,6 +404,8 @@ class Network(util.DaemonThread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'interface_stats':
+            value = self.get_interface_stats()
         return value
 
     def notify(self, key):
@@ -400,6 +427,11 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return list(self.interfaces.keys())
 
+    @with_interface_lock
+    def get_interface_stats(self):
+        '''Request window and latencies of each connected server'''
+        return {server: i.get_stats() for server, i in self.interfaces.items()}
+
     @with_recent_servers_lock
     def get_servers(self):
         out = constants.net.DEFAULT_SERVERS
@@ -676,11 +708,16 @@ class Network(util.DaemonThread):
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
+                routed_to = self.routed_requests.pop(message_id, None)
                 if client_req:
-                    if interface != self.interface:
+                    if interface != self.interface and interface.server != routed_to:
                         # we probably changed the current interface
                         # in the meantime; drop this.
-                        return
+                        continue
+                    if routed_to and not self.is_consistent(method, params, response):
+                        interface.print_error('retrying on main interface', method, params)
+                        self.resend_request(client_req)
+                        continue
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
@@ -734,6 +771,11 @@ class Network(util.DaemonThread):
         with self.pending_sends_lock:
             sends = self.pending_sends
             self.pending_sends = []
+            chunks = self.pending_chunks
+            self.pending_chunks = []
+
+        for interface, index in chunks:
+            self.request_chunk(interface, index)
 
         for messages, callback in sends:
             for method, params in messages:
@@ -753,8 +795,57 @@ class Network(util.DaemonThread):
                     self.print_error("cache hit", k)
                     callback(r)
                 else:
-                    message_id = self.queue_request(method, params)
+                    interface = self.route_request(method)
+                    message_id = self.queue_request(method, params, interface)
                     self.unanswered_requests[message_id] = method, params, callback
+                    if interface != self.interface:
+                        self.routed_requests[message_id] = interface.server
+
+    def route_request(self, method):
+        '''The interface a client request is sent to.  Balanced reads go
+        to the interface with the most room in its request window, among
+        those that follow our chain and are not behind our server.'''
+        if (method not in self.BALANCED_METHODS
+                or not self.config.get('load_balance', False)):
+            return self.interface
+        candidates = [self.interface] + [
+            i for i in self.interfaces.values()
+            if i != self.interface and i.mode == 'default'
+            and i.blockchain == self.interface.blockchain
+            and i.tip >= self.interface.tip]
+        return max(candidates, key=lambda i: i.max_requests
+                   - len(i.unanswered_requests) - len(i.unsent_requests))
+
+    def resend_request(self, client_req):
+        '''Sends a client request again, to our main server.'''
+        method, params, callback = client_req
+        if self.interface is None:
+            self.send([(method, params)], callback)
+            return
+        message_id = self.queue_request(method, params)
+        self.unanswered_requests[message_id] = client_req
+
+    @staticmethod
+    def get_history_status(history):
+        if not history:
+            return None
+        status = ''.join(item['tx_hash'] + ':%d:' % item['height'] for item in history)
+        return util.bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+    def is_consistent(self, method, params, response):
+        '''Whether a response from another server than ours can be
+        passed on.  Errors are retried, as the other server may just not
+        have seen the transaction yet, and histories must match the
+        status our server announced, or the synchronizer drops them.'''
+        if response.get('error') is not None:
+            return False
+        if method == 'blockchain.scripthash.get_history':
+            k = self.get_index('blockchain.scripthash.subscribe', params)
+            status = self.sub_cache.get(k)
+            if status is None:
+                return False
+            return self.get_history_status(response.get('result')) == status.get('result')
+        return True
 
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
@@ -780,6 +871,17 @@ class Network(util.DaemonThread):
             for b in self.blockchains.values():
                 if b.catch_up == server:
                     b.catch_up = None
+        # chunks we will not receive; they may be requested again
+        for index, s in list(self.requested_chunks.items()):
+            if s == server:
+                self.requested_chunks.pop(index)
+        # client requests we sent to that server go to our server
+        for message_id, s in list(self.routed_requests.items()):
+            if s == server:
+                self.routed_requests.pop(message_id)
+                client_req = self.unanswered_requests.pop(message_id, None)
+                if client_req:
+                    self.resend_request(client_req)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
@@ -851,14 +953,41 @@ class Network(util.DaemonThread):
                     self.request_fee_estimates()
 
     def request_chunk(self, interface, index):
+        if threading.current_thread() is not self:
+            # wallet jobs may run on scheduler worker threads;
+            # message ids are only handed out by the network thread
+            with self.pending_sends_lock:
+                self.pending_chunks.append((interface, index))
+            return
         if index in self.requested_chunks:
             return
+        if self.interfaces.get(interface.server) is not interface:
+            # closed while the request was pending
+            return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        self.requested_chunks[index] = interface.server
         height = index * 2016
         self.queue_request('blockchain.block.headers', [height, 2016],
                            interface)
 
+    def request_chunks(self, blockchain, indexes):
+        '''Requests several chunks at once, spread over the interfaces
+        that follow blockchain.'''
+        with self.interface_lock:
+            interfaces = [i for i in self.interfaces.values()
+                          if i.blockchain == blockchain]
+        if not interfaces:
+            return
+        in_flight = set(self.requested_chunks)
+        room = self.CHUNK_PREFETCH * len(interfaces) - len(in_flight)
+        for index in sorted(indexes):
+            if index in in_flight:
+                continue
+            if room <= 0:
+                break
+            self.request_chunk(interfaces[room % len(interfaces)], index)
+            room -= 1
+
     def on_block_headers(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
@@ -868,6 +997,9 @@ class Network(util.DaemonThread):
         if result is None or params is None or error is not None:
             interface.print_error(error or 'bad response')
             return
+        if interface.mode == 'fork_search' and tuple(params) == interface.request:
+            self.on_fork_search_headers(interface, response)
+            return
         # Ignore unsolicited chunks
         height = params[0]
         index = height // 2016
@@ -876,13 +1008,15 @@ class Network(util.DaemonThread):
             return
         else:
             interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
+        self.requested_chunks.pop(index)
         hexdata = result['hex']
+        # a chunk below our tip refills pruned headers
+        catching_up = (index + 1) * 2016 - 1 > blockchain.height()
         connect = blockchain.connect_chunk(index, hexdata)
         if not connect:
             self.connection_down(interface.server)
             return
-        if index >= len(blockchain.checkpoints):
+        if index >= len(blockchain.checkpoints) and catching_up:
             # If not finished, get the next chunk
             if blockchain.height() < interface.tip:
                 self.request_chunk(interface, index+1)
@@ -909,38 +1043,7 @@ class Network(util.DaemonThread):
             self.connection_down(interface.server)
             return
         chain = blockchain.check_header(header)
-        if interface.mode == 'backward':
-            can_connect = blockchain.can_connect(header)
-            if can_connect and can_connect.catch_up is None:
-                interface.mode = 'catch_up'
-                interface.blockchain = can_connect
-                interface.blockchain.save_header(header)
-                next_height = height + 1
-                interface.blockchain.catch_up = interface.server
-            elif chain:
-                # FIXME should await "initial chunk download".
-                # binary search will NOT do the correct thing if we don't yet
-                # have all headers up to the fork height
-                interface.print_error("binary search")
-                interface.mode = 'binary'
-                interface.blockchain = chain
-                interface.good = height
-                next_height = (interface.bad + interface.good) // 2
-                assert next_height >= self.max_checkpoint(), (interface.bad, interface.good)
-            else:
-                if height == 0:
-                    self.connection_down(interface.server)
-                    next_height = None
-                else:
-                    interface.bad = height
-                    interface.bad_header = header
-                    delta = interface.tip - height
-                    next_height = max(self.max_checkpoint(), interface.tip - 2 * delta)
-                    if height == next_height:
-                        self.connection_down(interface.server)
-                        next_height = None
-
-        elif interface.mode == 'binary':
+        if interface.mode == 'binary':
             if chain:
                 interface.good = height
                 interface.blockchain = chain
@@ -950,51 +1053,8 @@ class Network(util.DaemonThread):
             if interface.bad != interface.good + 1:
                 next_height = (interface.bad + interface.good) // 2
                 assert next_height >= self.max_checkpoint()
-            elif not interface.blockchain.can_connect(interface.bad_header, check_height=False):
-                self.connection_down(interface.server)
-                next_height = None
             else:
-                branch = self.blockchains.get(interface.bad)
-                if branch is not None:
-                    if branch.check_header(interface.bad_header):
-                        interface.print_error('joining chain', interface.bad)
-                        next_height = None
-                    elif branch.parent().check_header(header):
-                        interface.print_error('reorg', interface.bad, interface.tip)
-                        interface.blockchain = branch.parent()
-                        next_height = interface.bad
-                    else:
-                        interface.print_error('forkpoint conflicts with existing fork', branch.path())
-                        branch.write(b'', 0)
-                        branch.save_header(interface.bad_header)
-                        interface.mode = 'catch_up'
-                        interface.blockchain = branch
-                        next_height = interface.bad + 1
-                        interface.blockchain.catch_up = interface.server
-                else:
-                    bh = interface.blockchain.height()
-                    next_height = None
-                    if bh > interface.good:
-                        if not interface.blockchain.check_header(interface.bad_header):
-                            b = interface.blockchain.fork(interface.bad_header)
-                            with self.blockchains_lock:
-                                self.blockchains[interface.bad] = b
-                            interface.blockchain = b
-                            interface.print_error("new chain", b.forkpoint)
-                            interface.mode = 'catch_up'
-                            maybe_next_height = interface.bad + 1
-                            if maybe_next_height <= interface.tip:
-                                next_height = maybe_next_height
-                                interface.blockchain.catch_up = interface.server
-                    else:
-                        assert bh == interface.good
-                        if interface.blockchain.catch_up is None and bh < interface.tip:
-                            interface.print_error("catching up from %d"% (bh + 1))
-                            interface.mode = 'catch_up'
-                            next_height = bh + 1
-                            interface.blockchain.catch_up = interface.server
-
-                self.notify('updated')
+                next_height = self.on_forkpoint_found(interface, header)
 
         elif interface.mode == 'catch_up':
             can_connect = interface.blockchain.can_connect(header)
@@ -1002,12 +1062,17 @@ class Network(util.DaemonThread):
                 interface.blockchain.save_header(header)
                 next_height = height + 1 if height < interface.tip else None
             else:
-                # go back
+                # the server switched to another branch: look for the
+                # last header we have in common
                 interface.print_error("cannot connect", height)
-                interface.mode = 'backward'
+                interface.blockchain.catch_up = None
                 interface.bad = height
                 interface.bad_header = header
-                next_height = height - 1
+                if height - 1 < self.max_checkpoint():
+                    self.connection_down(interface.server)
+                    return
+                self.request_fork_search(interface, height - 1, self.FORK_SEARCH_WINDOW)
+                return
 
             if next_height is None:
                 # exit catch_up state
@@ -1018,6 +1083,117 @@ class Network(util.DaemonThread):
 
         else:
             raise Exception(interface.mode)
+        self.request_next_header(interface, next_height)
+
+    def on_forkpoint_found(self, interface, header):
+        '''interface.good is the last header we have in common with the
+        server, interface.bad_header the first one we do not have.
+        Returns the height of the next header to request.'''
+        if not interface.blockchain.can_connect(interface.bad_header, check_height=False):
+            self.connection_down(interface.server)
+            return None
+        branch = self.blockchains.get(interface.bad)
+        if branch is not None:
+            if branch.check_header(interface.bad_header):
+                interface.print_error('joining chain', interface.bad)
+                next_height = None
+            elif branch.parent().check_header(header):
+                interface.print_error('reorg', interface.bad, interface.tip)
+                interface.blockchain = branch.parent()
+                next_height = interface.bad
+            else:
+                interface.print_error('forkpoint conflicts with existing fork', branch.path())
+                branch.write(b'', 0)
+                branch.save_header(interface.bad_header)
+                interface.mode = 'catch_up'
+                interface.blockchain = branch
+                next_height = interface.bad + 1
+                interface.blockchain.catch_up = interface.server
+        else:
+            bh = interface.blockchain.height()
+            next_height = None
+            if bh > interface.good:
+                if not interface.blockchain.check_header(interface.bad_header):
+                    b = interface.blockchain.fork(interface.bad_header)
+                    with self.blockchains_lock:
+                        self.blockchains[interface.bad] = b
+                    interface.blockchain = b
+                    interface.print_error("new chain", b.forkpoint)
+                    interface.mode = 'catch_up'
+                    maybe_next_height = interface.bad + 1
+                    if maybe_next_height <= interface.tip:
+                        next_height = maybe_next_height
+                        interface.blockchain.catch_up = interface.server
+            else:
+                assert bh == interface.good
+                if interface.blockchain.catch_up is None and bh < interface.tip:
+                    interface.print_error("catching up from %d"% (bh + 1))
+                    interface.mode = 'catch_up'
+                    next_height = bh + 1
+                    interface.blockchain.catch_up = interface.server
+
+        self.notify('updated')
+        return next_height
+
+    def request_fork_search(self, interface, end, window):
+        '''Requests the headers up to height end (included), to find the
+        last one we have in common with the server.  Each round trip
+        looks at a whole range of headers, and the ranges grow as the
+        search goes back.'''
+        start = max(self.max_checkpoint(), end - window + 1)
+        interface.mode = 'fork_search'
+        interface.fork_search_window = window
+        interface.request = (start, end - start + 1)
+        interface.req_time = time.time()
+        self.queue_request('blockchain.block.headers', [start, end - start + 1], interface)
+
+    def on_fork_search_headers(self, interface, response):
+        result = response.get('result')
+        start, count = interface.request
+        try:
+            data = util.bfh(result['hex'])
+            headers = [blockchain.deserialize_header(data[i:i+80], start + i // 80)
+                       for i in range(0, len(data), 80)]
+        except Exception as e:
+            interface.print_error('bad response to fork search', e)
+            self.connection_down(interface.server)
+            return
+        if not headers or len(headers) > count:
+            self.connection_down(interface.server)
+            return
+        for prev, header in zip(headers, headers[1:]):
+            if header.get('prev_block_hash') != blockchain.hash_header(prev):
+                interface.print_error('fork search: headers do not form a chain')
+                self.connection_down(interface.server)
+                return
+        for i in range(len(headers) - 1, -1, -1):
+            chain = blockchain.check_header(headers[i])
+            if chain:
+                break
+        else:
+            if start <= self.max_checkpoint():
+                interface.print_error('fork search: no common header')
+                self.connection_down(interface.server)
+                return
+            window = min(self.FORK_SEARCH_MAX_WINDOW, interface.fork_search_window * 4)
+            self.request_fork_search(interface, start - 1, window)
+            return
+        interface.print_error('fork search: found common header', start + i)
+        interface.mode = 'binary'
+        interface.blockchain = chain
+        interface.good = start + i
+        if i + 1 < len(headers):
+            interface.bad = start + i + 1
+            interface.bad_header = headers[i + 1]
+        elif interface.bad != interface.good + 1:
+            # the range ended below the header we were notified of
+            interface.print_error('fork search: short response')
+            self.connection_down(interface.server)
+            return
+        next_height = self.on_forkpoint_found(interface, headers[i])
+        self.request_next_header(interface, next_height)
+
+    def request_next_header(self, interface, next_height):
         # If not finished, get the next header
         if next_height is not None:
             if next_height < 0:
@@ -1075,8 +1251,28 @@ class Network(util.DaemonThread):
                 if length>0:
                     f.seek(length-1)
                     f.write(b'\x00')
+            # the hashes of zeroed headers are zeroed too
+            with open(b.hashes_path(), 'wb') as f:
+                if length>0:
+                    f.seek(length // blockchain.HEADER_SIZE * blockchain.HASH_SIZE - 1)
+                    f.write(b'\x00')
         with b.lock:
             b.update_size()
+            b.sync_hashes()
+        self.maybe_prune_headers()
+
+    def maybe_prune_headers(self):
+        '''In pruned mode, only the most recent headers are kept on disk.
+        Older headers are downloaded again when the verifier needs them.'''
+        if not self.config.get('prune_headers', False):
+            return
+        keep = max(2016, self.config.get('prune_headers_keep', 2 * 2016))
+        b = self.blockchains[0]
+        height = (b.height() + 1 - keep) // 2016 * 2016
+        if height - self.config.get('headers_pruned_height', 0) < 2016:
+            return
+        b.prune(height)
+        self.config.set_key('headers_pruned_height', height)
 
     def run(self):
         self.init_headers_file()
@@ -1086,6 +1282,7 @@ class Network(util.DaemonThread):
             self.maintain_requests()
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
+            self.maybe_prune_headers()
         self.stop_network()
         self.on_stop()
 
@@ -1127,10 +1324,13 @@ class Network(util.DaemonThread):
         with self.blockchains_lock:
             tip = max([x.height() for x in self.blockchains.values()])
         if tip >=0:
-            interface.mode = 'backward'
             interface.bad = height
             interface.bad_header = header
-            self.request_header(interface, min(tip +1, height - 1))
+            end = min(tip + 1, height - 1)
+            if end < self.max_checkpoint():
+                self.connection_down(interface.server)
+                return
+            self.request_fork_search(interface, end, self.FORK_SEARCH_WINDOW)
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
@@ -1223,9 +1423,8 @@ class Network(util.DaemonThread):
         return cb2
 
     def subscribe_to_addresses(self, addresses, callback):
-        hash2address = {
-            bitcoin.address_to_scripthash(address): address
-            for address in addresses}
+        addresses = list(addresses)
+        hash2address = dict(zip(bitcoin.addresses_to_scripthashes(addresses), addresses))
         self.h2addr.update(hash2address)
         msgs = [
             ('blockchain.scripthash.subscribe', [x])
@@ -1287,11 +1486,22 @@ class Network(util.DaemonThread):
 
         return Network.__with_default_synchronous_callback(invocation, callback)
 
-    def get_transaction(self, transaction_hash, callback=None):
+    def get_transaction(self, transaction_hash, callback=None, cache=True):
         command = 'blockchain.transaction.get'
         invocation = lambda c: self.send([(command, [transaction_hash])], c)
 
-        return Network.__with_default_synchronous_callback(invocation, callback)
+        if callback:
+            return Network.__with_default_synchronous_callback(invocation, callback)
+        raw = self.tx_cache.get(transaction_hash)
+        if raw is None:
+            raw = Network.__with_default_synchronous_callback(invocation, callback)
+            try:
+                tx = Transaction(raw)
+                if cache and tx.txid() == transaction_hash:
+                    self.tx_cache.put(tx)
+            except BaseException as e:
+                self.print_error('not caching transaction', transaction_hash, repr(e))
+        return raw
 
     def get_transactions(self, transaction_hashes, callback=None):
         command = 'blockchain.transaction.get'
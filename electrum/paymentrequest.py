@@ -23,7 +23,9 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import hashlib
+import os
 import sys
+import threading
 import time
 import traceback
 import json
@@ -523,3 +525,108 @@ class InvoiceStore(object):
 
     def unpaid_invoices(self):
         return [ self.invoices[k] for k in filter(lambda x: self.get_status(x)!=PR_PAID, self.invoices.keys())]
+
+
+class RequestStore(object):
+    '''Payment requests of a wallet, by address.  They can also be
+    looked up by id.  Serialized PaymentRequests are kept until the
+    request expires, so that they are signed only once.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.requests = self.storage.get('payment_requests', {})
+        self.ids = {}
+        for addr, req in self.requests.items():
+            self.ids[req.get('id', addr)] = addr
+        # (address, signed with x509) -> serialized PaymentRequest
+        self.serialized = {}
+        # id -> whether its bip70 file exists in requests_dir
+        self.files = {}
+
+    def save(self):
+        self.storage.put('payment_requests', self.requests)
+
+    def add(self, req):
+        addr = req['address']
+        with self.lock:
+            old = self.requests.get(addr)
+            if old:
+                self.ids.pop(old.get('id', addr), None)
+            self.requests[addr] = req
+            self.ids[req.get('id', addr)] = addr
+            self.clear_serialized(addr)
+            self.save()
+
+    def remove(self, addr):
+        with self.lock:
+            req = self.requests.pop(addr)
+            self.ids.pop(req.get('id', addr), None)
+            self.clear_serialized(addr)
+            self.save()
+        return req
+
+    def get(self, key, default=None):
+        '''key is an address or the id of a request'''
+        with self.lock:
+            req = self.requests.get(key)
+            if req is None and key in self.ids:
+                req = self.requests.get(self.ids[key])
+        return default if req is None else req
+
+    def __getitem__(self, addr):
+        return self.requests[addr]
+
+    def __contains__(self, addr):
+        return addr in self.requests
+
+    def __iter__(self):
+        return iter(list(self.requests))
+
+    def __len__(self):
+        return len(self.requests)
+
+    def keys(self):
+        return self.requests.keys()
+
+    def values(self):
+        return self.requests.values()
+
+    def items(self):
+        return self.requests.items()
+
+    def clear_serialized(self, addr):
+        for signed in (False, True):
+            self.serialized.pop((addr, signed), None)
+
+    def get_serialized(self, addr, config=None) -> bytes:
+        '''The PaymentRequest of addr.  With a config, it is signed with
+        the x509 key of the config, if any; otherwise, it carries the
+        alias signature of the request, if any.'''
+        with self.lock:
+            req = self.requests[addr]
+            key = (addr, config is not None)
+            timestamp, exp = req.get('time'), req.get('exp')
+            expires = timestamp + exp if type(timestamp) == int and type(exp) == int and exp else None
+            item = self.serialized.get(key)
+            if item and (item[1] is None or time.time() < item[1]):
+                return item[0]
+            pr = make_request(config, req) if config is not None else serialize_request(req)
+            s = pr.SerializeToString()
+            self.serialized[key] = s, expires
+            return s
+
+    def has_file(self, rdir, key):
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = os.path.exists(request_path(rdir, key))
+            return self.files[key]
+
+    def set_file(self, key, exists):
+        with self.lock:
+            self.files[key] = exists
+
+
+def request_path(rdir, key):
+    '''The directory of the bip70 files of a request'''
+    return os.path.join(rdir, 'req', key[0], key[1], key)
@@ -0,0 +1,333 @@
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Payment batching.
+#
+# Payouts are queued in the wallet file, and paid together in a single
+# transaction once the oldest one has waited long enough, or once the
+# queue holds enough outputs or value.  The daemon runs the queue as a
+# network job; the queuepayment, payoutqueue and sendpayouts commands
+# give access to it.
+#
+# A batch the servers keep rejecting is marked as failed: its local
+# transaction is removed and its payouts are queued again.  A batch
+# whose transaction disappears from the wallet, e.g. because it was
+# replaced, is marked as failed too, but its payouts are only reported,
+# as the replacement may have paid them.
+#
+# To sign batches in the background, the password given with the last
+# queued payout is kept in a keystore session, and wiped when the
+# session times out or the wallet is stopped.
+
+import sys
+import threading
+import time
+import traceback
+
+from .address_synchronizer import TX_HEIGHT_LOCAL
+from .bitcoin import TYPE_ADDRESS, sha256
+from .keystore import KeySession
+from .transaction import TxOutput
+from .util import ThreadJob, bh2u, NotEnoughFunds, NoDynamicFeeEstimates
+
+
+PAYOUT_BUILT = 'built'
+PAYOUT_BROADCAST = 'broadcast'
+PAYOUT_FAILED = 'failed'
+
+
+class PayoutQueue(ThreadJob):
+
+    # defaults, overridden by config
+    interval = 600        # seconds the oldest payout may wait
+    max_outputs = 100     # pay as soon as this many payouts are queued
+    max_value = None      # pay as soon as this much value is queued
+    broadcast_retry = 60  # seconds between broadcast attempts of a batch
+    max_broadcast_failures = 5  # rejections before a batch is failed
+    prune_confirmations = 6  # batches are forgotten once this deep
+    prune_failed = 7 * 86400  # seconds failed batches are reported
+    max_backoff = 3600    # seconds, after repeated unexpected errors
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.storage = wallet.storage
+        self.lock = threading.RLock()
+        # holds the password, to sign batches in the background
+        self.session = None
+        self.last_error = None
+        self.failures = 0
+        self.next_attempt = 0
+        self.broadcast_attempts = {}
+        self.payouts = self.storage.get('payout_queue', {})
+        self.batches = self.storage.get('payout_batches', {})
+
+    def diagnostic_name(self):
+        return self.wallet.diagnostic_name()
+
+    def save(self):
+        with self.lock:
+            self.storage.put('payout_queue', self.payouts)
+            self.storage.put('payout_batches', self.batches)
+            self.storage.write()
+
+    def add(self, address, value):
+        '''Queue a payout; returns its id.'''
+        now = int(time.time())
+        with self.lock:
+            key = bh2u(sha256('%s:%d:%d:%d' % (address, value, now, len(self.payouts))))[0:10]
+            self.payouts[key] = {
+                'address': address,
+                'value': value,
+                'time': now,
+            }
+            self.save()
+        return key
+
+    def remove(self, key):
+        with self.lock:
+            if key not in self.payouts:
+                return False
+            self.payouts.pop(key)
+            self.save()
+            return True
+
+    def set_password(self, password, timeout):
+        '''Keeps password for timeout seconds, to sign the batches that
+        become due meanwhile.'''
+        session = KeySession(password, timeout)
+        if password is not None:
+            session.put('password', password.encode('utf8'))
+        with self.lock:
+            self.clear_password()
+            self.session = session
+            # the user may have fixed what made the last batch fail
+            self.failures = 0
+            self.next_attempt = 0
+
+    def clear_password(self):
+        with self.lock:
+            if self.session:
+                self.session.wipe()
+                self.session = None
+
+    def get_password(self):
+        '''Returns (can_sign, password).'''
+        if not self.wallet.has_password():
+            return True, None
+        with self.lock:
+            session = self.session
+        if session is None or (session.expires is not None and time.time() >= session.expires):
+            self.clear_password()
+            return False, None
+        password = session.get('password')
+        if password is None:
+            return False, None
+        return True, password.decode('utf8')
+
+    def get_thresholds(self, config):
+        interval = config.get('payout_interval', self.interval)
+        max_outputs = config.get('payout_max_outputs', self.max_outputs)
+        max_value = config.get('payout_max_value', self.max_value)
+        return interval, max_outputs, max_value
+
+    def is_due(self, config, now=None):
+        now = time.time() if now is None else now
+        interval, max_outputs, max_value = self.get_thresholds(config)
+        with self.lock:
+            if not self.payouts:
+                return False
+            oldest = min(p['time'] for p in self.payouts.values())
+            total = sum(p['value'] for p in self.payouts.values())
+            return (now - oldest >= interval
+                    or len(self.payouts) >= max_outputs
+                    or (max_value is not None and total >= max_value))
+
+    def get_status(self, config):
+        interval, max_outputs, max_value = self.get_thresholds(config)
+        with self.lock:
+            queued = sorted(({'id': k, 'address': p['address'], 'value': p['value'],
+                              'time': p['time']}
+                             for k, p in self.payouts.items()),
+                            key=lambda p: p['time'])
+            batches = {txid: {'status': b['status'], 'payouts': b['payouts'],
+                              'error': b.get('error')}
+                       for txid, b in self.batches.items()}
+            next_batch = None
+            if queued:
+                next_batch = max(0, int(queued[0]['time'] + interval - time.time()))
+            return {
+                'queued': queued,
+                'count': len(queued),
+                'total': sum(p['value'] for p in queued),
+                'next_batch_in': next_batch,
+                'max_outputs': max_outputs,
+                'max_value': max_value,
+                'batches': batches,
+                'can_sign': self.get_password()[0],
+                'last_error': self.last_error,
+            }
+
+    def make_tx(self, config, password):
+        '''Build and sign one transaction paying everything in the queue.
+        The payouts move from the queue to the list of batches, and the
+        transaction is added to the wallet so that later batches do not
+        spend the same coins.'''
+        with self.lock:
+            if not self.payouts:
+                return
+            keys = sorted(self.payouts, key=lambda k: self.payouts[k]['time'])
+            outputs = [TxOutput(TYPE_ADDRESS, self.payouts[k]['address'], self.payouts[k]['value'])
+                       for k in keys]
+            coins = self.wallet.get_spendable_coins(None, config)
+            tx = self.wallet.make_unsigned_transaction(coins, outputs, config)
+            if config.get('use_rbf', True):
+                tx.set_rbf(True)
+            self.wallet.sign_transaction(tx, password)
+            if not tx.is_complete():
+                raise Exception('payout batch could not be signed')
+            txid = tx.txid()
+            if not self.wallet.add_transaction(txid, tx):
+                raise Exception('payout batch conflicts with wallet history')
+            self.wallet.save_transactions()
+            payouts = {k: self.payouts.pop(k) for k in keys}
+            self.batches[txid] = {
+                'payouts': keys,
+                'outputs': payouts,
+                'status': PAYOUT_BUILT,
+                'time': int(time.time()),
+                'failures': 0,
+            }
+            self.save()
+            self.print_error('built payout batch', txid, 'with', len(keys), 'outputs')
+            return tx
+
+    def on_broadcast(self, txid, ok, msg=None):
+        with self.lock:
+            batch = self.batches.get(txid)
+            if batch is None or batch['status'] != PAYOUT_BUILT:
+                return
+            if ok or self.wallet.get_tx_height(txid).height != TX_HEIGHT_LOCAL:
+                # a server that already has the transaction may reject it
+                batch['status'] = PAYOUT_BROADCAST
+                self.save()
+                return
+            self.last_error = msg
+            self.print_error('payout batch broadcast failed', txid, msg)
+            batch['failures'] = batch.get('failures', 0) + 1
+            if batch['failures'] >= self.max_broadcast_failures:
+                self.fail_batch(txid, 'rejected: %s' % msg, requeue=True)
+            else:
+                self.save()
+
+    def fail_batch(self, txid, error, requeue):
+        '''Marks a batch as failed.  With requeue, its local transaction
+        is removed from the wallet, and its payouts are queued again.'''
+        with self.lock:
+            batch = self.batches[txid]
+            batch['status'] = PAYOUT_FAILED
+            batch['error'] = error
+            batch['time'] = int(time.time())
+            self.broadcast_attempts.pop(txid, None)
+            outputs = batch.get('outputs')
+            if requeue and outputs:
+                if txid in self.wallet.transactions:
+                    self.wallet.remove_transaction(txid)
+                    self.wallet.save_transactions()
+                self.payouts.update(outputs)
+                batch['requeued'] = True
+            self.save()
+            self.print_error('payout batch failed', txid, error)
+
+    def prune(self):
+        '''Updates the status of the batches from the wallet history, and
+        forgets the ones that are deep enough in the chain, or that
+        failed long ago.'''
+        now = time.time()
+        with self.lock:
+            done = []
+            changed = False
+            for txid, b in list(self.batches.items()):
+                if b['status'] == PAYOUT_FAILED:
+                    if now - b['time'] > self.prune_failed:
+                        done.append(txid)
+                    continue
+                if txid not in self.wallet.transactions:
+                    # replaced or removed; the replacement may pay them
+                    self.fail_batch(txid, 'transaction removed from wallet', requeue=False)
+                    continue
+                tx_mined_status = self.wallet.get_tx_height(txid)
+                if tx_mined_status.height > 0:
+                    # mined, even if we never heard of its broadcast
+                    if b['status'] != PAYOUT_BROADCAST:
+                        b['status'] = PAYOUT_BROADCAST
+                        changed = True
+                    if tx_mined_status.conf >= self.prune_confirmations:
+                        done.append(txid)
+            for txid in done:
+                self.batches.pop(txid)
+                self.broadcast_attempts.pop(txid, None)
+            if done or changed:
+                self.save()
+
+    def get_unbroadcast(self):
+        with self.lock:
+            txids = [txid for txid, b in self.batches.items() if b['status'] == PAYOUT_BUILT]
+        return [self.wallet.transactions[txid] for txid in txids
+                if txid in self.wallet.transactions]
+
+    def run(self):
+        '''Called from the network thread; builds a batch when one is due,
+        and (re)broadcasts built batches.'''
+        network = self.wallet.network
+        if network is None or not network.is_connected():
+            return
+        config = network.config
+        now = time.time()
+        can_sign, password = self.get_password()
+        if can_sign and now >= self.next_attempt and self.is_due(config):
+            try:
+                self.make_tx(config, password)
+                self.last_error = None
+                self.failures = 0
+            except (NotEnoughFunds, NoDynamicFeeEstimates) as e:
+                # keep the payouts queued; try again next time
+                self.last_error = str(e)
+            except Exception as e:
+                # keep the payouts queued, and do not retry at once
+                self.failures += 1
+                if self.failures == 1:
+                    traceback.print_exc(file=sys.stderr)
+                delay = min(self.max_backoff, self.broadcast_retry * 2 ** (self.failures - 1))
+                self.next_attempt = now + delay
+                self.last_error = repr(e)
+                self.print_error('payout batch failed, retrying in %d seconds' % delay)
+        self.prune()
+        for tx in self.get_unbroadcast():
+            txid = tx.txid()
+            if now - self.broadcast_attempts.get(txid, 0) < self.broadcast_retry:
+                continue
+            self.broadcast_attempts[txid] = now
+            def callback(response, txid=txid):
+                error = response.get('error')
+                self.on_broadcast(txid, error is None, error)
+            # do not block the network thread
+            network.broadcast_transaction(tx, callback)
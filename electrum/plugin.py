@@ -23,6 +23,9 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from collections import namedtuple
+import ast
+import importlib
+import importlib.util
 import traceback
 import sys
 import os
@@ -41,6 +44,54 @@ hook_names = set()
 hooks = {}
 
 
+if sys.version_info >= (3, 8):
+    _literal_nodes = (ast.Constant,)
+else:
+    _literal_nodes = (ast.Str, ast.Num, ast.NameConstant)
+
+
+def _eval_manifest_value(node):
+    if isinstance(node, _literal_nodes):
+        return ast.literal_eval(node)
+    if isinstance(node, ast.List):
+        return [_eval_manifest_value(x) for x in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_eval_manifest_value(x) for x in node.elts)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mod)):
+        left = _eval_manifest_value(node.left)
+        right = _eval_manifest_value(node.right)
+        return left + right if isinstance(node.op, ast.Add) else left % right
+    if isinstance(node, ast.Call) and len(node.args) == 1 and not node.keywords:
+        arg = _eval_manifest_value(node.args[0])
+        if isinstance(node.func, ast.Name) and node.func.id == '_':
+            return _(arg)
+        if isinstance(node.func, ast.Attribute) and node.func.attr == 'join':
+            separator = _eval_manifest_value(node.func.value)
+            if isinstance(separator, str):
+                return separator.join(arg)
+    raise ValueError('not a manifest value')
+
+
+def read_manifest(path):
+    '''Reads the module level constants of a plugin's __init__.py
+    without importing it.  Values must be literals, translated strings,
+    or joins and concatenations of them; other statements are ignored.'''
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    d = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        try:
+            value = _eval_manifest_value(node.value)
+        except ValueError:
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                d[target.id] = value
+    return d
+
+
 class Plugins(DaemonThread):
     verbosity_filter = 'p'
 
@@ -58,11 +109,28 @@ class Plugins(DaemonThread):
         self.add_jobs(self.device_manager.thread_jobs())
         self.start()
 
+    def get_manifest(self, name):
+        '''The metadata of a plugin, read from its sources if we can,
+        so that plugins are only imported when they are used.'''
+        full_name = 'electrum.plugins.' + name
+        path = os.path.join(self.pkgpath, name, '__init__.py')
+        if os.path.exists(path):
+            try:
+                d = read_manifest(path)
+            except BaseException as e:
+                self.print_error('cannot read manifest of', name, repr(e))
+            else:
+                d['__name__'] = full_name
+                return d
+        # no sources, e.g. in frozen builds
+        return importlib.import_module(full_name).__dict__
+
+    @profiler
     def load_plugins(self):
         for loader, name, ispkg in pkgutil.iter_modules([self.pkgpath]):
-            mod = pkgutil.find_loader('electrum.plugins.' + name)
-            m = mod.load_module()
-            d = m.__dict__
+            if not ispkg:
+                continue
+            d = self.get_manifest(name)
             gui_good = self.gui_name in d.get('available_for', [])
             if not gui_good:
                 continue
@@ -90,11 +158,10 @@ class Plugins(DaemonThread):
         if name in self.plugins:
             return self.plugins[name]
         full_name = 'electrum.plugins.' + name + '.' + self.gui_name
-        loader = pkgutil.find_loader(full_name)
-        if not loader:
+        if not importlib.util.find_spec(full_name):
             raise RuntimeError("%s implementation for %s plugin not found"
                                % (self.gui_name, name))
-        p = loader.load_module()
+        p = importlib.import_module(full_name)
         plugin = p.Plugin(self, self.config, name)
         self.add_jobs(plugin.thread_jobs())
         self.plugins[name] = plugin
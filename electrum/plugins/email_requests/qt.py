@@ -175,20 +175,16 @@ class Plugin(BasePlugin):
         menu.addAction(_("Send via e-mail"), lambda: self.send(window, addr))
 
     def send(self, window, addr):
-        from electrum import paymentrequest
         r = window.wallet.receive_requests.get(addr)
         message = r.get('memo', '')
         if r.get('signature'):
-            pr = paymentrequest.serialize_request(r)
+            payload = window.wallet.receive_requests.get_serialized(addr)
         else:
-            pr = paymentrequest.make_request(self.config, r)
-        if not pr:
-            return
+            payload = window.wallet.receive_requests.get_serialized(addr, self.config)
         recipient, ok = QInputDialog.getText(window, 'Send request', 'Email invoice to:')
         if not ok:
             return
         recipient = str(recipient)
-        payload = pr.SerializeToString()
         self.print_error('sending mail to', recipient)
         try:
             # FIXME this runs in the GUI thread and blocks it...
@@ -0,0 +1,163 @@
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Wallet job scheduling.
+#
+# The network thread runs its jobs one after the other, so with many
+# wallets loaded in the daemon a single slow wallet delays all the
+# others.  The scheduler runs the jobs of each wallet on a pool of
+# worker threads instead.  It is itself a network job: every tick it
+# queues each wallet whose previous run has finished.  A wallet never
+# runs on two workers at once, and never runs twice while another
+# wallet is waiting.
+
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from .util import ThreadJob
+
+
+class JobStats:
+
+    def __init__(self):
+        self.runs = 0
+        self.last = 0.
+        self.total = 0.
+        self.max = 0.
+        self.wait = 0.
+        self.overruns = 0
+
+    def add(self, wait, duration, overrun):
+        self.runs += 1
+        self.last = duration
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.wait = wait
+        if overrun:
+            self.overruns += 1
+
+    def as_dict(self):
+        return {
+            'runs': self.runs,
+            'last_ms': round(self.last * 1000, 1),
+            'avg_ms': round(self.total / self.runs * 1000, 1) if self.runs else 0.,
+            'max_ms': round(self.max * 1000, 1),
+            'queue_ms': round(self.wait * 1000, 1),
+            'overruns': self.overruns,
+        }
+
+
+class WalletScheduler(ThreadJob):
+
+    num_workers = 4
+    deadline = 1.0  # seconds between queueing and completing a run
+
+    def __init__(self, config):
+        self.num_workers = max(1, config.get('wallet_workers', self.num_workers))
+        self.deadline = config.get('wallet_job_deadline', self.deadline)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.groups = OrderedDict()  # key -> list of jobs
+        self.stats = {}              # key -> JobStats
+        self.pending = set()         # keys queued or running
+        self.running = set()         # keys running
+        self.queue = queue.Queue()
+        self.workers = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self.work, name='wallet-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def stop(self):
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def add_jobs(self, key, jobs):
+        with self.lock:
+            self.groups.setdefault(key, []).extend(jobs)
+            self.stats.setdefault(key, JobStats())
+
+    def remove_jobs(self, key, jobs):
+        '''Waits for a running batch of the wallet to finish, so that
+        the jobs are not used once this returns.'''
+        with self.cond:
+            while key in self.running:
+                self.cond.wait()
+            group = self.groups.get(key, [])
+            for job in jobs:
+                group.remove(job)
+            if not group:
+                self.groups.pop(key, None)
+                self.stats.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {key: stats.as_dict() for key, stats in self.stats.items()}
+
+    def run(self):
+        '''Called from the network thread; queues every idle wallet.'''
+        now = time.time()
+        with self.lock:
+            for key in self.groups:
+                if key not in self.pending:
+                    self.pending.add(key)
+                    self.queue.put((key, now))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, queued = item
+            with self.lock:
+                jobs = list(self.groups.get(key, []))
+                self.running.add(key)
+            start = time.time()
+            for job in jobs:
+                # as in DaemonThread.run_jobs, a failing job must not
+                # disrupt the other jobs
+                try:
+                    job.run()
+                except Exception as e:
+                    traceback.print_exc(file=sys.stderr)
+            end = time.time()
+            overrun = end - queued > self.deadline
+            if overrun:
+                self.print_error('wallet jobs missed deadline', key,
+                                 '%.3fs' % (end - queued))
+            with self.cond:
+                stats = self.stats.get(key)
+                if stats and jobs:
+                    stats.add(start - queued, end - start, overrun)
+                self.running.discard(key)
+                self.pending.discard(key)
+                self.cond.notify_all()
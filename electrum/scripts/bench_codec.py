@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Times the base58 codec against the digit by digit conversion of
+# earlier versions, on xpub-sized values, and the parsing of an xpub
+# with and without the cache.
+#
+# usage: python3 -m electrum.scripts.bench_codec [iterations]
+
+import random
+import sys
+import timeit
+
+from electrum import constants
+from electrum.bitcoin import (base_encode, base_decode, bip32_root,
+                              deserialize_xpub, _deserialize_xkey)
+from electrum.util import print_msg
+
+
+B58_CHARS = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B43_CHARS = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
+
+
+def reference_base_encode(v, chars):
+    '''the digit by digit conversion of earlier versions'''
+    long_value = 0
+    for (i, c) in enumerate(v[::-1]):
+        long_value += (256**i) * c
+    result = bytearray()
+    while long_value >= len(chars):
+        long_value, mod = divmod(long_value, len(chars))
+        result.append(chars[mod])
+    result.append(chars[long_value])
+    for c in v:
+        if c != 0:
+            break
+        result.append(chars[0])
+    result.reverse()
+    return result.decode('ascii')
+
+
+def run_benchmark(n=1000):
+    '''Returns a list of (name, microseconds per call).'''
+    rnd = random.Random('bench_codec')
+    value = bytes(rnd.getrandbits(8) for i in range(82))
+    encoded = base_encode(value, 58)
+    xprv, xpub = bip32_root(bytes(rnd.getrandbits(8) for i in range(32)), 'standard')
+    tests = [
+        ('base58 encode (reference)', lambda: reference_base_encode(value, B58_CHARS)),
+        ('base58 encode', lambda: base_encode(value, 58)),
+        ('base58 decode', lambda: base_decode(encoded, None, 58)),
+        ('xpub parse (uncached)', lambda: _deserialize_xkey(xpub, False, constants.net)),
+        ('xpub parse (cached)', lambda: deserialize_xpub(xpub)),
+    ]
+    return [(name, timeit.timeit(f, number=n) / n * 1e6) for name, f in tests]
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, us in run_benchmark(n):
+        print_msg('%-28s %9.1f us' % (name, us))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Compares the coin choosers on synthetic UTXO sets.
+# For each set size and chooser, prints the fee paid, the waste,
+# the number of change outputs and the selection runtime.
+#
+# usage: python3 -m electrum.scripts.bench_coinchooser [num_coins ...]
+
+import itertools
+import sys
+import time
+
+from electrum import coinchooser
+from electrum.bitcoin import COIN, TYPE_ADDRESS, hash_to_segwit_addr, sha256
+from electrum.coinchooser import PRNG
+from electrum.transaction import Transaction, TxOutput
+from electrum.util import print_msg, NotEnoughFunds
+
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_FEE_RATES = [1, 10]  # sat/vbyte used to build the transactions
+LONG_TERM_RATE = 5           # sat/vbyte expected when spending change later
+DUST_THRESHOLD = 546
+
+
+def make_address(i):
+    return hash_to_segwit_addr(sha256('bench address %d' % i)[:20], witver=0)
+
+
+def make_coins(num_coins, num_addresses=None, seed='bench'):
+    '''Deterministic set of p2wpkh coins with values spread over
+    several orders of magnitude, as found in merchant wallets.'''
+    p = PRNG(seed + str(num_coins))
+    num_addresses = num_addresses or max(1, num_coins // 2)
+    addresses = [make_address(i) for i in range(num_addresses)]
+    coins = []
+    for i in range(num_coins):
+        magnitude = p.randint(3, 8)
+        value = p.randint(1, 10) * 10 ** magnitude + p.randint(0, 10 ** magnitude)
+        coins.append({
+            'address': addresses[p.randint(0, num_addresses)],
+            'type': 'p2wpkh',
+            'prevout_hash': sha256('bench coin %d' % i).hex(),
+            'prevout_n': 0,
+            'value': value,
+            'height': p.randint(1, 500000),
+            'num_sig': 1,
+            'signatures': [None],
+            'x_pubkeys': ['02' + '00' * 32],
+            'pubkeys': ['02' + '00' * 32],
+        })
+    return coins
+
+
+def make_outputs(num_coins, count=1, seed='bench'):
+    p = PRNG(seed + 'outputs' + str(num_coins))
+    return [TxOutput(TYPE_ADDRESS, make_address(10 ** 7 + i),
+                     p.randint(COIN // 100, COIN // 2))
+            for i in range(count)]
+
+
+def tx_stats(tx, change_addrs, fee_rate):
+    '''Returns fee, waste and number of change outputs.
+    Waste counts the fee paid above the long-term rate for the inputs,
+    plus either the cost of the change output or the excess dropped to fees.'''
+    fee = tx.get_fee()
+    num_change = len([o for o in tx.outputs() if o.address in change_addrs])
+    required = fee_rate * tx.estimated_size()
+    inputs_vsize = sum(Transaction.virtual_size_from_weight(
+        Transaction.estimated_input_weight(txin, True)) for txin in tx.inputs())
+    waste = (fee_rate - LONG_TERM_RATE) * inputs_vsize
+    if num_change:
+        change_input_vsize = 68
+        waste += sum(fee_rate * Transaction.estimated_output_size(addr)
+                     + LONG_TERM_RATE * change_input_vsize
+                     for addr in change_addrs[:num_change])
+    else:
+        waste += fee - required
+    return fee, waste, num_change
+
+
+def run_benchmark(sizes=None, fee_rates=None, chooser_names=None):
+    '''Returns a list of result dicts, one per (size, fee rate, chooser).'''
+    sizes = sizes or DEFAULT_SIZES
+    fee_rates = fee_rates or DEFAULT_FEE_RATES
+    chooser_names = chooser_names or sorted(coinchooser.COIN_CHOOSERS)
+    results = []
+    for num_coins, fee_rate in itertools.product(sizes, fee_rates):
+        coins = make_coins(num_coins)
+        outputs = make_outputs(num_coins)
+        change_addrs = [make_address(10 ** 8)]
+        fee_estimator = lambda size: fee_rate * size
+        for name in chooser_names:
+            chooser = coinchooser.COIN_CHOOSERS[name]()
+            t0 = time.monotonic()
+            try:
+                tx = chooser.make_tx(coins, outputs, change_addrs,
+                                     fee_estimator, DUST_THRESHOLD)
+            except NotEnoughFunds:
+                continue
+            runtime = time.monotonic() - t0
+            fee, waste, num_change = tx_stats(tx, change_addrs, fee_rate)
+            results.append({
+                'coins': num_coins,
+                'fee_rate': fee_rate,
+                'chooser': name,
+                'inputs': len(tx.inputs()),
+                'fee': fee,
+                'waste': waste,
+                'change': num_change,
+                'runtime': runtime,
+            })
+    return results
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or None
+    print_msg('%8s %8s %-16s %6s %8s %8s %6s %9s' % (
+        'coins', 'sat/vB', 'chooser', 'inputs', 'fee', 'waste', 'change', 'time (s)'))
+    for r in run_benchmark(sizes):
+        print_msg('%(coins)8d %(fee_rate)8d %(chooser)-16s %(inputs)6d %(fee)8d '
+                  '%(waste)8d %(change)6d %(runtime)9.3f' % r)
@@ -36,6 +36,7 @@ from collections import defaultdict
 
 from . import util, bitcoin, ecc
 from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh
+from .crypto import aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot
 from .plugin import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 
@@ -67,6 +68,63 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# magic bytes of encrypted files, for each encryption version:
+# a single ECIES message, or the segmented format
+ENCRYPTION_MAGIC = {STO_EV_USER_PW: b'BIE1', STO_EV_XPUB_PW: b'BIE2'}
+SEGMENTED_MAGIC = {STO_EV_USER_PW: b'BIS1', STO_EV_XPUB_PW: b'BIS2'}
+
+# dicts with more items than this are split over several segments
+SEGMENT_ITEMS = 1000
+
+
+class SegmentKeys:
+    '''Keys of the segmented format.  The key of a file is agreed
+    between an ephemeral key, whose public key is in the header, and
+    the key derived from the password.  It is kept for the session,
+    so that writing needs neither the password nor an EC operation.'''
+
+    def __init__(self, magic, ephemeral_pubkey: bytes, shared_secret: bytes, pubkey: bytes):
+        self.header = magic + ephemeral_pubkey
+        self.pubkey = pubkey
+        key = hashlib.sha512(shared_secret).digest()
+        self.key_e, self.key_m = key[0:32], key[32:64]
+        # sha256 of a plaintext segment -> its line in the file
+        self.lines = {}
+
+    @classmethod
+    def for_writing(cls, magic, pubkey: bytes):
+        ephemeral = ecc.ECPrivkey.from_arbitrary_size_secret(os.urandom(32))
+        shared_secret = (ecc.ECPubkey(pubkey) * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
+        return cls(magic, ephemeral.get_public_key_bytes(compressed=True), shared_secret, pubkey)
+
+    @classmethod
+    def for_reading(cls, header: bytes, ec_key):
+        try:
+            ephemeral = ecc.ECPubkey(header[4:])
+        except Exception as e:
+            raise WalletFileException('invalid header') from e
+        shared_secret = (ephemeral * ec_key.secret_scalar).get_public_key_bytes(compressed=True)
+        return cls(header[0:4], header[4:], shared_secret, ec_key.get_public_key_bytes())
+
+    def mac(self, data: bytes) -> bytes:
+        return hmac_oneshot(self.key_m, data, hashlib.sha256)
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        iv = os.urandom(16)
+        ciphertext = iv + aes_encrypt_with_iv(self.key_e, iv, zlib.compress(plaintext))
+        return ciphertext + self.mac(ciphertext)
+
+    def decrypt(self, segment: bytes) -> bytes:
+        ciphertext, mac = segment[:-32], segment[-32:]
+        if len(ciphertext) < 16 or not hmac.compare_digest(mac, self.mac(ciphertext)):
+            raise InvalidPassword()
+        return zlib.decompress(aes_decrypt_with_iv(self.key_e, ciphertext[:16], ciphertext[16:]))
+
+    def seal(self, segments) -> bytes:
+        '''MAC of the whole file, so that segments cannot be dropped
+        or reordered.'''
+        return self.mac(self.header + b''.join(segment[-32:] for segment in segments))
+
 
 class JsonDB(PrintError):
 
@@ -112,8 +170,7 @@ class JsonDB(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
-        s = self.encrypt_before_writing(s)
+        s = self.dump()
 
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -132,6 +189,10 @@ class JsonDB(PrintError):
         self.print_error("saved", self.path)
         self.modified = False
 
+    def dump(self) -> str:
+        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
+        return self.encrypt_before_writing(s)
+
     def encrypt_before_writing(self, plaintext: str) -> str:
         return plaintext
 
@@ -146,6 +207,12 @@ class WalletStorage(JsonDB):
         JsonDB.__init__(self, path)
         self.manual_upgrades = manual_upgrades
         self.pubkey = None
+        self.segment_keys = None
+        # the segmented format is opt-in, as older versions cannot read it
+        self.segmented = False
+        # salted hash of the current password, whose public key is self.pubkey
+        self.password_salt = os.urandom(16)
+        self.password_digest = None
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
@@ -175,7 +242,9 @@ class WalletStorage(JsonDB):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        self.on_data_loaded()
 
+    def on_data_loaded(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -219,42 +288,139 @@ class WalletStorage(JsonDB):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
-            if magic == b'BIE1':
-                return STO_EV_USER_PW
-            elif magic == b'BIE2':
-                return STO_EV_XPUB_PW
-            else:
-                return STO_EV_PLAINTEXT
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
+            for version in (STO_EV_USER_PW, STO_EV_XPUB_PW):
+                if magic in (ENCRYPTION_MAGIC[version], SEGMENTED_MAGIC[version]):
+                    return version
+            return STO_EV_PLAINTEXT
         except:
             return STO_EV_PLAINTEXT
 
+    def is_segmented(self):
+        return self.raw.startswith(base64.b64encode(b'BIS')[0:4].decode('ascii'))
+
     @staticmethod
     def get_eckey_from_password(password):
         secret = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), b'', iterations=1024)
         ec_key = ecc.ECPrivkey.from_arbitrary_size_secret(secret)
         return ec_key
 
-    def _get_encryption_magic(self):
+    def _get_password_digest(self, password):
+        return hmac_oneshot(self.password_salt, password.encode('utf-8'), hashlib.sha256)
+
+    def get_pubkey_from_password(self, password):
+        '''get_eckey_from_password(password).get_public_key_hex(),
+        computed once for the current password.'''
+        digest = self._get_password_digest(password)
+        if self.password_digest is not None and hmac.compare_digest(digest, self.password_digest):
+            return self.pubkey
+        pubkey = self.get_eckey_from_password(password).get_public_key_hex()
+        if self.pubkey and pubkey == self.pubkey:
+            self.password_digest = digest
+        return pubkey
+
+    def forget_password(self):
+        '''Drops the cached hash of the password.'''
+        self.password_digest = None
+
+    def set_segmented(self, enable):
+        '''Whether the file is written in the segmented format once
+        encrypted.  Files that were read in that format keep it.'''
+        self.segmented = enable
+
+    def _get_encryption_magic(self, segmented=False):
         v = self._encryption_version
-        if v == STO_EV_USER_PW:
-            return b'BIE1'
-        elif v == STO_EV_XPUB_PW:
-            return b'BIE2'
-        else:
+        magics = SEGMENTED_MAGIC if segmented else ENCRYPTION_MAGIC
+        if v not in magics:
             raise WalletFileException('no encryption magic for version: %s' % v)
+        return magics[v]
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
+        if self.raw and self.is_segmented():
+            self.pubkey = ec_key.get_public_key_hex()
+            self.data = self.decrypt_segments(ec_key)
+            self.segmented = True
+            self.password_digest = self._get_password_digest(password)
+            self.on_data_loaded()
+            return
         if self.raw:
             enc_magic = self._get_encryption_magic()
             s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
         else:
             s = None
         self.pubkey = ec_key.get_public_key_hex()
+        self.password_digest = self._get_password_digest(password)
         s = s.decode('utf8')
         self.load_data(s)
 
+    def decrypt_segments(self, ec_key):
+        try:
+            lines = [base64.b64decode(line) for line in self.raw.split()]
+        except Exception as e:
+            raise WalletFileException('Cannot read wallet file') from e
+        if len(lines) < 2:
+            raise WalletFileException('Cannot read wallet file')
+        header, segments, seal = lines[0], lines[1:-1], lines[-1]
+        if header[0:4] != self._get_encryption_magic(segmented=True):
+            raise InvalidPassword()
+        keys = SegmentKeys.for_reading(header, ec_key)
+        if not hmac.compare_digest(seal, keys.seal(segments)):
+            raise InvalidPassword()
+        data = {}
+        for segment in segments:
+            plaintext = keys.decrypt(segment)
+            key, value, is_part = json.loads(plaintext.decode('utf8'))
+            if is_part:
+                data.setdefault(key, {}).update(value)
+            else:
+                data[key] = value
+            keys.lines[hashlib.sha256(plaintext).digest()] = segment
+        self.segment_keys = keys
+        return data
+
+    def iter_segments(self):
+        '''The plaintext segments of the data: one for each key, and
+        large dicts split over buckets of their keys, so that a change
+        only affects the segment of the key that was changed.'''
+        for key in sorted(self.data):
+            value = self.data[key]
+            if isinstance(value, dict) and len(value) > SEGMENT_ITEMS:
+                n = 2
+                while n * SEGMENT_ITEMS < len(value):
+                    n *= 2
+                buckets = [{} for i in range(n)]
+                for k, v in value.items():
+                    buckets[zlib.crc32(str(k).encode('utf8')) % n][k] = v
+                parts = [(bucket, True) for bucket in buckets]
+            else:
+                parts = [(value, False)]
+            for part, is_part in parts:
+                yield json.dumps([key, part, is_part], sort_keys=True, cls=util.MyEncoder).encode('utf8')
+
+    def encrypt_segments(self) -> str:
+        magic = self._get_encryption_magic(segmented=True)
+        pubkey = bfh(self.pubkey)
+        keys = self.segment_keys
+        if keys is None or keys.header[0:4] != magic or keys.pubkey != pubkey:
+            keys = self.segment_keys = SegmentKeys.for_writing(magic, pubkey)
+        lines = {}
+        segments = []
+        for plaintext in self.iter_segments():
+            digest = hashlib.sha256(plaintext).digest()
+            segment = keys.lines.get(digest) or keys.encrypt(plaintext)
+            lines[digest] = segment
+            segments.append(segment)
+        # forget the segments that are not in the file anymore
+        keys.lines = lines
+        out = [keys.header] + segments + [keys.seal(segments)]
+        return '\n'.join(base64.b64encode(line).decode('ascii') for line in out) + '\n'
+
+    def dump(self) -> str:
+        if self.pubkey and self.segmented:
+            return self.encrypt_segments()
+        return JsonDB.dump(self)
+
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
         if self.pubkey:
@@ -270,7 +436,7 @@ class WalletStorage(JsonDB):
         """Raises an InvalidPassword exception on invalid password"""
         if not self.is_encrypted():
             return
-        if self.pubkey and self.pubkey != self.get_eckey_from_password(password).get_public_key_hex():
+        if self.pubkey and self.pubkey != self.get_pubkey_from_password(password):
             raise InvalidPassword()
 
     def set_keystore_encryption(self, enable):
@@ -280,9 +446,10 @@ class WalletStorage(JsonDB):
         """Set a password to be used for encrypting this storage."""
         if enc_version is None:
             enc_version = self._encryption_version
+        self.forget_password()
         if password and enc_version != STO_EV_PLAINTEXT:
-            ec_key = self.get_eckey_from_password(password)
-            self.pubkey = ec_key.get_public_key_hex()
+            self.pubkey = self.get_pubkey_from_password(password)
+            self.password_digest = self._get_password_digest(password)
             self._encryption_version = enc_version
         else:
             self.pubkey = None
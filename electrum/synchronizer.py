@@ -39,6 +39,11 @@ class Synchronizer(ThreadJob):
     data of any transactions the wallet doesn't have.
 
     External interface: __init__() and add() member functions.
+
+    run() may be called from a wallet worker of the daemon's scheduler
+    while the network callbacks run on the network thread, so the
+    request sets are only accessed with self.lock held.  The lock is
+    never held while calling into the network.
     '''
 
     def __init__(self, wallet, network):
@@ -61,8 +66,9 @@ class Synchronizer(ThreadJob):
         return response['params'], response['result']
 
     def is_up_to_date(self):
-        return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+        with self.lock:
+            return (not self.requested_tx and not self.requested_histories
+                    and not self.requested_addrs and not self.new_addresses)
 
     def release(self):
         self.network.unsubscribe(self.on_address_status)
@@ -74,7 +80,8 @@ class Synchronizer(ThreadJob):
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
-            self.requested_addrs |= addresses
+            with self.lock:
+                self.requested_addrs |= addresses
             self.network.subscribe_to_addresses(addresses, self.on_address_status)
 
     def get_status(self, h):
@@ -93,16 +100,20 @@ class Synchronizer(ThreadJob):
             return
         addr = params[0]
         history = self.wallet.history.get(addr, [])
-        if self.get_status(history) != result:
-            # note that at this point 'result' can be None;
-            # if we had a history for addr but now the server is telling us
-            # there is no history
-            if addr not in self.requested_histories:
-                self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
-        # remove addr from list only after it is added to requested_histories
-        if addr in self.requested_addrs:  # Notifications won't be in
-            self.requested_addrs.remove(addr)
+        request = False
+        with self.lock:
+            if self.get_status(history) != result:
+                # note that at this point 'result' can be None;
+                # if we had a history for addr but now the server is telling us
+                # there is no history
+                if addr not in self.requested_histories:
+                    self.requested_histories[addr] = result
+                    request = True
+            # remove addr from list only after it is added to requested_histories;
+            # is_up_to_date takes the lock too, so it never sees addr in neither
+            self.requested_addrs.discard(addr)  # Notifications won't be in
+        if request:
+            self.network.request_address_history(addr, self.on_address_history)
 
     def on_address_history(self, response):
         if self.wallet.synchronizer is None and self.initialized:
@@ -112,7 +123,8 @@ class Synchronizer(ThreadJob):
             return
         addr = params[0]
         try:
-            server_status = self.requested_histories[addr]
+            with self.lock:
+                server_status = self.requested_histories[addr]
         except KeyError:
             # note: server_status can be None even if we asked for the history,
             # so it is not sufficient to test that
@@ -136,7 +148,8 @@ class Synchronizer(ThreadJob):
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
-        self.requested_histories.pop(addr)
+        with self.lock:
+            self.requested_histories.pop(addr, None)
 
     def on_tx_response(self, response):
         if self.wallet.synchronizer is None and self.initialized:
@@ -155,27 +168,45 @@ class Synchronizer(ThreadJob):
             self.print_error("received tx does not match expected txid ({} != {})"
                              .format(tx_hash, tx.txid()))
             return
-        tx_height = self.requested_tx.pop(tx_hash)
+        with self.lock:
+            tx_height = self.requested_tx.pop(tx_hash)
+        if self.wallet.use_shared_caches():
+            self.network.tx_cache.put(tx)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
         self.network.trigger_callback('new_transaction', tx)
-        if not self.requested_tx:
+        with self.lock:
+            done = not self.requested_tx
+        if done:
             self.network.trigger_callback('updated')
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         transaction_hashes = []
-        for tx_hash, tx_height in hist:
-            if tx_hash in self.requested_tx:
-                continue
-            if tx_hash in self.wallet.transactions:
-                continue
-            transaction_hashes.append(tx_hash)
-            self.requested_tx[tx_hash] = tx_height
-
-        self.network.get_transactions(transaction_hashes, self.on_tx_response)
+        cached = []
+        missing = []
+        with self.lock:
+            for tx_hash, tx_height in hist:
+                if tx_hash in self.requested_tx:
+                    continue
+                if tx_hash in self.wallet.transactions:
+                    continue
+                self.requested_tx[tx_hash] = tx_height
+                missing.append(tx_hash)
+        for tx_hash in missing:
+            # another wallet may have downloaded it already
+            raw = self.network.tx_cache.get(tx_hash)
+            if raw:
+                cached.append({'params': [tx_hash], 'result': raw})
+            else:
+                transaction_hashes.append(tx_hash)
+
+        for response in cached:
+            self.on_tx_response(response)
+        if transaction_hashes:
+            self.network.get_transactions(transaction_hashes, self.on_tx_response)
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
@@ -190,8 +221,10 @@ class Synchronizer(ThreadJob):
                 continue
             self.request_missing_txs(history)
 
-        if self.requested_tx:
-            self.print_error("missing tx", self.requested_tx)
+        with self.lock:
+            missing = dict(self.requested_tx)
+        if missing:
+            self.print_error("missing tx", missing)
         self.subscribe_to_addresses(set(self.wallet.get_addresses()))
         self.initialized = True
 
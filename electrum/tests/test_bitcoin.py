@@ -1,4 +1,5 @@
 import base64
+import random
 import unittest
 import sys
 
@@ -11,13 +12,15 @@ from electrum.bitcoin import (
     deserialize_privkey, serialize_privkey, is_segwit_address,
     is_b58_address, address_to_scripthash, is_minikey, is_compressed, is_xpub,
     xpub_type, is_xprv, is_bip32_derivation, seed_type, EncodeBase58Check,
+    base_encode, base_decode, deserialize_xpub, addresses_to_scripts, addresses_to_scripthashes,
     script_num_to_hex, push_script, add_number_to_script, int_to_hex, convert_bip32_path_to_list_of_uint32)
 from electrum import ecc, crypto, constants
 from electrum.ecc import number_to_string, string_to_number
 from electrum.transaction import opcodes
-from electrum.util import bfh, bh2u
+from electrum.util import bfh, bh2u, BitcoinException
 from electrum.storage import WalletStorage
 from electrum.keystore import xtype_from_derivation
+from electrum.scripts.bench_codec import reference_base_encode, B58_CHARS, B43_CHARS
 
 from electrum import ecc_fast
 
@@ -214,6 +217,21 @@ class Test_bitcoin(SequentialTestCase):
         sig2 = eckey2.sign_transaction(bfh('642a2e66332f507c92bda910158dfe46fc10afbf72218764899d3af99a043fac'))
         self.assertEqual(bfh('30440220618513f4cfc87dde798ce5febae7634c23e7b9254a1eabf486be820f6a7c2c4702204fef459393a2b931f949e63ced06888f35e286e446dc46feb24b5b5f81c6ed52'), sig2)
 
+    @needs_test_with_all_ecc_implementations
+    def test_sign_and_verify_batch(self):
+        keys = [bfh('7e1255fddb52db1729fc3ceb21a46f95b8d9fe94cc83425e936a6c5223bb679d'),
+                bfh('c7ce8c1462c311eec24dff9e2532ac6241e50ae57e7d1833af21942136972f23')]
+        hashes = [bfh('5a548b12369a53faaa7e51b5081829474ebdd9c924b3a8230b69aa0be254cd94'),
+                  bfh('642a2e66332f507c92bda910158dfe46fc10afbf72218764899d3af99a043fac')]
+        sigs = ecc.sign_transaction_batch(list(zip(keys, hashes)))
+        self.assertEqual([ecc.ECPrivkey(k).sign_transaction(h) for k, h in zip(keys, hashes)], sigs)
+        pubkeys = [ecc.ECPrivkey(k).get_public_key_bytes() for k in keys]
+        sig_strings = [ecc.sig_string_from_der_sig(sig) for sig in sigs]
+        self.assertEqual([True, True], ecc.verify_batch(list(zip(sig_strings, hashes, pubkeys))))
+        self.assertEqual([False, False], ecc.verify_batch(list(zip(sig_strings, hashes, reversed(pubkeys)))))
+        with self.assertRaises(ecc.InvalidECPointException):
+            ecc.sign_transaction_batch([(bytes(32), hashes[0])])
+
     @needs_test_with_all_aes_implementations
     def test_aes_homomorphic(self):
         """Make sure AES is homomorphic."""
@@ -388,6 +406,65 @@ class Test_bitcoin_testnet(TestCaseForTestnet):
         self.assertEqual(address_to_script('2N3LSvr3hv5EVdfcrxg2Yzecf3SRvqyBE4p'), 'a9146eae23d8c4a941316017946fc761a7a6c85561fb87')
         self.assertEqual(address_to_script('2NE4ZdmxFmUgwu5wtfoN2gVniyMgRDYq1kk'), 'a914e4567743d378957cd2ee7072da74b1203c1a7a0b87')
 
+    def test_address_cache(self):
+        addresses = ['tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7',
+                     'mutXcGt1CJdkRvXuN2xoz2quAAQYQ59bRX', '2N3LSvr3hv5EVdfcrxg2Yzecf3SRvqyBE4p']
+        self.assertEqual([address_to_script(a) for a in addresses], addresses_to_scripts(addresses))
+        self.assertEqual([address_to_scripthash(a) for a in addresses], addresses_to_scripthashes(addresses))
+        self.assertEqual('a9146eae23d8c4a941316017946fc761a7a6c85561fb87', addresses_to_scripts(addresses)[2])
+        # the cache is per network
+        with self.assertRaises(BitcoinException):
+            address_to_script(addresses[1], net=constants.BitcoinMainnet)
+        # not a mainnet segwit address, and not base58 either
+        with self.assertRaises(ValueError):
+            addresses_to_scripthashes(addresses[:1], net=constants.BitcoinMainnet)
+        # no address string is valid on both testnet and mainnet, so
+        # swap the address types to get one that means something else
+        class SwappedNet(constants.BitcoinTestnet):
+            ADDRTYPE_P2PKH = constants.BitcoinTestnet.ADDRTYPE_P2SH
+            ADDRTYPE_P2SH = constants.BitcoinTestnet.ADDRTYPE_P2PKH
+        p2pkh = address_to_script(addresses[1])
+        p2sh = address_to_script(addresses[1], net=SwappedNet)
+        self.assertEqual('76a914', p2pkh[:6])
+        self.assertEqual('a914', p2sh[:4])
+        self.assertEqual(p2pkh[6:46], p2sh[4:44])
+        self.assertEqual([p2sh], addresses_to_scripts(addresses[1:2], net=SwappedNet))
+        self.assertEqual([p2pkh], addresses_to_scripts(addresses[1:2]))
+        self.assertNotEqual(address_to_scripthash(addresses[1]),
+                            address_to_scripthash(addresses[1], net=SwappedNet))
+
+
+class Test_base_codec(SequentialTestCase):
+
+    def test_matches_reference(self):
+        rnd = random.Random(45)
+        randbytes = lambda n: bytes(rnd.getrandbits(8) for i in range(n))
+        values = [b'', b'\x00', b'\x00' * 5, b'\x01', b'\xff' * 82, b'\x00\x00\x01\x02']
+        values += [randbytes(n) for n in range(100)]
+        values += [b'\x00' * 2 + randbytes(n) for n in range(30)]
+        for base, chars in ((58, B58_CHARS), (43, B43_CHARS)):
+            for v in values:
+                encoded = base_encode(v, base)
+                self.assertEqual(reference_base_encode(v, chars), encoded)
+                decoded = base_decode(encoded, None, base)
+                if any(v):
+                    self.assertEqual(v, decoded)
+                self.assertEqual(decoded, base_decode(encoded, len(decoded), base))
+                self.assertIsNone(base_decode(encoded, len(decoded) + 1, base))
+
+    def test_forbidden_character(self):
+        with self.assertRaises(ValueError):
+            base_decode('0OIl', None, 58)
+        with self.assertRaises(ValueError):
+            base_decode('abc', None, 43)
+        with self.assertRaises(ValueError):
+            base_encode(b'', 64)
+
+    def test_xpub_cache(self):
+        xprv, xpub = bip32_root(b'\x01' * 32, 'standard')
+        self.assertIs(deserialize_xpub(xpub), deserialize_xpub(xpub))
+        self.assertEqual('standard', xpub_type(xpub))
+        self.assertFalse(is_xpub(xpub[:-1] + '9'))
 
 class Test_xprv_xpub(SequentialTestCase):
 
@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+
+from electrum import blockchain, constants
+from electrum.blockchain import Blockchain, hash_header
+from electrum.simple_config import SimpleConfig
+
+from . import SequentialTestCase
+
+
+def make_headers(prev_hash, start_height, count, nonce=0):
+    '''A chain of headers without proof of work, for a test network
+    where it is not checked.'''
+    headers = []
+    for height in range(start_height, start_height + count):
+        header = {
+            'version': 1,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % height,
+            'timestamp': 1500000000 + height * 600,
+            'bits': 0x207fffff,
+            'nonce': nonce,
+            'block_height': height,
+        }
+        headers.append(header)
+        prev_hash = hash_header(header)
+    return headers
+
+
+class BlockchainTestCase(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_simnet()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        os.mkdir(os.path.join(self.electrum_path, 'forks'))
+        self.saved_blockchains = dict(blockchain.blockchains)
+        blockchain.blockchains.clear()
+
+    def tearDown(self):
+        blockchain.blockchains.clear()
+        blockchain.blockchains.update(self.saved_blockchains)
+        shutil.rmtree(self.electrum_path)
+        super().tearDown()
+
+    def make_main_chain(self, count):
+        genesis = make_headers('00' * 32, 0, 1)[0]
+        open(os.path.join(self.electrum_path, 'blockchain_headers'), 'wb').close()
+        b = Blockchain(self.config, 0, None)
+        blockchain.blockchains[0] = b
+        b.save_header(genesis)
+        headers = [genesis] + make_headers(constants.net.GENESIS, 1, count - 1)
+        for header in headers[1:]:
+            b.save_header(header)
+        return b, headers
+
+
+class TestHashIndex(BlockchainTestCase):
+
+    def test_get_hash(self):
+        b, headers = self.make_main_chain(20)
+        self.assertEqual(19, b.height())
+        for header in headers[1:]:
+            self.assertEqual(hash_header(header), b.get_hash(header['block_height']))
+        self.assertEqual(20 * 32, os.path.getsize(b.hashes_path()))
+        self.assertEqual(hash_header(None), b.get_hash(20))
+        self.assertTrue(blockchain.check_header(headers[5]))
+        self.assertTrue(blockchain.can_connect(make_headers(hash_header(headers[-1]), 20, 1)[0]))
+
+    def test_index_is_rebuilt(self):
+        b, headers = self.make_main_chain(20)
+        os.unlink(b.hashes_path())
+        b = Blockchain(self.config, 0, None)
+        self.assertEqual(20 * 32, os.path.getsize(b.hashes_path()))
+        self.assertEqual(hash_header(headers[10]), b.get_hash(10))
+        # an index longer than the headers file is truncated
+        with open(b.hashes_path(), 'ab') as f:
+            f.write(bytes(64))
+        b = Blockchain(self.config, 0, None)
+        self.assertEqual(20 * 32, os.path.getsize(b.hashes_path()))
+
+    def test_swap_with_parent(self):
+        main, headers = self.make_main_chain(10)
+        fork_headers = make_headers(hash_header(headers[5]), 6, 7, nonce=1)
+        fork = main.fork(fork_headers[0])
+        blockchain.blockchains[fork.forkpoint] = fork
+        for header in fork_headers[1:]:
+            fork.save_header(header)
+        # the fork is now the longest chain, and has been swapped
+        self.assertEqual(12, blockchain.blockchains[0].height())
+        self.assertEqual(9, blockchain.blockchains[6].height())
+        main, fork = blockchain.blockchains[0], blockchain.blockchains[6]
+        for header in headers[1:6] + fork_headers:
+            self.assertEqual(hash_header(header), main.get_hash(header['block_height']))
+        for header in headers[1:]:
+            self.assertEqual(hash_header(header), fork.get_hash(header['block_height']))
+        self.assertEqual(4 * 32, os.path.getsize(fork.hashes_path()))
+        self.assertTrue(os.path.exists(os.path.join(self.electrum_path, 'forks', 'hashes_0_6')))
+
+
+class TestPrune(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.headers = self.make_main_chain(2 * 2016 + 10)
+
+    def chunk_hex(self, headers):
+        return ''.join(blockchain.serialize_header(h) for h in headers)
+
+    def test_prune(self):
+        size = os.path.getsize(self.main.path())
+        self.main.prune(2 * 2016)
+        self.assertEqual(size, os.path.getsize(self.main.path()))
+        self.assertEqual(2 * 2016 + 9, self.main.height())
+        self.assertIsNone(self.main.read_header(100))
+        self.assertIsNone(self.main.read_header(3000))
+        # retarget boundaries and recent headers are kept
+        for height in [2015, 2016, 4031, 4032, 4040]:
+            self.assertEqual(self.headers[height], self.main.read_header(height))
+        for height in [100, 3000]:
+            self.assertEqual(hash_header(self.headers[height]), self.main.get_hash(height))
+        self.assertEqual(3000, self.main.get_height(hash_header(self.headers[3000])))
+        self.assertTrue(blockchain.check_header(self.headers[3000]))
+
+    def test_refill_chunk(self):
+        self.main.prune(2 * 2016)
+        self.assertTrue(self.main.connect_chunk(1, self.chunk_hex(self.headers[2016:4032])))
+        self.assertEqual(self.headers[3000], self.main.read_header(3000))
+        # the headers above the chunk are not truncated
+        self.assertEqual(2 * 2016 + 9, self.main.height())
+        self.assertEqual(self.headers[4040], self.main.read_header(4040))
+
+    def test_refill_chunk_must_match_index(self):
+        self.main.prune(2 * 2016)
+        headers = self.headers[2016:3000] + make_headers(
+            hash_header(self.headers[2999]), 3000, 1032, nonce=1)
+        self.assertFalse(self.main.connect_chunk(1, self.chunk_hex(headers)))
+        self.assertIsNone(self.main.read_header(3000))
+        self.assertEqual(hash_header(self.headers[3000]), self.main.get_hash(3000))
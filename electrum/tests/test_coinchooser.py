@@ -0,0 +1,100 @@
+import shutil
+import tempfile
+
+from electrum import coinchooser
+from electrum.bitcoin import TYPE_ADDRESS
+from electrum.coinchooser import CoinChooserBranchAndBound, CoinChooserPrivacy
+from electrum.scripts import bench_coinchooser
+from electrum.simple_config import SimpleConfig
+from electrum.transaction import TxOutput
+
+from . import SequentialTestCase
+
+
+def make_coin(n, value, height=100):
+    return {
+        'address': bench_coinchooser.make_address(n),
+        'type': 'p2wpkh',
+        'prevout_hash': '%064x' % (n + 1),
+        'prevout_n': 0,
+        'value': value,
+        'height': height,
+        'num_sig': 1,
+        'signatures': [None],
+        'x_pubkeys': ['02' + '00' * 32],
+        'pubkeys': ['02' + '00' * 32],
+    }
+
+
+class TestCoinChooserBranchAndBound(SequentialTestCase):
+
+    change_addr = bench_coinchooser.make_address(1000)
+    dust_threshold = 546
+
+    def make_coins(self, values, heights=None):
+        heights = heights or [100] * len(values)
+        return [make_coin(n, v, h) for n, (v, h) in enumerate(zip(values, heights))]
+
+    def make_tx(self, chooser, values, amount, fee_estimator=lambda size: 0, heights=None, coins=None):
+        coins = coins or self.make_coins(values, heights)
+        outputs = [TxOutput(TYPE_ADDRESS, bench_coinchooser.make_address(2000), amount)]
+        return chooser.make_tx(coins, outputs, [self.change_addr],
+                               fee_estimator, self.dust_threshold)
+
+    def test_finds_changeless_solution(self):
+        tx = self.make_tx(CoinChooserBranchAndBound(), [50000, 30000, 20000, 7000], 37000)
+        self.assertEqual([30000, 7000], sorted((txin['value'] for txin in tx.inputs()), reverse=True))
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual(0, tx.get_fee())
+
+    def test_changeless_solution_pays_fee(self):
+        fee_estimator = lambda size: 2 * size
+        chooser = CoinChooserBranchAndBound()
+        values = [80000, 60000, 52300, 3000]
+        tx = self.make_tx(chooser, values, 52000, fee_estimator)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertGreaterEqual(tx.get_fee(), fee_estimator(tx.estimated_size()))
+        self.assertLess(tx.get_fee() - fee_estimator(tx.estimated_size()), chooser.cost_of_change)
+
+    def test_falls_back_to_privacy_chooser(self):
+        values = [500000, 300000]
+        tx1 = self.make_tx(CoinChooserBranchAndBound(), values, 100000)
+        tx2 = self.make_tx(CoinChooserPrivacy(), values, 100000)
+        self.assertEqual(2, len(tx1.outputs()))
+        self.assertEqual(tx2.serialize(), tx1.serialize())
+
+    def test_prefers_confirmed_coins(self):
+        tx = self.make_tx(CoinChooserBranchAndBound(), [20000, 10000, 10000], 20000,
+                          heights=[0, 100, 100])
+        self.assertEqual([100, 100], [txin['height'] for txin in tx.inputs()])
+        self.assertEqual(1, len(tx.outputs()))
+
+    def test_is_deterministic(self):
+        coins = self.make_coins([7000 * n + 13 for n in range(1, 40)])
+        # several pairs of coins pay this amount exactly
+        tx1 = self.make_tx(CoinChooserBranchAndBound(), None, 70026, coins=coins)
+        tx2 = self.make_tx(CoinChooserBranchAndBound(), None, 70026, coins=coins[::-1])
+        self.assertEqual(2, len(tx1.inputs()))
+        self.assertEqual(sorted(txin['prevout_hash'] for txin in tx1.inputs()),
+                         sorted(txin['prevout_hash'] for txin in tx2.inputs()))
+
+    def test_get_coin_chooser(self):
+        electrum_dir = tempfile.mkdtemp()
+        try:
+            config = SimpleConfig({'electrum_path': electrum_dir,
+                                   'coin_chooser': 'BranchAndBound'})
+            self.assertTrue(isinstance(coinchooser.get_coin_chooser(config),
+                                       CoinChooserBranchAndBound))
+        finally:
+            shutil.rmtree(electrum_dir)
+
+
+class TestCoinChooserBenchmark(SequentialTestCase):
+
+    def test_run_benchmark(self):
+        results = bench_coinchooser.run_benchmark(sizes=[200], fee_rates=[1])
+        self.assertEqual(sorted(coinchooser.COIN_CHOOSERS),
+                         sorted(r['chooser'] for r in results))
+        for r in results:
+            self.assertGreater(r['inputs'], 0)
+            self.assertGreater(r['fee'], 0)
@@ -0,0 +1,178 @@
+import shutil
+import tempfile
+
+from electrum.bitcoin import hash_to_segwit_addr, sha256
+from electrum.coinchooser import PRNG
+from electrum.consolidation import ConsolidationPlanner
+from electrum.simple_config import SimpleConfig
+from electrum.util import NoDynamicFeeEstimates
+
+from . import SequentialTestCase
+
+
+class MockWallet:
+
+    def diagnostic_name(self):
+        return 'mock_wallet'
+
+
+def make_address(i):
+    return hash_to_segwit_addr(sha256('consolidation address %d' % i)[:20], witver=0)
+
+
+def make_coins(num_coins):
+    '''p2wpkh coins, one per address, with values spread over several
+    orders of magnitude.'''
+    p = PRNG(b'consolidation')
+    coins = []
+    for i in range(num_coins):
+        magnitude = p.randint(3, 8)
+        coins.append({
+            'address': make_address(i),
+            'type': 'p2wpkh',
+            'prevout_hash': sha256('consolidation coin %d' % i).hex(),
+            'prevout_n': 0,
+            'value': p.randint(1, 10) * 10 ** magnitude + p.randint(0, 10 ** magnitude),
+            'height': 100,
+            'num_sig': 1,
+            'signatures': [None],
+            'x_pubkeys': ['02' + '00' * 32],
+            'pubkeys': ['02' + '00' * 32],
+        })
+    return coins
+
+
+class TestConsolidationPlanner(SequentialTestCase):
+
+    dest = make_address(10 ** 6)
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+    def test_nothing_to_do_below_target(self):
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        coins = make_coins(planner.target_utxos)
+        self.assertEqual([], planner.plan(coins, 1000, self.dest))
+
+    def test_plan_reduces_utxo_count(self):
+        self.config.set_key('consolidation_target_utxos', 100, False)
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        coins = make_coins(500)
+        batches = planner.plan(coins, 1000, self.dest)
+        swept = sum(len(batch) for batch in batches)
+        remaining = len(coins) - swept + len(batches)
+        self.assertLessEqual(remaining, 100)
+        self.assertGreater(remaining, 90)
+        # smallest coins go first
+        largest_swept = max(coin['value'] for batch in batches for coin in batch)
+        swept_ids = set(coin['prevout_hash'] for batch in batches for coin in batch)
+        kept = [coin['value'] for coin in coins if coin['prevout_hash'] not in swept_ids]
+        self.assertLessEqual(largest_swept, min(kept))
+
+    def test_batches_respect_weight_limit(self):
+        self.config.set_key('consolidation_target_utxos', 1, False)
+        self.config.set_key('consolidation_max_weight', 20000, False)
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        coins = make_coins(300)
+        batches = planner.plan(coins, 1000, self.dest)
+        self.assertGreater(len(batches), 1)
+        for batch in batches:
+            # a p2wpkh input weighs about 272 weight units
+            self.assertLess(len(batch) * 272, 20000)
+
+    def test_uneconomical_coins_are_kept(self):
+        self.config.set_key('consolidation_target_utxos', 1, False)
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        coins = make_coins(20)
+        coins[0]['value'] = 100
+        batches = planner.plan(coins, 10000, self.dest)
+        self.assertNotIn(coins[0], [coin for batch in batches for coin in batch])
+
+    def test_low_fee_rate(self):
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        with self.assertRaises(NoDynamicFeeEstimates):
+            planner.low_fee_per_kb()
+        for target, fee in [(25, 3000), (10, 8000), (5, 20000), (2, 40000)]:
+            self.config.update_fee_estimates(target, fee)
+        self.assertEqual(3000, planner.low_fee_per_kb())
+        self.assertTrue(planner.is_low_fee_time(3000))
+        self.config.mempool_fees = [[20, 100000], [5, 20000000]]
+        self.assertEqual(3000, planner.low_fee_per_kb())
+        self.config.mempool_fees = [[2, 20000000]]
+        self.assertEqual(3000, planner.low_fee_per_kb())
+        self.config.mempool_fees = [[1, 2000]]
+        self.assertEqual(1000, planner.low_fee_per_kb())
+        self.assertFalse(planner.is_low_fee_time(planner.max_fee_per_kb + 1))
+
+    def test_single_coin_batches_remove_nothing(self):
+        # two p2wpkh inputs per transaction, but not three
+        self.config.set_key('consolidation_max_weight', 850, False)
+        coins = make_coins(10)
+        for i, coin in enumerate(coins):
+            coin['value'] = 10000 * (i + 1)
+        # the second smallest address has two coins
+        coins[2]['address'] = coins[1]['address']
+        coins[2]['value'] = coins[1]['value']
+        self.config.set_key('consolidation_target_utxos', len(coins) - 2, False)
+        planner = ConsolidationPlanner(MockWallet(), self.config)
+        batches = planner.plan(coins, 1000, self.dest)
+        # the smallest coin cannot join them, and is left alone
+        self.assertEqual([[coins[1], coins[2]], [coins[3], coins[4]]], batches)
+        remaining = len(coins) - sum(len(batch) for batch in batches) + len(batches)
+        self.assertEqual(planner.target_utxos, remaining)
+
+    def test_destinations_are_not_reused(self):
+        wallet = MockDestinationWallet(['c1'], ['r1', 'c1'], deterministic=True)
+        planner = ConsolidationPlanner(wallet, self.config)
+        self.assertEqual(['c1'], planner.get_destination_addresses(1))
+        self.assertEqual(['c1', 'r1', 'new0', 'new1'], planner.get_destination_addresses(4))
+        wallet = MockDestinationWallet(['c1'], ['r1'], deterministic=False)
+        planner = ConsolidationPlanner(wallet, self.config)
+        self.assertEqual(['c1', 'r1'], planner.get_destination_addresses(4))
+        wallet = MockDestinationWallet([], [], deterministic=False)
+        planner = ConsolidationPlanner(wallet, self.config)
+        self.assertEqual([], planner.get_destination_addresses(1))
+
+    def test_no_address_created_without_batches(self):
+        wallet = MockDestinationWallet([], [], deterministic=True)
+        planner = ConsolidationPlanner(wallet, self.config)
+        wallet.coins = make_coins(planner.target_utxos)
+        self.assertEqual([], planner.make_transactions(fee_per_kb=1000))
+        self.assertEqual(0, wallet.created)
+
+
+class MockDestinationWallet(MockWallet):
+
+    def __init__(self, unused_change, unused, deterministic):
+        self.unused_change = unused_change
+        self.unused = unused
+        self.deterministic = deterministic
+        self.created = 0
+        self.coins = []
+        self.frozen_addresses = set()
+
+    def get_utxos(self, **kwargs):
+        return list(self.coins)
+
+    def add_input_info(self, coin):
+        pass
+
+    def calc_unused_change_addresses(self):
+        return list(self.unused_change)
+
+    def get_unused_addresses(self):
+        return list(self.unused)
+
+    def is_deterministic(self):
+        return self.deterministic
+
+    def create_new_address(self, for_change=False):
+        addr = 'new%d' % self.created
+        self.created += 1
+        return addr
@@ -1,3 +1,5 @@
+import socket
+import time
 import unittest
 
 from electrum import interface
@@ -26,3 +28,92 @@ class TestInterface(SequentialTestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestLatencyHistogram(SequentialTestCase):
+
+    def test_percentiles(self):
+        h = interface.LatencyHistogram()
+        self.assertIsNone(h.percentile(50))
+        for ms in [5, 20, 20, 40, 200, 12000]:
+            h.add(ms / 1000)
+        d = h.as_dict()
+        self.assertEqual(6, d['count'])
+        self.assertEqual(25, d['p50_ms'])
+        self.assertEqual(12000, d['p90_ms'])
+        self.assertEqual(12000, d['max_ms'])
+        self.assertEqual((10, 1), d['buckets'][0])
+
+
+class TestRequestWindow(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sock, self.other = socket.socketpair()
+        self.interface = interface.Interface('host:50002:s', self.sock)
+        self.wire_id = 0
+
+    def tearDown(self):
+        super().tearDown()
+        self.sock.close()
+        self.other.close()
+
+    def answer(self, rtt, error=None, in_flight=0):
+        self.wire_id += 1
+        request = ('server.ping', [], self.wire_id)
+        self.interface.unanswered_requests = {-i: None for i in range(in_flight)}
+        self.interface.send_times[self.wire_id] = time.time() - rtt
+        self.interface.on_response(request, {'id': self.wire_id, 'result': None, 'error': error})
+
+    def test_window_grows_while_used(self):
+        for i in range(100):
+            self.answer(0.01)
+        self.assertEqual(interface.Interface.INITIAL_REQUESTS, self.interface.max_requests)
+        for i in range(300):
+            self.answer(0.01, in_flight=int(self.interface.max_requests))
+        self.assertEqual(102, int(self.interface.max_requests))
+        self.assertEqual(1, len(self.interface.latency))
+        self.assertEqual(400, self.interface.get_stats()['latency']['server.ping']['count'])
+
+    def test_window_shrinks_on_errors(self):
+        self.answer(0.01)
+        self.answer(0.01, error={'message': 'excessive resource usage'})
+        self.assertEqual(50, self.interface.max_requests)
+        # once per round trip
+        self.answer(0.01, error={'message': 'excessive resource usage'})
+        self.assertEqual(50, self.interface.max_requests)
+        self.interface.last_decrease = 0
+        self.answer(2.)
+        self.assertEqual(25, self.interface.max_requests)
+        self.assertEqual(2, self.interface.get_stats()['errors'])
+        for i in range(10):
+            self.interface.last_decrease = 0
+            self.answer(0.01, error={'message': 'error'})
+        self.assertEqual(interface.Interface.MIN_REQUESTS, self.interface.max_requests)
+
+    def test_request_timeout(self):
+        self.assertEqual(interface.Interface.DEFAULT_TIMEOUT, self.interface.request_timeout())
+        for i in range(20):
+            self.answer(0.05)
+        self.assertEqual(interface.Interface.MIN_TIMEOUT, self.interface.request_timeout())
+        for i in range(20):
+            self.answer(60)
+        self.assertEqual(interface.Interface.MAX_TIMEOUT, self.interface.request_timeout())
+
+    def pending(self, method, age):
+        self.wire_id += 1
+        self.interface.unanswered_requests = {self.wire_id: (method, [], self.wire_id)}
+        self.interface.request_time = time.time() - age
+        self.interface.pipe.idle_time = lambda: age
+
+    def test_slow_request_on_fast_server(self):
+        for i in range(20):
+            self.answer(0.01)
+        self.pending('blockchain.scripthash.get_history', 15)
+        self.assertFalse(self.interface.has_timed_out())
+        self.pending('blockchain.block.headers', 25)
+        self.assertFalse(self.interface.has_timed_out())
+        self.pending('server.ping', 15)
+        self.assertTrue(self.interface.has_timed_out())
+        self.pending('server.ping', 9)
+        self.assertFalse(self.interface.has_timed_out())
@@ -0,0 +1,104 @@
+import base64
+import http.client
+import json
+import threading
+import time
+
+from electrum.jsonrpc import VerifyingJSONRPCServer
+
+from . import SequentialTestCase
+
+
+class TestVerifyingJSONRPCServer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                             rpc_user='user', rpc_password='pass',
+                                             rpc_threads=4, request_timeout=5,
+                                             keepalive_timeout=0.5)
+        self.server.timeout = 0.1
+        self.server.register_function(lambda x: x, 'echo')
+        self.server.register_function(lambda: time.sleep(1) or 'slow', 'slow')
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.running = False
+        self.thread.join()
+        self.server.server_close()
+
+    def serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def connect(self):
+        host, port = self.server.socket.getsockname()
+        return http.client.HTTPConnection(host, port, timeout=5)
+
+    def call(self, conn, payload, password='pass'):
+        auth = base64.b64encode(('user:' + password).encode('utf8')).decode('ascii')
+        conn.request('POST', '/', json.dumps(payload),
+                     {'Content-Type': 'application/json',
+                      'Authorization': 'Basic ' + auth})
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, json.loads(body.decode('utf8')) if response.status == 200 else None
+
+    def request(self, method, params, id=1):
+        return {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id}
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        for i in range(3):
+            status, result = self.call(conn, self.request('echo', [i], id=i))
+            self.assertEqual(200, status)
+            self.assertEqual(i, result['result'])
+        conn.close()
+
+    def test_idle_connection_is_closed(self):
+        conn = self.connect()
+        status, result = self.call(conn, self.request('echo', [1]))
+        self.assertEqual(200, status)
+        self.assertEqual(1, len(self.server.connections))
+        # the thread of the connection is freed well before request_timeout
+        for i in range(20):
+            if not self.server.connections:
+                break
+            time.sleep(0.1)
+        self.assertEqual(set(), self.server.connections)
+        self.assertEqual(b'', conn.sock.recv(1))
+        conn.close()
+
+    def test_batch(self):
+        conn = self.connect()
+        status, result = self.call(conn, [self.request('echo', ['a'], id=1),
+                                          self.request('echo', ['b'], id=2)])
+        self.assertEqual(['a', 'b'], [r['result'] for r in sorted(result, key=lambda r: r['id'])])
+        conn.close()
+
+    def test_slow_request_does_not_block_others(self):
+        results = []
+        def slow_call():
+            conn = self.connect()
+            results.append(self.call(conn, self.request('slow', []))[1]['result'])
+            conn.close()
+        t = threading.Thread(target=slow_call)
+        t.start()
+        time.sleep(0.2)
+        start = time.time()
+        conn = self.connect()
+        status, result = self.call(conn, self.request('echo', ['fast']))
+        conn.close()
+        self.assertEqual('fast', result['result'])
+        self.assertLess(time.time() - start, 0.5)
+        t.join()
+        self.assertEqual(['slow'], results)
+
+    def test_bad_credentials(self):
+        conn = self.connect()
+        status, result = self.call(conn, self.request('echo', [1]), password='wrong')
+        self.assertEqual(401, status)
+        conn.close()
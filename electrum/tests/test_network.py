@@ -0,0 +1,303 @@
+import threading
+
+from electrum import blockchain
+from electrum.blockchain import hash_header, serialize_header
+from electrum.network import Network
+
+from . import SequentialTestCase
+from .test_blockchain import BlockchainTestCase, make_headers
+
+
+class MockInterface:
+
+    def __init__(self, server='mock:50002:s'):
+        self.server = server
+        self.host = server.split(':')[0]
+        self.mode = 'default'
+        self.request = None
+        self.blockchain = None
+        self.tip = None
+        self.max_requests = 100
+        self.unanswered_requests = {}
+        self.unsent_requests = []
+        self.responses = []
+
+    def get_responses(self):
+        responses, self.responses = self.responses, []
+        return responses
+
+    def close(self):
+        pass
+
+    def print_error(self, *args):
+        pass
+
+
+class MockNetwork(Network):
+
+    def __init__(self):
+        self.blockchains = blockchain.blockchains
+        self.blockchains_lock = threading.Lock()
+        self.requested_chunks = {}
+        self.interfaces = {}
+        self.interface_lock = threading.RLock()
+        self.requests = []
+        self.closed = []
+
+    def queue_request(self, method, params, interface=None):
+        self.requests.append((method, params))
+
+    def request_chunk(self, interface, index):
+        self.requests.append(('chunk', index))
+        self.requested_chunks[index] = interface.server
+
+    def connection_down(self, server):
+        self.closed.append(server)
+
+    def notify(self, key):
+        pass
+
+    def switch_lagging_interface(self):
+        pass
+
+
+class TestForkSearch(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.headers = self.make_main_chain(100)
+        self.network = MockNetwork()
+        self.interface = MockInterface()
+
+    def server_chain(self, forkpoint, tip):
+        fork_headers = make_headers(hash_header(self.headers[forkpoint - 1]), forkpoint,
+                                    tip - forkpoint + 1, nonce=1)
+        return self.headers[:forkpoint] + fork_headers
+
+    def notify(self, header):
+        self.network.on_notify_header(self.interface, {
+            'hex': serialize_header(header),
+            'height': header['block_height'],
+        })
+
+    def answer(self, server_headers):
+        '''Answers the last headers request of the network.'''
+        method, (start, count) = self.network.requests[-1]
+        self.assertEqual('blockchain.block.headers', method)
+        self.network.on_block_headers(self.interface, {
+            'params': [start, count],
+            'result': {
+                'hex': ''.join(serialize_header(h) for h in server_headers[start:start + count]),
+                'count': count,
+                'max': 2016,
+            },
+        })
+
+    def test_recent_fork_found_in_one_round_trip(self):
+        server_headers = self.server_chain(90, 110)
+        self.notify(server_headers[110])
+        self.assertEqual('fork_search', self.interface.mode)
+        self.answer(server_headers)
+        self.assertEqual([], self.network.closed)
+        fork = blockchain.blockchains[90]
+        self.assertEqual(hash_header(server_headers[90]), fork.get_hash(90))
+        self.assertEqual('catch_up', self.interface.mode)
+        self.assertIs(fork, self.interface.blockchain)
+        self.assertEqual(('blockchain.block.get_header', [91]), self.network.requests[-1])
+        self.assertEqual(2, len(self.network.requests))
+
+    def test_deep_fork(self):
+        server_headers = self.server_chain(30, 110)
+        self.notify(server_headers[110])
+        self.answer(server_headers)
+        self.assertEqual('fork_search', self.interface.mode)
+        self.answer(server_headers)
+        self.assertEqual([], self.network.closed)
+        self.assertIn(30, blockchain.blockchains)
+        # far behind the tip: catch up with chunks
+        self.assertEqual(('chunk', 0), self.network.requests[-1])
+        self.assertEqual(3, len(self.network.requests))
+
+    def test_catch_up(self):
+        server_headers = self.headers + make_headers(hash_header(self.headers[-1]), 100, 6)
+        self.notify(server_headers[105])
+        self.answer(server_headers)
+        self.assertEqual([], self.network.closed)
+        self.assertEqual('catch_up', self.interface.mode)
+        self.assertIs(self.main, self.interface.blockchain)
+        self.assertEqual(('blockchain.block.get_header', [100]), self.network.requests[-1])
+
+    def test_fork_found_during_catch_up(self):
+        server_headers = self.headers + make_headers(hash_header(self.headers[-1]), 100, 6)
+        self.notify(server_headers[105])
+        self.answer(server_headers)
+        self.network.on_get_header(self.interface, {'result': server_headers[100]})
+        self.assertEqual(('blockchain.block.get_header', [101]), self.network.requests[-1])
+        # meanwhile, the server switched to a branch that forks at 98
+        server_headers = self.server_chain(98, 110)
+        self.network.on_get_header(self.interface, {'result': server_headers[101]})
+        self.assertEqual('fork_search', self.interface.mode)
+        self.assertIsNone(self.main.catch_up)
+        self.answer(server_headers)
+        self.assertEqual([], self.network.closed)
+        fork = blockchain.blockchains[98]
+        self.assertEqual(hash_header(server_headers[98]), fork.get_hash(98))
+        self.assertEqual('catch_up', self.interface.mode)
+        self.assertIs(fork, self.interface.blockchain)
+        self.assertEqual(('blockchain.block.get_header', [99]), self.network.requests[-1])
+
+    def test_bad_chain(self):
+        server_headers = self.server_chain(90, 110)
+        server_headers[95] = dict(server_headers[95], nonce=2)
+        self.notify(server_headers[110])
+        self.answer(server_headers)
+        self.assertEqual([self.interface.server], self.network.closed)
+
+    def test_hash_to_height_index(self):
+        self.assertEqual(42, self.main.get_height(hash_header(self.headers[42])))
+        self.assertIs(self.main, blockchain.find_hash(hash_header(self.headers[42])))
+        server_headers = self.server_chain(90, 110)
+        self.assertIsNone(blockchain.find_hash(hash_header(server_headers[95])))
+        self.assertFalse(blockchain.check_header(server_headers[95]))
+        # truncating the chain forgets the hashes
+        self.main.write(b'', 50 * 80)
+        self.assertIsNone(self.main.get_height(hash_header(self.headers[60])))
+        self.assertEqual(49, self.main.get_height(hash_header(self.headers[49])))
+
+
+class TestChunkPrefetch(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.headers = self.make_main_chain(10)
+        self.network = MockNetwork()
+        for i in range(2):
+            interface = MockInterface('mock%d:50002:s' % i)
+            interface.blockchain = self.main
+            self.network.interfaces[interface.server] = interface
+
+    def test_chunks_are_spread_over_interfaces(self):
+        self.network.request_chunks(self.main, {3, 1, 2})
+        self.assertEqual([('chunk', 1), ('chunk', 2), ('chunk', 3)], self.network.requests)
+        self.assertEqual(2, len(set(self.network.requested_chunks.values())))
+
+    def test_chunks_in_flight_are_bounded(self):
+        self.network.request_chunks(self.main, range(100))
+        self.assertEqual(2 * Network.CHUNK_PREFETCH, len(self.network.requested_chunks))
+        self.network.request_chunks(self.main, range(100))
+        self.assertEqual(2 * Network.CHUNK_PREFETCH, len(self.network.requests))
+        # interfaces on another chain are not used
+        self.network.requested_chunks.clear()
+        for interface in self.network.interfaces.values():
+            interface.blockchain = None
+        self.network.request_chunks(self.main, [200])
+        self.assertNotIn(200, self.network.requested_chunks)
+
+
+class RoutingNetwork(MockNetwork):
+
+    def __init__(self):
+        MockNetwork.__init__(self)
+        self.config = {'load_balance': True}
+        self.debug = False
+        self.message_id = 0
+        self.pending_sends = []
+        self.pending_chunks = []
+        self.pending_sends_lock = threading.Lock()
+        self.callback_lock = threading.Lock()
+        self.subscriptions = {}
+        self.sub_cache = {}
+        self.unanswered_requests = {}
+        self.routed_requests = {}
+        self.disconnected_servers = set()
+        self.default_server = 'mock0:50002:s'
+        self.sent = []
+
+    def queue_request(self, method, params, interface=None):
+        interface = interface or self.interface
+        self.message_id += 1
+        interface.unsent_requests.append((method, params, self.message_id))
+        self.sent.append((interface.server, method, params, self.message_id))
+        return self.message_id
+
+    connection_down = Network.connection_down
+
+
+class TestLoadBalancing(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.network = RoutingNetwork()
+        for i in range(3):
+            interface = MockInterface('mock%d:50002:s' % i)
+            interface.tip = 100
+            self.network.interfaces[interface.server] = interface
+        self.network.interface = self.network.interfaces['mock0:50002:s']
+        self.responses = []
+
+    def send(self, messages):
+        self.network.send(messages, self.responses.append)
+        self.network.process_pending_sends()
+
+    def answer(self, server, result=None, error=None):
+        '''Answers the requests that were sent to server.'''
+        interface = self.network.interfaces[server]
+        for method, params, message_id in interface.unsent_requests:
+            response = {'id': message_id, 'result': result}
+            if error:
+                response['error'] = error
+            interface.responses.append(((method, params, message_id), response))
+        interface.unsent_requests = []
+        self.network.process_responses(interface)
+
+    def test_reads_are_spread(self):
+        self.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(30)])
+        servers = [sent[0] for sent in self.network.sent]
+        self.assertEqual(3, len(set(servers)))
+        self.assertEqual(10, servers.count('mock1:50002:s'))
+        # other requests go to our server
+        self.send([('blockchain.scripthash.subscribe', ['00'])])
+        self.assertEqual('mock0:50002:s', self.network.sent[-1][0])
+
+    def test_lagging_or_disabled(self):
+        self.network.interfaces['mock1:50002:s'].tip = 99
+        self.network.interfaces['mock2:50002:s'].mode = 'catch_up'
+        self.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(5)])
+        self.assertEqual({'mock0:50002:s'}, {sent[0] for sent in self.network.sent})
+        self.network.config['load_balance'] = False
+        self.network.interfaces['mock1:50002:s'].tip = 100
+        self.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(5)])
+        self.assertEqual({'mock0:50002:s'}, {sent[0] for sent in self.network.sent})
+
+    def test_errors_are_retried_on_our_server(self):
+        self.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(3)])
+        self.answer('mock1:50002:s', error={'message': 'not found'})
+        self.assertEqual([], self.responses)
+        self.assertEqual('mock0:50002:s', self.network.sent[-1][0])
+        self.answer('mock0:50002:s', result='00')
+        self.answer('mock2:50002:s', result='00')
+        self.assertEqual(3, len(self.responses))
+        self.assertEqual({}, self.network.unanswered_requests)
+
+    def test_history_must_match_status(self):
+        history = [{'tx_hash': '%064x' % 1, 'height': 10}]
+        status = Network.get_history_status(history)
+        self.network.sub_cache['blockchain.scripthash.subscribe:01'] = {'result': status}
+        self.network.sub_cache['blockchain.scripthash.subscribe:02'] = {'result': 'stale'}
+        # our server is busy
+        self.network.interface.max_requests = 0
+        self.send([('blockchain.scripthash.get_history', ['01']),
+                   ('blockchain.scripthash.get_history', ['02'])])
+        self.answer('mock1:50002:s', result=history)
+        self.answer('mock2:50002:s', result=history)
+        self.assertEqual([['01']], [r['params'] for r in self.responses])
+        self.assertEqual(('mock0:50002:s', 'blockchain.scripthash.get_history', ['02']),
+                         self.network.sent[-1][:3])
+
+    def test_connection_down(self):
+        self.send([('blockchain.transaction.get', ['%064x' % i]) for i in range(3)])
+        self.network.connection_down('mock2:50002:s')
+        self.assertEqual('mock0:50002:s', self.network.sent[-1][0])
+        self.answer('mock0:50002:s', result='00')
+        self.answer('mock1:50002:s', result='00')
+        self.assertEqual(3, len(self.responses))
@@ -0,0 +1,211 @@
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from electrum import storage, keystore
+from electrum import Transaction
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED
+from electrum.payout_queue import PAYOUT_BUILT, PAYOUT_BROADCAST, PAYOUT_FAILED
+from electrum.simple_config import SimpleConfig
+from electrum.util import TxMinedStatus
+
+from . import TestCaseForTestnet
+from .test_wallet_vertical import WalletIntegrityHelper
+
+
+FUNDING_TX = '01000000014576dacce264c24d81887642b726f5d64aa7825b21b350c7b75a57f337da6845010000006b483045022100a3f8b6155c71a98ad9986edd6161b20d24fad99b6463c23b463856c0ee54826d02200f606017fd987696ebbe5200daedde922eee264325a184d5bbda965ba5160821012102e5c473c051dae31043c335266d0ef89c1daab2f34d885cc7706b267f3269c609ffffffff0240420f00000000001600148a28bddb7f61864bdcf58b2ad13d5aeb3abc3c42a2ddb90e000000001976a914c384950342cb6f8df55175b48586838b03130fad88ac00000000'
+
+
+class TestPayoutQueue(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path,
+                                    'dynamic_fees': False,
+                                    'fee_per_kb': 10000})
+        patcher = mock.patch.object(storage.WalletStorage, '_write')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wallet = self.create_wallet('bitter grass shiver impose acquire brush forget axis eager alone wine silver')
+        self.other = self.create_wallet('cycle rocket west magnet parrot shuffle foot correct salt library feed song')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.electrum_path)
+
+    def create_wallet(self, seed_words):
+        ks = keystore.from_seed(seed_words, '', False)
+        return WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+
+    def fund_wallet(self):
+        funding_tx = Transaction(FUNDING_TX)
+        self.wallet.receive_tx_callback(funding_tx.txid(), funding_tx, TX_HEIGHT_UNCONFIRMED)
+
+    def test_add_and_remove(self):
+        queue = self.wallet.payout_queue
+        addrs = self.other.get_receiving_addresses()
+        key1 = queue.add(addrs[0], 10000)
+        key2 = queue.add(addrs[1], 20000)
+        self.assertNotEqual(key1, key2)
+        status = queue.get_status(self.config)
+        self.assertEqual(2, status['count'])
+        self.assertEqual(30000, status['total'])
+        self.assertTrue(queue.remove(key1))
+        self.assertFalse(queue.remove(key1))
+        # the queue is kept in the wallet file
+        self.assertEqual([key2], list(self.wallet.storage.get('payout_queue')))
+
+    def test_is_due(self):
+        queue = self.wallet.payout_queue
+        addr = self.other.get_receiving_address()
+        self.assertFalse(queue.is_due(self.config))
+        queue.add(addr, 10000)
+        self.assertFalse(queue.is_due(self.config))
+        now = queue.payouts[next(iter(queue.payouts))]['time']
+        self.assertTrue(queue.is_due(self.config, now=now + queue.interval))
+        self.config.set_key('payout_max_value', 25000, False)
+        queue.add(addr, 10000)
+        self.assertFalse(queue.is_due(self.config, now=now))
+        queue.add(addr, 10000)
+        self.assertTrue(queue.is_due(self.config, now=now))
+        self.config.set_key('payout_max_value', None, False)
+        self.config.set_key('payout_max_outputs', 3, False)
+        self.assertTrue(queue.is_due(self.config, now=now))
+
+    def test_make_tx_pays_all_outputs(self):
+        self.fund_wallet()
+        queue = self.wallet.payout_queue
+        addrs = self.other.get_receiving_addresses()
+        keys = [queue.add(addrs[0], 100000), queue.add(addrs[1], 200000)]
+        tx = queue.make_tx(self.config, None)
+        self.assertTrue(tx.is_complete())
+        self.assertEqual(1, len(tx.inputs()))
+        # two payouts and change
+        self.assertEqual(3, len(tx.outputs()))
+        paid = {o.address: o.value for o in tx.outputs()}
+        self.assertEqual(100000, paid[addrs[0]])
+        self.assertEqual(200000, paid[addrs[1]])
+        self.assertEqual({}, queue.payouts)
+        self.assertEqual(sorted(keys), sorted(queue.batches[tx.txid()]['payouts']))
+        self.assertIn(tx.txid(), self.wallet.transactions)
+        self.assertEqual([tx.txid()], [t.txid() for t in queue.get_unbroadcast()])
+        queue.on_broadcast(tx.txid(), True)
+        self.assertEqual(PAYOUT_BROADCAST, queue.batches[tx.txid()]['status'])
+        self.assertEqual([], queue.get_unbroadcast())
+        # nothing left to pay
+        self.assertIsNone(queue.make_tx(self.config, None))
+
+    def test_failed_broadcast_is_retried(self):
+        self.fund_wallet()
+        queue = self.wallet.payout_queue
+        queue.add(self.other.get_receiving_address(), 100000)
+        tx = queue.make_tx(self.config, None)
+        queue.on_broadcast(tx.txid(), False, 'server error')
+        self.assertEqual(PAYOUT_BUILT, queue.batches[tx.txid()]['status'])
+        self.assertEqual('server error', queue.get_status(self.config)['last_error'])
+        self.assertEqual([tx.txid()], [t.txid() for t in queue.get_unbroadcast()])
+
+    def test_password_is_kept_for_the_session(self):
+        queue = self.wallet.payout_queue
+        with mock.patch.object(self.wallet, 'has_password', return_value=True):
+            self.assertEqual((False, None), queue.get_password())
+            queue.set_password('secret', 60)
+            self.assertEqual((True, 'secret'), queue.get_password())
+            self.assertTrue(queue.get_status(self.config)['can_sign'])
+            session = queue.session
+            with mock.patch('time.time', return_value=session.expires + 1):
+                self.assertEqual((False, None), queue.get_password())
+            self.assertIsNone(session.get('password'))
+            queue.set_password('secret', 60)
+            session = queue.session
+            self.wallet.stop_threads()
+            self.assertIsNone(session.get('password'))
+            self.assertEqual((False, None), queue.get_password())
+
+    def test_confirmed_batches_are_pruned(self):
+        self.fund_wallet()
+        queue = self.wallet.payout_queue
+        queue.add(self.other.get_receiving_address(), 100000)
+        txid = queue.make_tx(self.config, None).txid()
+        queue.prune()
+        self.assertIn(txid, queue.batches)
+        queue.on_broadcast(txid, True)
+        height = TxMinedStatus(1000, queue.prune_confirmations, None, None)
+        with mock.patch.object(self.wallet, 'get_tx_height', return_value=height):
+            queue.prune()
+        self.assertEqual({}, queue.batches)
+        self.assertEqual({}, self.wallet.storage.get('payout_batches'))
+
+    def make_batch(self):
+        self.fund_wallet()
+        queue = self.wallet.payout_queue
+        key = queue.add(self.other.get_receiving_address(), 100000)
+        return queue, key, queue.make_tx(self.config, None).txid()
+
+    def test_rejected_batch_is_requeued(self):
+        queue, key, txid = self.make_batch()
+        for i in range(queue.max_broadcast_failures - 1):
+            queue.on_broadcast(txid, False, 'min relay fee not met')
+        self.assertEqual(PAYOUT_BUILT, queue.batches[txid]['status'])
+        queue.on_broadcast(txid, False, 'min relay fee not met')
+        self.assertEqual(PAYOUT_FAILED, queue.batches[txid]['status'])
+        self.assertNotIn(txid, self.wallet.transactions)
+        self.assertEqual([key], list(queue.payouts))
+        self.assertEqual([], queue.get_unbroadcast())
+        status = queue.get_status(self.config)
+        self.assertIn('min relay fee not met', status['batches'][txid]['error'])
+        # the coins can be spent again
+        self.assertIsNotNone(queue.make_tx(self.config, None))
+
+    def test_rejection_of_known_tx_counts_as_broadcast(self):
+        queue, key, txid = self.make_batch()
+        height = TxMinedStatus(TX_HEIGHT_UNCONFIRMED, 0, None, None)
+        with mock.patch.object(self.wallet, 'get_tx_height', return_value=height):
+            queue.on_broadcast(txid, False, 'transaction already in block chain')
+        self.assertEqual(PAYOUT_BROADCAST, queue.batches[txid]['status'])
+
+    def test_mined_batch_is_pruned_without_broadcast_ack(self):
+        queue, key, txid = self.make_batch()
+        height = TxMinedStatus(1000, 1, None, None)
+        with mock.patch.object(self.wallet, 'get_tx_height', return_value=height):
+            queue.prune()
+        self.assertEqual(PAYOUT_BROADCAST, queue.batches[txid]['status'])
+        self.assertEqual([], queue.get_unbroadcast())
+        height = TxMinedStatus(1000, queue.prune_confirmations, None, None)
+        with mock.patch.object(self.wallet, 'get_tx_height', return_value=height):
+            queue.prune()
+        self.assertEqual({}, queue.batches)
+
+    def test_removed_batch_is_reported(self):
+        queue, key, txid = self.make_batch()
+        self.wallet.remove_transaction(txid)
+        queue.prune()
+        batch = queue.get_status(self.config)['batches'][txid]
+        self.assertEqual(PAYOUT_FAILED, batch['status'])
+        self.assertEqual([key], batch['payouts'])
+        # a replacement may have paid them
+        self.assertEqual({}, queue.payouts)
+        with mock.patch('time.time', return_value=time.time() + queue.prune_failed + 1):
+            queue.prune()
+        self.assertEqual({}, queue.batches)
+
+    def test_unexpected_error_backs_off(self):
+        queue = self.wallet.payout_queue
+        self.config.set_key('payout_max_outputs', 1, False)
+        queue.add(self.other.get_receiving_address(), 100000)
+        self.wallet.network = mock.Mock(config=self.config)
+        with mock.patch.object(queue, 'make_tx', side_effect=Exception('boom')) as make_tx, \
+                mock.patch('electrum.payout_queue.traceback.print_exc') as print_exc:
+            queue.run()
+            queue.run()
+            self.assertEqual(1, make_tx.call_count)
+            self.assertEqual(1, print_exc.call_count)
+            self.assertIn('boom', queue.get_status(self.config)['last_error'])
+            queue.next_attempt = 0
+            queue.run()
+            self.assertEqual(2, make_tx.call_count)
+            self.assertEqual(1, print_exc.call_count)
+            self.assertEqual(2 * queue.broadcast_retry, round(queue.next_attempt - time.time()))
+        self.assertEqual(1, queue.get_status(self.config)['count'])
@@ -0,0 +1,42 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+from electrum import plugins
+from electrum.plugin import Plugins, read_manifest
+from electrum.simple_config import SimpleConfig
+
+from . import SequentialTestCase
+
+
+class TestPluginManifest(SequentialTestCase):
+
+    def test_manifest_matches_module(self):
+        pkgpath = os.path.dirname(plugins.__file__)
+        for name in os.listdir(pkgpath):
+            path = os.path.join(pkgpath, name, '__init__.py')
+            if not os.path.exists(path):
+                continue
+            manifest = read_manifest(path)
+            module = importlib.import_module('electrum.plugins.' + name)
+            for key in ['fullname', 'description', 'requires', 'available_for',
+                        'registers_keystore', 'registers_wallet_type', 'requires_wallet_type']:
+                self.assertEqual(module.__dict__.get(key), manifest.get(key), (name, key))
+
+    def test_plugins_are_not_imported(self):
+        electrum_path = tempfile.mkdtemp()
+        saved = {k: v for k, v in sys.modules.items() if k.startswith('electrum.plugins.')}
+        for k in saved:
+            sys.modules.pop(k)
+        try:
+            p = Plugins(SimpleConfig({'electrum_path': electrum_path}), True, 'cmdline')
+            p.stop()
+            self.assertIn('trezor', p.hw_wallets)
+            self.assertEqual('electrum.plugins.labels', p.descriptions['labels']['__name__'])
+            self.assertNotIn('audio_modem', p.descriptions)
+            self.assertEqual([], [k for k in sys.modules if k.startswith('electrum.plugins.')])
+        finally:
+            sys.modules.update(saved)
+            shutil.rmtree(electrum_path)
@@ -0,0 +1,200 @@
+import queue
+import sys
+import threading
+import time
+
+from electrum.scheduler import WalletScheduler
+from electrum.synchronizer import Synchronizer
+from electrum.util import ThreadJob
+
+from . import SequentialTestCase
+
+
+class MockConfig(dict):
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+
+class CountingJob(ThreadJob):
+
+    def __init__(self, delay=0., fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.count = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.count += 1
+            self.active -= 1
+        if self.fail:
+            raise Exception('job failed')
+
+
+class TestWalletScheduler(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = WalletScheduler(MockConfig(wallet_workers=2, wallet_job_deadline=0.1))
+        self.scheduler.start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.scheduler.stop()
+
+    def tick(self, n, interval=0.01):
+        for i in range(n):
+            self.scheduler.run()
+            time.sleep(interval)
+
+    def test_slow_wallet_does_not_block_others(self):
+        slow = CountingJob(delay=0.3)
+        fast = CountingJob()
+        self.scheduler.add_jobs('slow', [slow])
+        self.scheduler.add_jobs('fast', [fast])
+        self.tick(20)
+        self.assertGreater(fast.count, 10)
+        self.assertLessEqual(slow.count, 1)
+        # a wallet never runs on two workers at once
+        self.assertEqual(1, slow.max_active)
+
+    def test_stats(self):
+        self.scheduler.add_jobs('w1', [CountingJob(), CountingJob(delay=0.15)])
+        self.tick(3, interval=0.2)
+        stats = self.scheduler.get_stats()['w1']
+        self.assertEqual(3, stats['runs'])
+        self.assertGreaterEqual(stats['max_ms'], 150)
+        self.assertEqual(3, stats['overruns'])
+
+    def test_failing_job_does_not_stop_others(self):
+        job = CountingJob()
+        self.scheduler.add_jobs('w1', [CountingJob(fail=True), job])
+        self.tick(5)
+        self.assertGreater(job.count, 0)
+
+    def test_remove_jobs_waits_for_run(self):
+        job = CountingJob(delay=0.2)
+        self.scheduler.add_jobs('w1', [job])
+        self.scheduler.run()
+        time.sleep(0.05)
+        self.scheduler.remove_jobs('w1', [job])
+        self.assertEqual(0, job.active)
+        self.assertEqual({}, self.scheduler.get_stats())
+        count = job.count
+        self.tick(5)
+        self.assertEqual(count, job.count)
+
+
+class MockSyncNetwork:
+    '''Queues the requests of the synchronizer; the test thread plays
+    the server and answers them, as the network thread would.'''
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def subscribe_to_addresses(self, addresses, callback):
+        for addr in addresses:
+            self.events.put(('status', addr))
+
+    def request_address_history(self, addr, callback):
+        self.events.put(('history', addr))
+
+    def trigger_callback(self, event, *args):
+        pass
+
+
+class MockSyncWallet:
+
+    def __init__(self, server_history):
+        self.server_history = server_history
+        self.history = {}
+        self.transactions = set(tx_hash for h in server_history.values() for tx_hash, height in h)
+        self.addresses = []
+        self.up_to_date = False
+        self.errors = []
+        self.synchronizer = None
+
+    def get_addresses(self):
+        return list(self.addresses)
+
+    def synchronize(self):
+        pass
+
+    def is_up_to_date(self):
+        return self.up_to_date
+
+    def set_up_to_date(self, up_to_date):
+        if up_to_date:
+            missing = [addr for addr in self.addresses
+                       if self.history.get(addr) != self.server_history[addr]]
+            if missing:
+                self.errors.append(missing)
+        self.up_to_date = up_to_date
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        self.history[addr] = hist
+
+
+class SlowDict(dict):
+    '''Pauses after checking for emptiness, so that the callbacks can
+    run in the middle of Synchronizer.is_up_to_date.'''
+
+    def __len__(self):
+        n = dict.__len__(self)
+        time.sleep(0.0002)
+        return n
+
+
+class TestSynchronizerOnWorker(SequentialTestCase):
+
+    def test_up_to_date_only_after_all_histories(self):
+        n = 100
+        server_history = {'addr%d' % i: [('%064x' % i, 100 + i)] for i in range(n)}
+        network = MockSyncNetwork()
+        wallet = MockSyncWallet(server_history)
+        sync = Synchronizer(wallet, network)
+        wallet.synchronizer = sync
+        sync.requested_histories = SlowDict()
+        stop = threading.Event()
+        def work():
+            # as a wallet worker of the scheduler would, only without pause
+            while not stop.is_set():
+                sync.run()
+        worker = threading.Thread(target=work)
+        worker.start()
+        # switch threads as often as possible, to interleave the worker
+        # with the callbacks
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for addr in sorted(server_history):
+                # new addresses are subscribed to by the worker
+                sync.add(addr)
+                wallet.addresses.append(addr)
+                # answer whatever is pending meanwhile
+                while True:
+                    try:
+                        kind, a = network.events.get(timeout=0.01)
+                    except queue.Empty:
+                        break
+                    hist = server_history[a]
+                    if kind == 'status':
+                        sync.on_address_status({'params': [a], 'result': sync.get_status(hist)})
+                    else:
+                        sync.on_address_history({'params': [a], 'result': [
+                            {'tx_hash': tx_hash, 'height': height} for tx_hash, height in hist]})
+        finally:
+            sys.setswitchinterval(interval)
+            stop.set()
+            worker.join()
+        self.assertEqual([], wallet.errors)
+        sync.run()
+        self.assertTrue(wallet.up_to_date)
+        self.assertEqual(server_history, wallet.history)
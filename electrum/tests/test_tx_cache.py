@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import time
+
+from electrum import Transaction
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer
+from electrum.tx_cache import TxCache
+
+from . import SequentialTestCase
+from .test_transaction import signed_blob, signed_segwit_blob
+from .test_payout_queue import FUNDING_TX
+
+
+class TestTxCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.cache = TxCache(self.config)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.electrum_path)
+
+    def test_put_get(self):
+        for raw in [signed_blob, signed_segwit_blob]:
+            tx = Transaction(raw)
+            self.assertIsNone(self.cache.get(tx.txid()))
+            self.cache.put(tx)
+            self.assertEqual(raw, self.cache.get(tx.txid()))
+        # shared with other instances
+        self.assertEqual(signed_blob, TxCache(self.config).get(Transaction(signed_blob).txid()))
+        self.assertIsNone(self.cache.get('../' * 20 + 'config'))
+
+    def test_corrupted_entry(self):
+        tx = Transaction(signed_blob)
+        self.cache.put(tx)
+        filename = self.cache.filename(tx.txid())
+        with open(filename, 'wb') as f:
+            f.write(bytes.fromhex(FUNDING_TX))
+        self.assertIsNone(self.cache.get(tx.txid()))
+        self.assertFalse(os.path.exists(filename))
+
+    def test_eviction(self):
+        self.config.set_key('tx_cache_size', 0.0006)  # 600 bytes
+        cache = TxCache(self.config)
+        txs = [Transaction(raw) for raw in [signed_blob, signed_segwit_blob, FUNDING_TX]]
+        for tx in txs[:2]:
+            cache.put(tx)
+        # make the first one the most recently used
+        past = time.time() - 100
+        os.utime(cache.filename(txs[1].txid()), (past, past))
+        cache.put(txs[2])
+        self.assertIsNotNone(cache.get(txs[0].txid()))
+        self.assertIsNone(cache.get(txs[1].txid()))
+        self.assertLessEqual(cache.size, 600)
+
+    def test_disabled(self):
+        self.config.set_key('tx_cache_size', 0)
+        cache = TxCache(self.config)
+        tx = Transaction(signed_blob)
+        cache.put(tx)
+        self.assertIsNone(cache.get(tx.txid()))
+
+
+
+class MockNetwork:
+    '''Answers transaction requests at once, and counts them.'''
+
+    def __init__(self, cache):
+        self.tx_cache = cache
+        self.requested = []
+
+    def subscribe_to_addresses(self, addresses, callback):
+        pass
+
+    def get_transactions(self, tx_hashes, callback):
+        for raw in [signed_blob, signed_segwit_blob]:
+            txid = Transaction(raw).txid()
+            if txid in tx_hashes:
+                self.requested.append(txid)
+                callback({'params': [txid], 'result': raw})
+
+    def trigger_callback(self, event, *args):
+        pass
+
+
+class MockWallet:
+
+    def __init__(self, encrypted):
+        self.encrypted = encrypted
+        self.history = {}
+        self.transactions = {}
+        self.synchronizer = None
+
+    def get_addresses(self):
+        return []
+
+    def use_shared_caches(self):
+        return not self.encrypted
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.transactions[tx_hash] = tx
+
+
+class TestSynchronizerTxCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.network = MockNetwork(TxCache(self.config))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.electrum_path)
+
+    def receive(self, encrypted, raw):
+        wallet = MockWallet(encrypted)
+        sync = Synchronizer(wallet, self.network)
+        wallet.synchronizer = sync
+        txid = Transaction(raw).txid()
+        sync.request_missing_txs([(txid, 100)])
+        self.assertEqual(raw, wallet.transactions[txid].raw)
+        return txid
+
+    def test_shared(self):
+        txid = self.receive(False, signed_blob)
+        self.assertEqual(signed_blob, self.network.tx_cache.get(txid))
+        # another wallet does not download it again
+        self.receive(False, signed_blob)
+        self.assertEqual([txid], self.network.requested)
+
+    def test_encrypted_wallet_does_not_write(self):
+        txid = self.receive(True, signed_blob)
+        self.assertIsNone(self.network.tx_cache.get(txid))
+        # but it reads what other wallets have downloaded
+        txid = self.receive(False, signed_segwit_blob)
+        self.receive(True, signed_segwit_blob)
+        self.assertEqual(1, self.network.requested.count(txid))
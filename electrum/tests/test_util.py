@@ -1,5 +1,5 @@
 import unittest
-from electrum.util import format_satoshis, parse_URI
+from electrum.util import format_satoshis, parse_URI, Debouncer
 
 from . import SequentialTestCase
 
@@ -107,3 +107,23 @@ class TestUtil(SequentialTestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class TestDebouncer(SequentialTestCase):
+
+    def test_burst_is_coalesced(self):
+        d = Debouncer(quiet=1, max_delay=5)
+        self.assertFalse(d.ready(now=0))
+        d.request(now=0)
+        d.request(now=0.5)
+        self.assertFalse(d.ready(now=1))
+        self.assertTrue(d.ready(now=1.5))
+        self.assertFalse(d.ready(now=2))
+
+    def test_max_delay(self):
+        d = Debouncer(quiet=1, max_delay=5)
+        for i in range(20):
+            d.request(now=i * 0.5)
+            if d.ready(now=i * 0.5):
+                break
+        self.assertEqual(5 * 2, i)
@@ -0,0 +1,182 @@
+from electrum import blockchain
+from electrum.blockchain import hash_header
+from electrum.tx_cache import ProofCache
+from electrum.verifier import SPV
+
+from .test_blockchain import BlockchainTestCase, make_headers
+
+
+class MockInterface:
+
+    def __init__(self, chain):
+        self.blockchain = chain
+
+
+class MockNetwork:
+
+    def __init__(self, chain, config):
+        self.chain = chain
+        self.interface = MockInterface(chain)
+        self.proof_cache = ProofCache(config)
+        self.merkle_requests = []
+        self.chunk_requests = []
+
+    def blockchain(self):
+        return self.chain
+
+    def get_local_height(self):
+        return self.chain.height()
+
+    def get_merkle_for_transaction(self, tx_hash, tx_height, callback):
+        self.merkle_requests.append((tx_hash, tx_height))
+
+    def request_chunks(self, chain, indexes):
+        self.chunk_requests.append(sorted(indexes))
+
+
+class MockWallet:
+
+    def __init__(self, unverified, encrypted=False):
+        self.unverified = unverified
+        self.verified = {}
+        self.verifier = None
+        self.encrypted = encrypted
+
+    def get_unverified_txs(self):
+        return {tx_hash: height for tx_hash, height in self.unverified.items()
+                if tx_hash not in self.verified}
+
+    def add_verified_tx(self, tx_hash, info):
+        self.verified[tx_hash] = info
+
+    def is_up_to_date(self):
+        return False
+
+    def use_shared_caches(self):
+        return not self.encrypted
+
+
+class TestChunkPrefetch(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.headers = self.make_main_chain(3 * 2016 + 10)
+        self.main.prune(3 * 2016)
+        self.network = MockNetwork(self.main, self.config)
+        # in our test chain, a block with a single tx has its txid as merkle root
+        self.txids = {height: self.headers[height]['merkle_root']
+                      for height in [2100, 3000, 4500, 6050]}
+        self.wallet = MockWallet({txid: height for height, txid in self.txids.items()})
+        self.spv = SPV(self.network, self.wallet)
+        self.wallet.verifier = self.spv
+
+    def proof(self, height):
+        return {
+            'params': [self.txids[height], height],
+            'result': {'block_height': height, 'pos': 0, 'merkle': []},
+        }
+
+    def refill(self, index):
+        hexdata = ''.join(blockchain.serialize_header(h)
+                          for h in self.headers[index * 2016:(index + 1) * 2016])
+        self.assertTrue(self.main.connect_chunk(index, hexdata))
+
+    def test_all_chunks_and_proofs_requested_at_once(self):
+        self.spv.run()
+        self.assertEqual([[1, 2]], self.network.chunk_requests)
+        self.assertEqual(4, len(self.network.merkle_requests))
+
+    def test_proofs_are_verified_as_chunks_arrive(self):
+        self.spv.run()
+        for height in self.txids:
+            self.spv.verify_merkle(self.proof(height))
+        # the header of the recent tx was not pruned
+        self.assertEqual([self.txids[6050]], list(self.wallet.verified))
+        self.refill(2)
+        self.spv.run()
+        self.assertEqual(4500, self.wallet.verified[self.txids[4500]].height)
+        self.assertEqual([1], self.network.chunk_requests[-1])
+        self.refill(1)
+        self.spv.run()
+        self.assertEqual(4, len(self.wallet.verified))
+        self.assertTrue(self.spv.is_up_to_date())
+        self.assertEqual(4, len(self.network.merkle_requests))
+
+
+class TestProofCache(BlockchainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.headers = self.make_main_chain(20)
+        self.network = MockNetwork(self.main, self.config)
+        self.txid = self.headers[10]['merkle_root']
+
+    def make_spv(self, encrypted=False):
+        wallet = MockWallet({self.txid: 10}, encrypted)
+        spv = SPV(self.network, wallet)
+        wallet.verifier = spv
+        return spv, wallet
+
+    def verify(self, encrypted=False):
+        spv, wallet = self.make_spv(encrypted)
+        spv.run()
+        spv.verify_merkle({
+            'params': [self.txid, 10],
+            'result': {'block_height': 10, 'pos': 0, 'merkle': []},
+        })
+        self.assertIn(self.txid, wallet.verified)
+
+    def test_proof_reused_after_restart(self):
+        self.verify()
+        self.assertEqual(1, len(self.network.merkle_requests))
+        spv, wallet = self.make_spv()
+        spv.run()
+        self.assertEqual(1, len(self.network.merkle_requests))
+        self.assertEqual(hash_header(self.headers[10]), wallet.verified[self.txid].header_hash)
+        self.assertTrue(spv.is_up_to_date())
+
+    def test_encrypted_wallet_does_not_write(self):
+        self.verify(encrypted=True)
+        self.assertEqual({}, self.network.proof_cache.get(self.txid))
+        spv, wallet = self.make_spv()
+        spv.run()
+        self.assertEqual(2, len(self.network.merkle_requests))
+
+    def test_cached_proof_checked_when_header_pruned(self):
+        main, headers = self.make_main_chain(3 * 2016 + 10)
+        main.prune(3 * 2016)
+        self.network = MockNetwork(main, self.config)
+        self.txid = headers[2100]['merkle_root']
+        header_hash = hash_header(headers[2100])
+        proof = {'height': 2100, 'pos': 0, 'merkle': [], 'timestamp': 0,
+                 'merkle_root': self.txid}
+        self.network.proof_cache.add(self.txid, header_hash, proof)
+        wallet = MockWallet({self.txid: 2100})
+        spv = SPV(self.network, wallet)
+        wallet.verifier = spv
+        spv.run()
+        self.assertIn(self.txid, wallet.verified)
+        self.assertEqual([], self.network.merkle_requests)
+        # a branch that does not lead to the merkle root is not trusted
+        proof['merkle'] = ['%064x' % 1]
+        self.network.proof_cache.add(self.txid, header_hash, proof)
+        wallet = MockWallet({self.txid: 2100})
+        spv = SPV(self.network, wallet)
+        wallet.verifier = spv
+        spv.run()
+        self.assertNotIn(self.txid, wallet.verified)
+        self.assertEqual([(self.txid, 2100)], self.network.merkle_requests)
+
+    def test_proof_not_reused_on_other_branch(self):
+        self.verify()
+        # a reorganisation replaces the block of our tx
+        fork_headers = make_headers(hash_header(self.headers[9]), 10, 12, nonce=1)
+        fork = self.main.fork(fork_headers[0])
+        blockchain.blockchains[fork.forkpoint] = fork
+        for header in fork_headers[1:]:
+            fork.save_header(header)
+        self.network.chain = self.network.interface.blockchain = blockchain.blockchains[0]
+        spv, wallet = self.make_spv()
+        spv.run()
+        self.assertEqual(2, len(self.network.merkle_requests))
+        self.assertNotIn(self.txid, wallet.verified)
@@ -4,11 +4,27 @@ import sys
 import unittest
 import os
 import json
+import csv
+import hashlib
+import hmac
+import time
 
 from io import StringIO
-from electrum.storage import WalletStorage, FINAL_SEED_VERSION
+from unittest import mock
 
-from . import SequentialTestCase
+from electrum import keystore
+from electrum.commands import Commands
+from electrum.paymentrequest import PaymentRequest, PR_PAID, PR_UNPAID
+from electrum.simple_config import SimpleConfig
+from electrum.address_synchronizer import (AddressSynchronizer, TX_HEIGHT_UNCONFIRMED,
+                                           TX_HEIGHT_LOCAL, SNAPSHOT_MAGIC)
+from electrum.storage import WalletStorage, FINAL_SEED_VERSION, STO_EV_USER_PW
+from electrum.transaction import Transaction
+from electrum.util import json_encode, InvalidPassword, VerifiedTxInfo
+from electrum.wallet import Standard_Wallet
+
+from . import SequentialTestCase, TestCaseForTestnet
+from .test_payout_queue import FUNDING_TX
 
 
 class FakeSynchronizer(object):
@@ -69,3 +85,409 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+
+class TestEncryptedStorage(WalletTestCase):
+
+    def create(self, data):
+        storage = WalletStorage(self.wallet_path)
+        for key, value in data.items():
+            storage.put(key, value)
+        storage.set_password('secret', STO_EV_USER_PW)
+        storage.set_segmented(True)
+        storage.write()
+        return storage
+
+    def open(self, password='secret'):
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        storage.decrypt(password)
+        return storage
+
+    def read_lines(self):
+        with open(self.wallet_path, "r") as f:
+            return f.read().split()
+
+    def test_segments(self):
+        txs = {'%064x' % i: '00' * 100 for i in range(2500)}
+        self.create({'seed_version': FINAL_SEED_VERSION, 'labels': {'a': 'b'}, 'transactions': txs})
+        lines = self.read_lines()
+        # header, seed_version, labels, 4 buckets of transactions, seal
+        self.assertEqual(8, len(lines))
+        storage = self.open()
+        self.assertEqual(txs, storage.get('transactions'))
+        self.assertEqual({'a': 'b'}, storage.get('labels'))
+        # only the changed segment is encrypted again
+        storage.put('labels', {'a': 'c'})
+        storage.write()
+        new_lines = self.read_lines()
+        self.assertEqual(lines[0], new_lines[0])
+        self.assertEqual(6, len(set(lines) & set(new_lines)))
+        self.assertEqual({'a': 'c'}, self.open().get('labels'))
+
+    def test_wrong_password(self):
+        self.create({'seed_version': FINAL_SEED_VERSION})
+        with self.assertRaises(InvalidPassword):
+            self.open('wrong')
+        storage = self.open()
+        storage.check_password('secret')
+        with self.assertRaises(InvalidPassword):
+            storage.check_password('wrong')
+
+    def test_only_current_password_is_cached(self):
+        self.create({'seed_version': FINAL_SEED_VERSION})
+        storage = self.open()
+        digest = storage.password_digest
+        self.assertIsNotNone(digest)
+        with self.assertRaises(InvalidPassword):
+            storage.check_password('wrong')
+        self.assertEqual(digest, storage.password_digest)
+        storage.forget_password()
+        self.assertIsNone(storage.password_digest)
+        storage.check_password('secret')
+        self.assertEqual(digest, storage.password_digest)
+        storage.set_password('other')
+        with self.assertRaises(InvalidPassword):
+            storage.check_password('secret')
+        storage.check_password('other')
+
+    def test_segments_are_authenticated(self):
+        self.create({'seed_version': FINAL_SEED_VERSION, 'a': 1, 'b': 2})
+        lines = self.read_lines()
+        with open(self.wallet_path, "w") as f:
+            f.write('\n'.join(lines[0:2] + lines[3:]))
+        with self.assertRaises(InvalidPassword):
+            self.open()
+
+    def test_single_message_format(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'b')
+        storage.set_password('secret', STO_EV_USER_PW)
+        with open(self.wallet_path, "w") as f:
+            f.write(storage.encrypt_before_writing(json.dumps(storage.data)))
+        storage = self.open()
+        self.assertEqual('b', storage.get('a'))
+        # it keeps its format, unless the segmented format is enabled
+        storage.put('c', 'd')
+        storage.write()
+        self.assertFalse(WalletStorage(self.wallet_path).is_segmented())
+        self.assertEqual('d', self.open().get('c'))
+        storage.set_segmented(True)
+        storage.put('c', 'e')
+        storage.write()
+        self.assertTrue(WalletStorage(self.wallet_path).is_segmented())
+        self.assertEqual('b', self.open().get('a'))
+        # removing the password writes plaintext
+        storage.set_password(None)
+        storage.write()
+        self.assertEqual('e', WalletStorage(self.wallet_path, manual_upgrades=True).get('c'))
+
+
+class TestWalletSnapshot(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        storage = WalletStorage(self.wallet_path)
+        storage.put('keystore', ks.dump())
+        storage.put('gap_limit', 2)
+        wallet = Standard_Wallet(storage)
+        wallet.synchronize()
+        tx = Transaction(FUNDING_TX)
+        wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        wallet.stop_threads()
+        self.wallet = wallet
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def open_wallet(self):
+        return Standard_Wallet(WalletStorage(self.wallet_path))
+
+    def assert_same_indexes(self, w1, w2):
+        self.assertEqual(w1.txi, w2.txi)
+        # outputs are tuples in memory, and lists when read from the file
+        self.assertEqual(json.loads(json.dumps(w1.txo)), json.loads(json.dumps(w2.txo)))
+        spent = lambda w: {k: v for k, v in w.spent_outpoints.items() if v}
+        self.assertEqual(spent(w1), spent(w2))
+        self.assertEqual(w1._history_local, w2._history_local)
+        self.assertEqual(set(w1.transactions), set(w2.transactions))
+        self.assertEqual(w1.get_balance(), w2.get_balance())
+
+    def test_snapshot_is_used(self):
+        self.assertTrue(os.path.exists(self.wallet.snapshot_path()))
+        with mock.patch.object(AddressSynchronizer, 'load_transactions') as load:
+            wallet = self.open_wallet()
+        self.assertFalse(load.called)
+        self.assert_same_indexes(self.wallet, wallet)
+
+    def test_outdated_snapshot_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'a': 'b'})
+        storage.write()
+        with mock.patch.object(AddressSynchronizer, 'load_transactions',
+                               side_effect=AddressSynchronizer.load_transactions,
+                               autospec=True) as load:
+            wallet = self.open_wallet()
+        self.assertTrue(load.called)
+        self.assert_same_indexes(self.wallet, wallet)
+
+    def test_corrupted_snapshot_is_ignored(self):
+        path = self.wallet.snapshot_path()
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        data[-1] ^= 1
+        with open(path, 'wb') as f:
+            f.write(data)
+        wallet = self.open_wallet()
+        self.assert_same_indexes(self.wallet, wallet)
+
+    def rewrite_snapshot(self, payload, key):
+        n = len(SNAPSHOT_MAGIC) + 1
+        with open(self.wallet.snapshot_path(), 'rb') as f:
+            header = f.read()[0:n]
+        with open(self.wallet.snapshot_path(), 'wb') as f:
+            f.write(header + hmac.new(key, payload, hashlib.sha256).digest() + payload)
+
+    def test_tampered_snapshot_is_ignored(self):
+        path = self.wallet.snapshot_path()
+        with open(path, 'rb') as f:
+            payload = f.read()[len(SNAPSHOT_MAGIC) + 33:]
+        d = json.loads(payload.decode('utf8'))
+        d['txo'] = {}
+        # without the key derived from the wallet file
+        self.rewrite_snapshot(json.dumps(d).encode('utf8'), hashlib.sha256(payload).digest())
+        wallet = self.open_wallet()
+        self.assert_same_indexes(self.wallet, wallet)
+
+    def test_malformed_snapshot_is_ignored(self):
+        self.rewrite_snapshot(b'\xe3\x00\x00', self.wallet.snapshot_key())
+        wallet = self.open_wallet()
+        self.assert_same_indexes(self.wallet, wallet)
+        self.rewrite_snapshot(b'{"txi": []}', self.wallet.snapshot_key())
+        wallet = self.open_wallet()
+        self.assert_same_indexes(self.wallet, wallet)
+
+
+class TestWalletChanges(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        storage = WalletStorage(os.path.join(self.user_dir, "somewallet"))
+        storage.put('keystore', ks.dump())
+        storage.put('gap_limit', 2)
+        self.wallet = Standard_Wallet(storage)
+        self.wallet.synchronize()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_changes(self):
+        txids, addresses = self.wallet.pop_changes()
+        self.assertEqual(set(), txids)
+        self.assertEqual(set(self.wallet.get_addresses()), addresses)
+        self.assertEqual((set(), set()), self.wallet.pop_changes())
+        tx = Transaction(FUNDING_TX)
+        txid = tx.txid()
+        self.wallet.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        txids, addresses = self.wallet.pop_changes()
+        self.assertEqual({txid}, txids)
+        self.assertTrue(addresses)
+        self.assertEqual(set(self.wallet.txo[txid]), addresses)
+        self.wallet.remove_transaction(txid)
+        self.assertEqual(({txid}, addresses), self.wallet.pop_changes())
+
+
+class TestHistoryExport(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        storage = WalletStorage(os.path.join(self.user_dir, "somewallet"))
+        storage.put('keystore', ks.dump())
+        storage.put('gap_limit', 2)
+        self.wallet = Standard_Wallet(storage)
+        self.wallet.synchronize()
+        tx = Transaction(FUNDING_TX)
+        self.txid = tx.txid()
+        self.wallet.receive_tx_callback(self.txid, tx, TX_HEIGHT_UNCONFIRMED)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_iter_history(self):
+        summary = {}
+        items = list(self.wallet.iter_history(summary=summary))
+        full = self.wallet.get_full_history()
+        self.assertEqual(json_encode(full['transactions']), json_encode(items))
+        self.assertEqual(json_encode(full['summary']), json_encode(summary))
+        self.assertEqual(self.wallet.get_balance()[1], summary['end_balance'].value)
+
+    def test_export_json(self):
+        f = StringIO()
+        self.assertEqual(1, self.wallet.export_history(f, False))
+        self.assertEqual(json_encode(self.wallet.get_full_history()['transactions']), f.getvalue())
+        f = StringIO()
+        self.assertEqual(0, self.wallet.export_history(f, False, from_timestamp=1, to_timestamp=2))
+        self.assertEqual([], json.loads(f.getvalue()))
+
+    def test_export_command(self):
+        path = os.path.join(self.user_dir, 'history.csv')
+        result = json.loads(Commands(None, self.wallet, None).history(output=path))
+        self.assertEqual(1, result['transactions'])
+        with open(path) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(2, len(rows))
+        self.assertEqual('transaction_hash', rows[0][0])
+        self.assertEqual(self.txid, rows[1][0])
+        # existing files are not overwritten, relative paths are refused
+        with self.assertRaises(Exception) as ctx:
+            Commands(None, self.wallet, None).history(output=path)
+        self.assertIn('File exists', str(ctx.exception))
+        with open(path) as f:
+            self.assertEqual(rows, list(csv.reader(f)))
+        with self.assertRaises(Exception) as ctx:
+            Commands(None, self.wallet, None).history(output='history.json')
+        self.assertIn('absolute', str(ctx.exception))
+
+
+class TestKeySession(SequentialTestCase):
+
+    xprv = 'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'
+
+    def setUp(self):
+        super().setUp()
+        self.ks = keystore.from_xprv(self.xprv)
+        self.expected = self.ks.get_private_key((0, 1), None)
+        self.ks.update_password(None, 'secret')
+
+    def test_session(self):
+        self.assertIsNone(self.ks.get_session('secret'))
+        with self.assertRaises(InvalidPassword):
+            self.ks.unlock('wrong')
+        session = self.ks.unlock('secret', 60)
+        self.assertEqual(self.expected, self.ks.get_private_key((0, 1), 'secret'))
+        self.assertEqual(self.expected, self.ks.get_private_key([0, 1], 'secret'))
+        # the session only answers to its password
+        self.assertIsNone(self.ks.get_session('wrong'))
+        with self.assertRaises(InvalidPassword):
+            self.ks.get_private_key((0, 1), 'wrong')
+        secrets = list(session.secrets.values())
+        self.assertTrue(any(any(s) for s in secrets))
+        self.ks.lock()
+        self.assertFalse(any(any(s) for s in secrets))
+        self.assertIsNone(self.ks.get_session('secret'))
+        self.assertEqual(self.expected, self.ks.get_private_key((0, 1), 'secret'))
+
+    def test_timeout(self):
+        self.ks.unlock('secret', 0.01)
+        time.sleep(0.1)
+        self.assertIsNone(self.ks.get_session('secret'))
+
+    def test_password_change_locks(self):
+        self.ks.unlock('secret', 60)
+        self.ks.update_password('secret', 'other')
+        self.assertIsNone(self.ks.session)
+        with self.assertRaises(InvalidPassword):
+            self.ks.get_private_key((0, 1), 'secret')
+
+    def test_imported(self):
+        ks = keystore.Imported_KeyStore({})
+        privkey = 'p2wpkh:L15oxP24NMNAXxq5r2aom24pHPtt3Fet8ZutgL155Bad93GSubM2'
+        txin_type, pubkey = ks.import_privkey(privkey, 'secret')
+        expected = ks.get_private_key(pubkey, 'secret')
+        ks.unlock('secret')
+        self.assertEqual(expected, ks.get_private_key(pubkey, 'secret'))
+        self.assertEqual(expected, ks.get_private_key(pubkey, 'secret'))
+        ks.lock()
+        self.assertIsNone(ks.session)
+
+
+class TestPaymentRequests(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.user_dir,
+                                    'requests_dir': os.path.join(self.user_dir, 'requests')})
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        storage = WalletStorage(os.path.join(self.user_dir, "somewallet"))
+        storage.put('keystore', ks.dump())
+        storage.put('gap_limit', 2)
+        self.wallet = Standard_Wallet(storage)
+        self.wallet.synchronize()
+        self.wallet.up_to_date = True
+        self.tx = Transaction(FUNDING_TX)
+        self.addr = [o.address for o in self.tx.outputs() if self.wallet.is_mine(o.address)][0]
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_status(self):
+        req = self.wallet.make_payment_request(self.addr, 1000000, 'coffee', 3600)
+        self.wallet.add_payment_request(req, self.config)
+        self.assertEqual((PR_UNPAID, None), self.wallet.get_request_status(self.addr))
+        self.assertIn(self.addr, self.wallet.received_cache)
+        self.wallet.receive_tx_callback(self.tx.txid(), self.tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertNotIn(self.addr, self.wallet.received_cache)
+        self.assertEqual((PR_PAID, 0), self.wallet.get_request_status(self.addr))
+        self.assertEqual(PR_PAID, self.wallet.get_payment_request(req['id'], self.config)['status'])
+
+    def test_received_cache_not_stale(self):
+        txid = self.tx.txid()
+        self.wallet.receive_tx_callback(txid, self.tx, 100)
+        self.wallet.unverified_tx.pop(txid)
+        self.wallet.verified_tx[txid] = VerifiedTxInfo(100, 0, 1, '00' * 32)
+        self.wallet.mark_tx_changed(txid)
+        value = self.wallet.get_received(self.addr)[0][1]
+        self.assertEqual([(100, value)], self.wallet.get_received(self.addr))
+        # a reader that runs as soon as the cache is invalidated
+        mark_changed = self.wallet.mark_changed
+        def mark_changed_and_read(*args, **kwargs):
+            mark_changed(*args, **kwargs)
+            self.wallet.get_received(self.addr)
+        self.wallet.mark_changed = mark_changed_and_read
+        self.wallet.add_unverified_tx(txid, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual([(None, value)], self.wallet.get_received(self.addr))
+        self.wallet.add_unverified_tx(txid, TX_HEIGHT_LOCAL)
+        self.wallet.remove_transaction(txid)
+        self.assertEqual([], self.wallet.get_received(self.addr))
+
+    def test_index(self):
+        req = self.wallet.make_payment_request(self.addr, 1000000, 'coffee', 3600)
+        out = self.wallet.add_payment_request(req, self.config)
+        self.assertIn('request_url', out)
+        requests = self.wallet.receive_requests
+        self.assertEqual(req, requests.get(req['id']))
+        self.assertEqual(req, requests[self.addr])
+        self.assertEqual([self.addr], list(requests))
+        # serialized requests are kept
+        s = requests.get_serialized(self.addr)
+        self.assertIs(s, requests.get_serialized(self.addr))
+        self.assertEqual(req['memo'], PaymentRequest(s).memo)
+        # until the request is replaced
+        req2 = self.wallet.make_payment_request(self.addr, 2000000, 'tea', 3600)
+        req2['id'] = 'abcdef'
+        self.wallet.add_payment_request(req2, self.config)
+        self.assertEqual('tea', PaymentRequest(requests.get_serialized(self.addr)).memo)
+        self.assertIsNone(requests.get(req['id']))
+        self.assertTrue(self.wallet.remove_payment_request(self.addr, self.config))
+        self.assertIsNone(requests.get('abcdef'))
+        self.assertEqual(0, len(requests))
+        self.assertEqual({}, self.wallet.storage.get('payment_requests'))
+
+    def test_expired_serialization_is_rebuilt(self):
+        req = self.wallet.make_payment_request(self.addr, 1000000, 'coffee', 60)
+        self.wallet.receive_requests.add(req)
+        s = self.wallet.receive_requests.get_serialized(self.addr)
+        with mock.patch('time.time', return_value=req['time'] + 61):
+            self.assertIsNot(s, self.wallet.receive_requests.get_serialized(self.addr))
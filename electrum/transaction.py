@@ -1164,10 +1164,14 @@ class Transaction:
 
     def sign(self, keypairs) -> None:
         # keypairs:  (x_)pubkey -> secret_bytes
+        # find the signatures we can add, then make all of them at once
+        to_sign = []
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            signatures = list(txin.get('signatures', []))
+            pre_hash = None
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
-                if self.is_txin_complete(txin):
+                if self.is_txin_complete(dict(txin, signatures=signatures)):
                     break
                 if pubkey in keypairs:
                     _pubkey = pubkey
@@ -1177,8 +1181,13 @@ class Transaction:
                     continue
                 print_error("adding signature for", _pubkey)
                 sec, compressed = keypairs.get(_pubkey)
-                sig = self.sign_txin(i, sec)
-                self.add_signature_to_txin(i, j, sig)
+                if pre_hash is None:
+                    pre_hash = Hash(bfh(self.serialize_preimage(i)))
+                signatures[j] = _pubkey
+                to_sign.append((i, j, sec, pre_hash))
+        sigs = ecc.sign_transaction_batch([(sec, pre_hash) for i, j, sec, pre_hash in to_sign])
+        for (i, j, sec, pre_hash), sig in zip(to_sign, sigs):
+            self.add_signature_to_txin(i, j, bh2u(sig) + '01')
 
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
@@ -0,0 +1,191 @@
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import re
+import threading
+
+from .util import PrintError, make_dir, bfh, bh2u
+from .transaction import Transaction
+
+
+class FileCache(PrintError):
+    '''Entries stored in a directory of the electrum directory, one file
+    per txid.  The least recently used entries are evicted when the cache
+    grows beyond the size given by the size_key config option, in
+    megabytes.'''
+
+    directory = None
+    size_key = None
+    default_size = None
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(config.path, self.directory)
+        self.max_size = int(config.get(self.size_key, self.default_size) * 1000000)
+        self.lock = threading.Lock()
+        self.size = None  # computed on first write
+
+    def filename(self, txid):
+        return os.path.join(self.path, txid[0:2], txid)
+
+    def read(self, txid):
+        if not self.max_size or not re.fullmatch('[0-9a-f]{64}', txid):
+            return None
+        filename = self.filename(txid)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # the mtime of an entry is its last use
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return data
+
+    def write(self, txid, data):
+        filename = self.filename(txid)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(e[2] for e in self.entries())
+            make_dir(self.path)
+            make_dir(os.path.dirname(filename))
+            if os.path.exists(filename):
+                self.size -= os.path.getsize(filename)
+            tmp = filename + '.tmp%d' % threading.get_ident()
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, filename)
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def entries(self):
+        '''(mtime, path, size) of every entry'''
+        if not os.path.exists(self.path):
+            return []
+        out = []
+        for d in os.scandir(self.path):
+            if not d.is_dir():
+                continue
+            for e in os.scandir(d.path):
+                if '.tmp' in e.name:
+                    continue
+                st = e.stat()
+                out.append((st.st_mtime, e.path, st.st_size))
+        return out
+
+    def evict(self):
+        # go well below the limit, so that we do not scan the
+        # directory again on the next write
+        target = self.max_size * 0.8
+        entries = sorted(self.entries())
+        self.size = sum(e[2] for e in entries)
+        for mtime, path, size in entries:
+            if self.size <= target:
+                break
+            self.remove(path)
+            self.size -= size
+        self.print_error('evicted entries, size is now', self.size)
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class TxCache(FileCache):
+    '''Raw transactions downloaded by any wallet, stored under their
+    txid.  Entries are checked against their txid when read, so a
+    corrupted file is never returned.
+
+    The cache is not encrypted: anyone who can read the electrum
+    directory can tell which transactions its wallets are involved
+    in.  Wallets with an encrypted file do not write to it, and
+    setting tx_cache_size to 0 disables it.'''
+
+    directory = 'txcache'
+    size_key = 'tx_cache_size'
+    default_size = 100
+
+    def get(self, txid):
+        '''Returns the raw transaction in hex, or None.'''
+        data = self.read(txid)
+        if data is None:
+            return None
+        raw = bh2u(data)
+        try:
+            ok = Transaction(raw).txid() == txid
+        except BaseException:
+            ok = False
+        if not ok:
+            self.print_error('removing corrupted entry', txid)
+            self.remove(self.filename(txid))
+            return None
+        return raw
+
+    def put(self, tx):
+        '''Stores a complete transaction.'''
+        if not self.max_size:
+            return
+        txid = tx.txid()
+        if txid is None:
+            return
+        if os.path.exists(self.filename(txid)):
+            return
+        self.write(txid, bfh(tx.raw))
+
+
+class ProofCache(FileCache):
+    '''Merkle proofs that the verifier has checked, for each block a
+    transaction was seen in.  A proof stays valid as long as the hash
+    of its block is in our chain at its height.  Like TxCache, it is
+    not encrypted, and wallets with an encrypted file do not write to
+    it.'''
+
+    directory = 'proofs'
+    size_key = 'proof_cache_size'
+    default_size = 20
+
+    def get(self, txid):
+        '''Returns a dict of block_hash -> proof, where a proof is a
+        dict with height, pos, merkle, merkle_root and timestamp.'''
+        data = self.read(txid)
+        if data is None:
+            return {}
+        try:
+            return json.loads(data.decode('utf8'))
+        except BaseException:
+            self.print_error('removing corrupted entry', txid)
+            self.remove(self.filename(txid))
+            return {}
+
+    def add(self, txid, block_hash, proof):
+        if not self.max_size:
+            return
+        proofs = self.get(txid)
+        proofs[block_hash] = proof
+        self.write(txid, json.dumps(proofs).encode('utf8'))
@@ -222,6 +222,36 @@ class DebugMem(ThreadJob):
             self.mem_stats()
             self.next_time = time.time() + self.interval
 
+class Debouncer:
+    '''Coalesces bursts of requests, such as the updates received while
+    catching up with many blocks.  ready() returns True once the
+    requests stopped for quiet seconds, or max_delay seconds after the
+    first pending request, so that a steady stream still gets served.'''
+
+    def __init__(self, quiet, max_delay):
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.first = None
+        self.last = None
+
+    def request(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.first is None:
+                self.first = now
+            self.last = now
+
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.first is None:
+                return False
+            if now - self.last < self.quiet and now - self.first < self.max_delay:
+                return False
+            self.first = self.last = None
+            return True
+
 class DaemonThread(threading.Thread, PrintError):
     """ daemon thread that terminates cleanly """
     verbosity_filter = 'd'
@@ -21,6 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from threading import Lock
 from typing import Sequence, Optional
 
 from .util import ThreadJob, bh2u, VerifiedTxInfo
@@ -36,7 +37,13 @@ class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
 class SPV(ThreadJob):
-    """ Simple Payment Verification """
+    """ Simple Payment Verification
+
+    run() may be called from a wallet worker while verify_merkle runs
+    on the network thread; requested_merkle and pending_proofs are
+    guarded by self.lock, which is never held while calling into the
+    network or the wallet.
+    """
 
     def __init__(self, network, wallet):
         self.wallet = wallet
@@ -44,6 +51,8 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.pending_proofs = {}  # txid -> merkle response waiting for its header
+        self.lock = Lock()
 
     def run(self):
         interface = self.network.interface
@@ -54,26 +63,47 @@ class SPV(ThreadJob):
         if not blockchain:
             return
 
+        # proofs that arrived before their header
+        with self.lock:
+            pending = list(self.pending_proofs.items())
+        for tx_hash, response in pending:
+            if blockchain.read_header(response['result'].get('block_height')):
+                with self.lock:
+                    self.pending_proofs.pop(tx_hash, None)
+                self.verify_merkle(response)
+
         local_height = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
+        missing_chunks = set()
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
-
+            if tx_hash in self.merkle_roots:
+                continue
+            with self.lock:
+                requested = tx_hash in self.requested_merkle
+            if not requested and self.verify_cached_proof(blockchain, tx_hash, tx_height):
+                continue
             header = blockchain.read_header(tx_height)
             if header is None:
-                index = tx_height // 2016
-                if index < len(blockchain.checkpoints):
-                    self.network.request_chunk(interface, index)
-            elif (tx_hash not in self.requested_merkle
-                    and tx_hash not in self.merkle_roots):
+                # checkpoint region, or pruned; the proof is requested
+                # meanwhile, and verified once the chunk has arrived
+                missing_chunks.add(tx_height // 2016)
+            if not requested:
+                # added before the request, so that the response
+                # always finds it
+                with self.lock:
+                    self.requested_merkle.add(tx_hash)
                 self.network.get_merkle_for_transaction(
                         tx_hash,
                         tx_height,
                         self.verify_merkle)
                 self.print_error('requested merkle', tx_hash)
-                self.requested_merkle.add(tx_hash)
+
+        # fetch all the missing headers at once, over several servers
+        if missing_chunks:
+            self.network.request_chunks(blockchain, missing_chunks)
 
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
@@ -94,6 +124,12 @@ class SPV(ThreadJob):
         pos = merkle.get('pos')
         merkle_branch = merkle.get('merkle')
         header = self.network.blockchain().read_header(tx_height)
+        if header is None:
+            with self.lock:
+                if tx_hash in self.requested_merkle:
+                    # wait for the chunk
+                    self.pending_proofs[tx_hash] = response
+                    return
         try:
             verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
         except MerkleVerificationFailure as e:
@@ -103,18 +139,56 @@ class SPV(ThreadJob):
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = header.get('merkle_root')
-        try:
+        with self.lock:
             # note: we could pop in the beginning, but then we would request
             # this proof again in case of verification failure from the same server
-            self.requested_merkle.remove(tx_hash)
-        except KeyError: pass
+            self.requested_merkle.discard(tx_hash)
         self.print_error("verified %s" % tx_hash)
         header_hash = hash_header(header)
+        if self.wallet.use_shared_caches():
+            self.network.proof_cache.add(tx_hash, header_hash, {
+                'height': tx_height,
+                'pos': pos,
+                'merkle': merkle_branch,
+                'merkle_root': header.get('merkle_root'),
+                'timestamp': header.get('timestamp'),
+            })
         vtx_info = VerifiedTxInfo(tx_height, header.get('timestamp'), pos, header_hash)
         self.wallet.add_verified_tx(tx_hash, vtx_info)
         if self.is_up_to_date() and self.wallet.is_up_to_date():
             self.wallet.save_verified_tx(write=True)
 
+    def verify_cached_proof(self, blockchain, tx_hash, tx_height):
+        '''Verifies tx_hash with a proof we have checked before, if its
+        block is still in our chain.  Returns True on success.'''
+        for header_hash, proof in self.network.proof_cache.get(tx_hash).items():
+            if proof.get('height') != tx_height:
+                continue
+            if blockchain.read_hash(tx_height) != header_hash:
+                continue
+            header = blockchain.read_header(tx_height)
+            try:
+                if header:
+                    verify_tx_is_in_block(tx_hash, proof['merkle'], proof['pos'], header, tx_height)
+                else:
+                    # the header was pruned: the branch must still lead
+                    # to the merkle root it was checked against
+                    merkle_root = self.hash_merkle_root(proof['merkle'], tx_hash, proof['pos'])
+                    if merkle_root != proof['merkle_root']:
+                        raise MerkleVerificationFailure(
+                            "merkle root mismatch in cached proof of %s" % tx_hash)
+            except (MerkleVerificationFailure, KeyError) as e:
+                self.print_error(str(e))
+                continue
+            self.merkle_roots[tx_hash] = proof['merkle_root']
+            self.print_error("verified %s with cached proof" % tx_hash)
+            vtx_info = VerifiedTxInfo(tx_height, proof['timestamp'], proof['pos'], header_hash)
+            self.wallet.add_verified_tx(tx_hash, vtx_info)
+            if self.is_up_to_date() and self.wallet.is_up_to_date():
+                self.wallet.save_verified_tx(write=True)
+            return True
+        return False
+
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
         """Return calculated merkle root."""
@@ -153,13 +227,13 @@ class SPV(ThreadJob):
 
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
-        try:
-            self.requested_merkle.remove(tx_hash)
-        except KeyError:
-            pass
+        with self.lock:
+            self.pending_proofs.pop(tx_hash, None)
+            self.requested_merkle.discard(tx_hash)
 
     def is_up_to_date(self):
-        return not self.requested_merkle
+        with self.lock:
+            return not self.requested_merkle
 
 
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
@@ -32,6 +32,7 @@ import sys
 import random
 import time
 import json
+import csv
 import copy
 import errno
 import traceback
@@ -43,11 +44,11 @@ from .i18n import _
 from .util import (NotEnoughFunds, PrintError, UserCancelled, profiler,
                    format_satoshis, format_fee_satoshis, NoDynamicFeeEstimates,
                    TimeoutException, WalletFileException, BitcoinException,
-                   InvalidPassword, format_time)
+                   InvalidPassword, format_time, MyEncoder)
 
 from .bitcoin import *
 from .version import *
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, Software_KeyStore
 from .storage import multisig_type, STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW
 
 from . import transaction, bitcoin, coinchooser, paymentrequest, contacts
@@ -57,7 +58,8 @@ from .address_synchronizer import (AddressSynchronizer, TX_HEIGHT_LOCAL,
                                    TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_UNCONFIRMED)
 
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
-from .paymentrequest import InvoiceStore
+from .paymentrequest import InvoiceStore, RequestStore, request_path
+from .payout_queue import PayoutQueue
 from .contacts import Contacts
 
 TX_STATUS = [
@@ -168,6 +170,10 @@ class Abstract_Wallet(AddressSynchronizer):
     verbosity_filter = 'w'
 
     def __init__(self, storage):
+        # address -> outputs received, for the status of payment requests.
+        # Entries are dropped by mark_changed, which runs while loading.
+        self.received_cache = {}
+        self.received_cache_version = 0
         AddressSynchronizer.__init__(self, storage)
 
         self.electrum_version = ELECTRUM_VERSION
@@ -177,7 +183,7 @@ class Abstract_Wallet(AddressSynchronizer):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.fiat_value            = storage.get('fiat_value', {})
-        self.receive_requests      = storage.get('payment_requests', {})
+        self.receive_requests      = RequestStore(storage)
 
         self.calc_unused_change_addresses()
 
@@ -188,6 +194,7 @@ class Abstract_Wallet(AddressSynchronizer):
         # invoices and contacts
         self.invoices = InvoiceStore(self.storage)
         self.contacts = Contacts(self.storage)
+        self.payout_queue = PayoutQueue(self)
 
         self.coin_price_cache = {}
 
@@ -386,18 +393,27 @@ class Abstract_Wallet(AddressSynchronizer):
         # return last balance
         return balance
 
-    @profiler
-    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
+    def iter_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
+                     show_addresses=False, progress=None, summary=None):
+        '''Yields the items of get_full_history one at a time, so that a
+        long history can be written out without holding all of it in
+        memory.  If summary is a dict, it is filled in once the iterator
+        is exhausted.  progress, if given, is called with the number of
+        transactions done and their total.  It may raise an exception to
+        cancel.'''
         from .util import timestamp_to_datetime, Satoshis, Fiat
-        out = []
         income = 0
         expenditures = 0
         capital_gains = Decimal(0)
         fiat_income = Decimal(0)
         fiat_expenditures = Decimal(0)
+        start_balance = end_balance = None
+        count = 0
         h = self.get_history(domain)
         now = time.time()
-        for tx_hash, tx_mined_status, value, balance in h:
+        for i, (tx_hash, tx_mined_status, value, balance) in enumerate(h):
+            if progress and i % 100 == 0:
+                progress(i, len(h))
             timestamp = tx_mined_status.timestamp
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
@@ -442,43 +458,78 @@ class Abstract_Wallet(AddressSynchronizer):
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
-            out.append(item)
+            if count == 0:
+                start_balance = None if balance is None else balance - value
+            end_balance = balance
+            count += 1
+            yield item
         # add summary
-        if out:
-            b, v = out[0]['balance'].value, out[0]['value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'income': Satoshis(income),
-                'expenditures': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled():
-                unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
-                summary['capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_income'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_expenditures'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['start_fiat_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['end_fiat_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['start_fiat_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['end_fiat_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        if summary is None or count == 0:
+            return
+        if from_timestamp is not None and to_timestamp is not None:
+            start_date = timestamp_to_datetime(from_timestamp)
+            end_date = timestamp_to_datetime(to_timestamp)
         else:
-            summary = {}
+            start_date = None
+            end_date = None
+        summary.update({
+            'start_date': start_date,
+            'end_date': end_date,
+            'start_balance': Satoshis(start_balance),
+            'end_balance': Satoshis(end_balance),
+            'income': Satoshis(income),
+            'expenditures': Satoshis(expenditures)
+        })
+        if fx and fx.is_enabled():
+            unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
+            summary['capital_gains'] = Fiat(capital_gains, fx.ccy)
+            summary['fiat_income'] = Fiat(fiat_income, fx.ccy)
+            summary['fiat_expenditures'] = Fiat(fiat_expenditures, fx.ccy)
+            summary['unrealized_gains'] = Fiat(unrealized, fx.ccy)
+            summary['start_fiat_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
+            summary['end_fiat_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
+            summary['start_fiat_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+            summary['end_fiat_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+
+    @profiler
+    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False, progress=None):
+        summary = {}
+        out = list(self.iter_history(domain, from_timestamp, to_timestamp, fx, show_addresses, progress, summary))
         return {
             'transactions': out,
             'summary': summary
         }
 
+    def export_history(self, f, is_csv, summary=None, **kwargs):
+        '''Writes the history to the file object f, one transaction at
+        a time, as CSV or as a JSON list.  kwargs are passed to
+        iter_history.  Returns the number of transactions written.'''
+        fx = kwargs.get('fx')
+        show_fiat = fx and fx.is_enabled()
+        items = self.iter_history(summary=summary, **kwargs)
+        n = 0
+        if is_csv:
+            writer = csv.writer(f, lineterminator='\n')
+            header = ["transaction_hash", "label", "confirmations", "value", "timestamp"]
+            if show_fiat:
+                header += ["fiat_value", "acquisition_price", "capital_gain"]
+            writer.writerow(header)
+            for item in items:
+                row = [item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['date']]
+                if show_fiat:
+                    row += [item['fiat_value'], item.get('acquisition_price', ''), item.get('capital_gain', '')]
+                writer.writerow(row)
+                n += 1
+        else:
+            # same output as json_encode of the list
+            f.write('[')
+            for item in items:
+                s = json.dumps(item, sort_keys=True, indent=4, cls=MyEncoder)
+                f.write((',' if n else '') + '\n    ' + s.replace('\n', '\n    '))
+                n += 1
+            f.write('\n]' if n else ']')
+        return n
+
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
         if label is '':
@@ -777,7 +828,8 @@ class Abstract_Wallet(AddressSynchronizer):
         tx = self.transactions.get(tx_hash, None)
         if not tx and self.network:
             try:
-                tx = Transaction(self.network.get_transaction(tx_hash))
+                tx = Transaction(self.network.get_transaction(
+                    tx_hash, cache=self.use_shared_caches()))
             except TimeoutException as e:
                 self.print_error('getting input txn from network timed out for {}'.format(tx_hash))
                 if not ignore_timeout:
@@ -821,6 +873,24 @@ class Abstract_Wallet(AddressSynchronizer):
                 continue
         return tx
 
+    def unlock_keystores(self, password, timeout):
+        '''Keeps the keys of the wallet decrypted for timeout seconds,
+        so that signing does not decrypt them for every request.'''
+        for k in self.get_keystores():
+            if isinstance(k, Software_KeyStore) and not k.is_watching_only():
+                k.unlock(password, timeout)
+
+    def lock_keystores(self):
+        for k in self.get_keystores():
+            if isinstance(k, Software_KeyStore):
+                k.lock()
+        self.storage.forget_password()
+
+    def stop_threads(self):
+        AddressSynchronizer.stop_threads(self)
+        self.lock_keystores()
+        self.payout_queue.clear_password()
+
     def get_unused_addresses(self):
         # fixme: use slots from expired requests
         domain = self.get_receiving_addresses()
@@ -846,16 +916,38 @@ class Abstract_Wallet(AddressSynchronizer):
                     choice = addr
         return choice
 
+    def mark_changed(self, txids=(), addresses=()):
+        addresses = list(addresses)
+        with self.changes_lock:
+            self.received_cache_version += 1
+            for addr in addresses:
+                self.received_cache.pop(addr, None)
+        AddressSynchronizer.mark_changed(self, txids, addresses)
+
+    def get_received(self, address):
+        '''(height, value) of the outputs received by address, where
+        height is None for unverified transactions.'''
+        with self.changes_lock:
+            received = self.received_cache.get(address)
+            version = self.received_cache_version
+        if received is not None:
+            return received
+        received = []
+        for txo, (h, v, is_cb) in self.get_addr_io(address)[0].items():
+            txid, n = txo.split(':')
+            info = self.verified_tx.get(txid)
+            received.append((info.height if info else None, v))
+        with self.changes_lock:
+            if version == self.received_cache_version:
+                self.received_cache[address] = received
+        return received
+
     def get_payment_status(self, address, amount):
         local_height = self.get_local_height()
-        received, sent = self.get_addr_io(address)
         l = []
-        for txo, x in received.items():
-            h, v, is_cb = x
-            txid, n = txo.split(':')
-            info = self.verified_tx.get(txid)
-            if info:
-                conf = local_height - info.height
+        for height, v in self.get_received(address):
+            if height is not None:
+                conf = local_height - height
             else:
                 conf = 0
             l.append((conf, v))
@@ -870,6 +962,7 @@ class Abstract_Wallet(AddressSynchronizer):
         r = self.receive_requests.get(addr)
         if not r:
             return
+        addr = r['address']
         out = copy.copy(r)
         out['URI'] = 'bitcoin:' + addr + '?amount=' + format_satoshis(out.get('amount'))
         status, conf = self.get_request_status(addr)
@@ -880,8 +973,7 @@ class Abstract_Wallet(AddressSynchronizer):
         rdir = config.get('requests_dir')
         if rdir:
             key = out.get('id', addr)
-            path = os.path.join(rdir, 'req', key[0], key[1], key)
-            if os.path.exists(path):
+            if self.receive_requests.has_file(rdir, key):
                 baseurl = 'file://' + rdir
                 rewrite = config.get('url_rewrite')
                 if rewrite:
@@ -942,8 +1034,7 @@ class Abstract_Wallet(AddressSynchronizer):
         paymentrequest.sign_request_with_alias(pr, alias, alias_privkey)
         req['name'] = pr.pki_data
         req['sig'] = bh2u(pr.signature)
-        self.receive_requests[key] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        self.receive_requests.add(req)
 
     def add_payment_request(self, req, config):
         addr = req['address']
@@ -954,15 +1045,13 @@ class Abstract_Wallet(AddressSynchronizer):
 
         amount = req.get('amount')
         message = req.get('memo')
-        self.receive_requests[addr] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        self.receive_requests.add(req)
         self.set_label(addr, message) # should be a default label
 
         rdir = config.get('requests_dir')
         if rdir and amount is not None:
             key = req.get('id', addr)
-            pr = paymentrequest.make_request(config, req)
-            path = os.path.join(rdir, 'req', key[0], key[1], key)
+            path = request_path(rdir, key)
             if not os.path.exists(path):
                 try:
                     os.makedirs(path)
@@ -970,7 +1059,8 @@ class Abstract_Wallet(AddressSynchronizer):
                     if exc.errno != errno.EEXIST:
                         raise
             with open(os.path.join(path, key), 'wb') as f:
-                f.write(pr.SerializeToString())
+                f.write(self.receive_requests.get_serialized(addr, config))
+            self.receive_requests.set_file(key, True)
             # reload
             req = self.get_payment_request(addr, config)
             with open(os.path.join(path, key + '.json'), 'w', encoding='utf-8') as f:
@@ -980,15 +1070,15 @@ class Abstract_Wallet(AddressSynchronizer):
     def remove_payment_request(self, addr, config):
         if addr not in self.receive_requests:
             return False
-        r = self.receive_requests.pop(addr)
+        r = self.receive_requests.remove(addr)
         rdir = config.get('requests_dir')
         if rdir:
             key = r.get('id', addr)
             for s in ['.json', '']:
-                n = os.path.join(rdir, 'req', key[0], key[1], key, key + s)
+                n = os.path.join(request_path(rdir, key), key + s)
                 if os.path.exists(n):
                     os.unlink(n)
-        self.storage.put('payment_requests', self.receive_requests)
+            self.receive_requests.set_file(key, False)
         return True
 
     def get_sorted_requests(self, config):
@@ -1069,6 +1159,7 @@ class Abstract_Wallet(AddressSynchronizer):
         #       If these were not the case,
         #       extra care would need to be taken when encrypting keystores.
         self._update_password_for_keystore(old_pw, new_pw)
+        self.payout_queue.clear_password()
         encrypt_keystore = self.can_have_keystore_encryption()
         self.storage.set_keystore_encryption(bool(new_pw) and encrypt_keystore)
 
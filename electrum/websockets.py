@@ -24,7 +24,7 @@
 # SOFTWARE.
 import queue
 import threading, os, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 try:
     from SimpleWebSocketServer import WebSocket, SimpleSSLWebSocketServer
 except ImportError:
@@ -33,6 +33,7 @@ except ImportError:
 
 from . import util
 from . import bitcoin
+from .paymentrequest import request_path
 
 request_queue = queue.Queue()
 
@@ -54,23 +55,37 @@ class ElectrumWebSocket(WebSocket):
 
 class WsClientThread(util.DaemonThread):
 
+    max_cached_requests = 1000
+
     def __init__(self, config, network):
         util.DaemonThread.__init__(self)
         self.network = network
         self.config = config
         self.response_queue = queue.Queue()
         self.subscriptions = defaultdict(list)
+        # request id -> (mtime, address, amount), least recently used first
+        self.requests = OrderedDict()
 
     def make_request(self, request_id):
-        # read json file
         rdir = self.config.get('requests_dir')
-        n = os.path.join(rdir, 'req', request_id[0], request_id[1], request_id, request_id + '.json')
-        with open(n, encoding='utf-8') as f:
-            s = f.read()
-        d = json.loads(s)
-        addr = d.get('address')
-        amount = d.get('amount')
-        return addr, amount
+        n = os.path.join(request_path(rdir, request_id), request_id + '.json')
+        try:
+            mtime = os.stat(n).st_mtime
+        except OSError:
+            # the request was removed
+            self.requests.pop(request_id, None)
+            raise
+        r = self.requests.pop(request_id, None)
+        if r is None or r[0] != mtime:
+            # read json file
+            with open(n, encoding='utf-8') as f:
+                s = f.read()
+            d = json.loads(s)
+            r = mtime, d.get('address'), d.get('amount')
+        self.requests[request_id] = r
+        if len(self.requests) > self.max_cached_requests:
+            self.requests.popitem(last=False)
+        return r[1], r[2]
 
     def reading_thread(self):
         while self.is_running():